@@ -0,0 +1,371 @@
+import os
+import re
+import sys
+import time
+import random
+import shutil
+import logging
+import argparse
+import tempfile
+import tracemalloc
+
+from main_2023 import (
+    read_json, write_json, write_csv,
+    get_gene_id_file, get_gene_id_type_list,
+    read_gene_id_dictionary, tag_gene_id_by_sentence,
+    read_gene_id_trie, tag_gene_id_by_sentence_trie,
+    read_gene_id_approximate_index, tag_gene_id_by_sentence_approximate,
+)
+
+logger = logging.getLogger(__name__)
+
+# Synthetic alias tables and corpora for timing GeneID taggers before corpus runs.
+# Alias tables mimic the gene_id/{Genus}_{species}.csv files:
+#   one row per gene id, the id first, then 0-4 aliases;
+#   most aliases are short symbols (MYB12, AtPIN3, bHLH041), some are multi-word full names.
+# Corpus sentences are filler words with aliases planted at a controlled density,
+# i.e. the expected number of planted aliases per sentence.
+# Some planted aliases are formatting variants only the approximate engine finds:
+#   hyphen (MYB12 -> MYB-12), space (MYB12 -> MYB 12), Greek letter (alphaVPE3 <-> αVPE3),
+#   and one edit (a letter substituted or deleted; digits are kept).
+# With --source_dir, sentences are read from NER batch files and tagged with a real --gene_id_dir instead.
+
+species_list = [
+    ("Arabidopsis thaliana", "AT", "At"),
+    ("Oryza sativa", "LOC_Os", "Os"),
+    ("Zea mays", "Zm", "Zm"),
+    ("Populus trichocarpa", "Potri.", "Pt"),
+    ("Glycine max", "Glyma.", "Gm"),
+]
+symbol_stem_list = [
+    "MYB", "PIN", "ARF", "WRKY", "NAC", "bHLH", "ERF", "DREB", "GA20ox", "CYP", "LHY", "FLC", "SOC", "PHY", "CRY",
+    "HSP", "LEA", "NRT", "PHT", "SWEET", "TCP", "SPL", "GRF", "YUC", "AUX", "IAA", "SAUR", "BZR", "BRI", "PYL",
+    "alphaVPE", "betaAMY", "γTIP", "δVPE",
+]
+greek_letter_list = [("alpha", "α"), ("beta", "β"), ("gamma", "γ"), ("delta", "δ")]
+variant_list = ["exact", "upper", "lower", "hyphen", "space", "greek", "edit"]
+letter_digit_pattern = re.compile(r"(?<=[^\W\d_])(?=\d)")
+full_name_word_list = [
+    "auxin", "response", "factor", "transcription", "binding", "protein", "kinase", "receptor", "like", "domain",
+    "containing", "heat", "shock", "nitrate", "transporter", "phosphate", "sugar", "flowering", "locus", "zinc",
+    "finger", "family", "ethylene", "responsive", "element", "cytochrome", "oxidase", "repeat", "leucine", "rich",
+]
+filler_word_list = [
+    "the", "of", "and", "in", "to", "was", "were", "expression", "levels", "plants", "under", "stress", "we",
+    "found", "that", "mutant", "lines", "showed", "increased", "reduced", "root", "leaf", "growth", "during",
+    "development", "analysis", "revealed", "significant", "differences", "between", "wild-type", "and", "seedlings",
+    "treated", "with", "compared", "control", "conditions", "(", ")", ",", ";", "p", "<", "0.05", "Fig.", "2A",
+]
+
+
+def get_synthetic_alias(rng):
+    # ~80% symbols of 3-10 characters, ~20% full names of 2-4 words;
+    # ~3% of symbols carry a letter that changes length or context when lowercased (İ -> i̇, final Σ)
+    if rng.random() < 0.8:
+        alias = rng.choice(symbol_stem_list) + str(rng.randint(1, 999))
+        r = rng.random()
+        if r < 0.15:
+            alias = alias + rng.choice(["a", "b", "-1", "-2", ".1"])
+        elif r < 0.25:
+            alias = rng.choice(["At", "Os", "Zm", "Pt", "Gm"]) + alias
+        elif r < 0.28:
+            alias = rng.choice(["İ", "Σ", "é", "ß"]) + alias
+        return alias
+    words = rng.randint(2, 4)
+    alias = " ".join(rng.choice(full_name_word_list) for _ in range(words)) + " " + str(rng.randint(1, 99))
+    return alias
+
+
+def write_synthetic_gene_id_dir(gene_id_dir, names, seed=0):
+    # names: total aliases over all species (gene ids count as names, like in read_gene_id_dictionary)
+    rng = random.Random(seed)
+    os.makedirs(gene_id_dir, exist_ok=True)
+    species_to_row_list = {species: [] for species, _, _ in species_list}
+    alias_list = []
+    written = 0
+    gi = 0
+
+    while written < names:
+        species, id_prefix, _ = species_list[gi % len(species_list)]
+        _id = f"{id_prefix}{gi // len(species_list):07d}"
+        row = [_id]
+        for _ in range(min(rng.randint(0, 4), names - written - 1)):
+            alias = get_synthetic_alias(rng)
+            row.append(alias)
+            alias_list.append(alias)
+        species_to_row_list[species].append(row)
+        written += len(row)
+        gi += 1
+
+    for species, row_list in species_to_row_list.items():
+        write_csv(get_gene_id_file(gene_id_dir, species), "csv", row_list, write_log=False)
+    logger.info(f"Wrote {written:,} names of {gi:,} gene ids to {gene_id_dir}")
+    return alias_list
+
+
+def get_synthetic_variant(alias, variant, rng):
+    # returns the variant of alias, or alias itself if it has no such variant
+    if variant == "upper":
+        return alias.upper()
+    if variant == "lower":
+        return alias.lower()
+    if variant == "hyphen":
+        if " " in alias:
+            return alias.replace(" ", "-")
+        return letter_digit_pattern.sub("-", alias, count=1)
+    if variant == "space":
+        return letter_digit_pattern.sub(" ", alias, count=1)
+    if variant == "greek":
+        for spelled, letter in greek_letter_list:
+            if spelled in alias:
+                return alias.replace(spelled, letter, 1)
+            if letter in alias:
+                return alias.replace(letter, spelled, 1)
+        return alias
+    if variant == "edit":
+        letter_index_list = [i for i, c in enumerate(alias) if c.isalpha()]
+        if not letter_index_list:
+            return alias
+        i = rng.choice(letter_index_list)
+        if rng.random() < 0.5:
+            return alias[:i] + alias[i + 1:]
+        c = rng.choice([c for c in "abcdefghijklmnopqrstuvwxyz" if c != alias[i].lower()])
+        return alias[:i] + c + alias[i + 1:]
+    return alias
+
+
+def get_synthetic_corpus(alias_list, sentences, density, words=25, seed=0):
+    # returns the sentences and the number of planted aliases of each variant
+    rng = random.Random(seed)
+    sentence_list = []
+    variant_to_planted = {variant: 0 for variant in variant_list}
+
+    for _ in range(sentences):
+        word_list = [rng.choice(filler_word_list) for _ in range(words)]
+        # Bernoulli trials per word slot, so the expected number of planted aliases is density
+        for wi in range(words):
+            if rng.random() < density / words:
+                alias = rng.choice(alias_list)
+                # ~60% exact; the rest split evenly over the other variants (falling back to exact when absent)
+                r = rng.random()
+                variant = "exact"
+                if r < 0.4:
+                    variant = variant_list[1 + int(r / 0.4 * 6)]
+                    variant_alias = get_synthetic_variant(alias, variant, rng)
+                    if variant_alias == alias:
+                        variant = "exact"
+                    alias = variant_alias
+                word_list[wi] = alias
+                variant_to_planted[variant] += 1
+        sentence_list.append(" ".join(word_list) + ".")
+
+    planted = sum(variant_to_planted.values())
+    logger.info(
+        f"{sentences:,} sentences; {planted:,} planted aliases; {planted / max(sentences, 1):.2f} per sentence;"
+        + "".join(f" {variant} {count:,}" for variant, count in variant_to_planted.items())
+    )
+    return sentence_list, variant_to_planted
+
+
+def read_corpus(source_dir, start, end):
+    sentence_list = []
+    for bi in range(start, end + 1):
+        source_file = os.path.join(source_dir, f"batch_{bi}.json")
+        sentence_list.extend(datum["sentence"] for datum in read_json(source_file, write_log=False))
+    logger.info(f"Read {len(sentence_list):,} sentences of batch [{start:,}-{end:,}] from {source_dir}")
+    return sentence_list
+
+
+def read_engine(gene_id_dir, gene_id_type_list, engine, max_distance=1, min_length=5):
+    if engine == "dict":
+        return read_gene_id_dictionary(gene_id_dir, gene_id_type_list)
+    if engine == "trie":
+        return read_gene_id_trie(gene_id_dir, gene_id_type_list)
+    if engine == "trie+approximate":
+        return (
+            read_gene_id_trie(gene_id_dir, gene_id_type_list),
+            read_gene_id_approximate_index(gene_id_dir, gene_id_type_list, max_distance, min_length),
+        )
+    assert False
+
+
+def tag_engine(sentence, engine, index):
+    if engine == "dict":
+        return tag_gene_id_by_sentence(sentence, index)
+    if engine == "trie":
+        return tag_gene_id_by_sentence_trie(sentence, index)
+    if engine == "trie+approximate":
+        trie, approximate_index = index
+        mention_list = tag_gene_id_by_sentence_trie(sentence, trie)
+        return mention_list + tag_gene_id_by_sentence_approximate(sentence, approximate_index, mention_list)
+    assert False
+
+
+def get_mention_key_list(mention_list):
+    return sorted((m["real_pos"][0], m["real_pos"][1], m["type"], tuple(m["id"])) for m in mention_list)
+
+
+def benchmark_engine(gene_id_dir, sentence_list, engine, max_distance=1, min_length=5):
+    gene_id_type_list = get_gene_id_type_list(gene_id_dir)
+    logging.disable(logging.INFO)
+
+    # memory pass: tracemalloc slows allocation down, so it is not timed
+    tracemalloc.start()
+    index = read_engine(gene_id_dir, gene_id_type_list, engine, max_distance, min_length)
+    index_bytes, build_peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    for sentence in sentence_list[:1000]:
+        tag_engine(sentence, engine, index)
+    _, tag_peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del index
+
+    start_time = time.perf_counter()
+    index = read_engine(gene_id_dir, gene_id_type_list, engine, max_distance, min_length)
+    build_seconds = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    mentionlist_list = [tag_engine(sentence, engine, index) for sentence in sentence_list]
+    tag_seconds = time.perf_counter() - start_time
+    logging.disable(logging.NOTSET)
+
+    result = {
+        "engine": engine,
+        "build_seconds": build_seconds,
+        "tag_seconds": tag_seconds,
+        "sentences_per_second": len(sentence_list) / tag_seconds,
+        "characters_per_second": sum(len(sentence) for sentence in sentence_list) / tag_seconds,
+        "index_mb": index_bytes / 2**20,
+        "build_peak_mb": build_peak_bytes / 2**20,
+        "tag_peak_mb": tag_peak_bytes / 2**20,
+        "mentions": sum(len(mention_list) for mention_list in mentionlist_list),
+        "approximate_mentions": sum(
+            mention.get("match") == "approximate" for mention_list in mentionlist_list for mention in mention_list
+        ),
+    }
+    return result, [get_mention_key_list(mention_list) for mention_list in mentionlist_list]
+
+
+def compare_engines(gene_id_dir, sentence_list, engine_list, reference_engine, max_distance=1, min_length=5):
+    # Every engine is compared to reference_engine (the current tagger):
+    # exact engines must produce the same mentions, fuzzy engines a superset of them.
+    result_list = []
+    reference = None
+
+    for engine in [reference_engine] + [e for e in engine_list if e != reference_engine]:
+        result, key_list_list = benchmark_engine(gene_id_dir, sentence_list, engine, max_distance, min_length)
+        if reference is None:
+            reference = key_list_list
+            result["equal_to_reference"] = True
+        elif engine.endswith("+approximate"):
+            result["equal_to_reference"] = all(
+                set(a) <= set(b) for a, b in zip(reference, key_list_list)
+            )
+        else:
+            result["equal_to_reference"] = key_list_list == reference
+        result_list.append(result)
+    return result_list
+
+
+def log_result(prefix, result, reference_engine):
+    logger.info(
+        f"{prefix} [{result['engine']}]"
+        f" build {result['build_seconds']:.2f}s;"
+        f" {result['sentences_per_second']:,.0f} sentences/s;"
+        f" index {result['index_mb']:,.1f}MB; build peak {result['build_peak_mb']:,.1f}MB;"
+        f" {result['mentions']:,} mentions ({result['approximate_mentions']:,} approximate);"
+        f" {'equal to' if result['equal_to_reference'] else 'DIFFERENT from'} {reference_engine}"
+    )
+    return
+
+
+def run_benchmark(
+        names_list, sentences, density_list, engine_list, reference_engine="dict", seed=0,
+        max_distance=1, min_length=5,
+):
+    result_list = []
+    work_dir = tempfile.mkdtemp(prefix="benchmark_gene_id_")
+
+    try:
+        for names in names_list:
+            gene_id_dir = os.path.join(work_dir, f"gene_id_{names}")
+            alias_list = write_synthetic_gene_id_dir(gene_id_dir, names, seed)
+
+            for density in density_list:
+                sentence_list, variant_to_planted = get_synthetic_corpus(alias_list, sentences, density, seed=seed)
+                for result in compare_engines(
+                        gene_id_dir, sentence_list, engine_list, reference_engine, max_distance, min_length,
+                ):
+                    result = {
+                        "names": names, "sentences": sentences, "density": density,
+                        "planted": variant_to_planted, **result,
+                    }
+                    result_list.append(result)
+                    log_result(f"[{names:,} names; density {density}]", result, reference_engine)
+    finally:
+        shutil.rmtree(work_dir)
+
+    mismatches = sum(not result["equal_to_reference"] for result in result_list)
+    return result_list, mismatches
+
+
+def run_corpus_benchmark(
+        gene_id_dir, source_dir, start, end, engine_list, reference_engine="dict", max_distance=1, min_length=5,
+):
+    sentence_list = read_corpus(source_dir, start, end)
+    result_list = []
+    for result in compare_engines(
+            gene_id_dir, sentence_list, engine_list, reference_engine, max_distance, min_length,
+    ):
+        result = {"source_dir": source_dir, "start": start, "end": end, "sentences": len(sentence_list), **result}
+        result_list.append(result)
+        log_result(f"[batch {start:,}-{end:,}]", result, reference_engine)
+
+    mismatches = sum(not result["equal_to_reference"] for result in result_list)
+    return result_list, mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--names", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--sentences", type=int, default=10000)
+    parser.add_argument("--density", type=float, nargs="+", default=[0.1, 1.0])
+    parser.add_argument("--engine", type=str, nargs="+", default=["dict", "trie"])
+    parser.add_argument("--reference_engine", type=str, default="dict")
+    parser.add_argument("--seed", type=int, default=0)
+    # approximate index, as in main_2023.py --approximate
+    parser.add_argument("--max_distance", type=int, default=1)
+    parser.add_argument("--min_length", type=int, default=5)
+    # real corpus instead of synthetic data: NER batch_{start..end}.json files and gene_id/{Genus}_{species}.csv files
+    parser.add_argument("--gene_id_dir", type=str)
+    parser.add_argument("--source_dir", type=str)
+    parser.add_argument("--start", type=int)
+    parser.add_argument("--end", type=int)
+    parser.add_argument("--result_file", type=str)
+    arg = parser.parse_args()
+    for key, value in vars(arg).items():
+        if value is not None:
+            logger.info(f"[arg.{key}] {value}")
+
+    if arg.source_dir:
+        result_list, mismatches = run_corpus_benchmark(
+            arg.gene_id_dir, arg.source_dir, arg.start, arg.end, arg.engine, arg.reference_engine,
+            arg.max_distance, arg.min_length,
+        )
+    else:
+        result_list, mismatches = run_benchmark(
+            arg.names, arg.sentences, arg.density, arg.engine, arg.reference_engine, arg.seed,
+            arg.max_distance, arg.min_length,
+        )
+    if arg.result_file:
+        write_json(arg.result_file, result_list, indent=2)
+
+    # non-zero exit when an engine disagrees with the reference, so a script or CI can stop before corpus runs
+    if mismatches:
+        logger.error(f"{mismatches} engine runs differ from {arg.reference_engine}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,10 +1,36 @@
 import os
+import re
 import csv
 import sys
 import json
+import hashlib
+import inspect
 import logging
+import shutil
+import sqlite3
 import argparse
-from collections import defaultdict
+import multiprocessing
+from array import array
+from bisect import bisect_left
+from collections import deque, defaultdict
+
+# greek_alphabet
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pdf_to_text"))
+from greek_alphabet import GREEK_ALPHABETS
+
+# record_file: NER batch formats of plant_ner/tool/main.py --output_format
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "plant_ner", "tool"))
+from record_file import find_record_file, get_record_file, iterate_record_file
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(
@@ -49,12 +75,31 @@ def write_lines(file, line_list, write_log=True):
     return
 
 
-def read_json(file, write_log=True):
+def get_json_backend(json_backend):
+    # json: the reference output; orjson: faster, the same data in different bytes
+    # (compact separators, non-ASCII characters unescaped), so outputs no longer diff or hash equal
+    if json_backend == "orjson" and orjson is None:
+        raise ImportError("json_backend=orjson requires the orjson package")
+    assert json_backend in ["json", "orjson"]
+    return json_backend
+
+
+def dump_json_string(data, json_backend="json"):
+    if json_backend == "orjson":
+        return orjson.dumps(data).decode("utf8")
+    return json.dumps(data)
+
+
+def read_json(file, write_log=True, json_backend="json"):
     if write_log:
         logger.info(f"Reading {file}")
 
-    with open(file, "r", encoding="utf8") as f:
-        data = json.load(f)
+    if json_backend == "orjson":
+        with open(file, "rb") as f:
+            data = orjson.loads(f.read())
+    else:
+        with open(file, "r", encoding="utf8") as f:
+            data = json.load(f)
 
     if write_log:
         objects = len(data)
@@ -104,11 +149,214 @@ def write_csv(file, dialect, row_list, write_log=True):
     return
 
 
+"""
+string dictionary
+"""
+# Repeated strings (PMIDs, gene ids, names, sentences) are interned into integer ids,
+# so aggregations hold ints instead of string copies.
+# A dictionary is persisted as a json list; the id of a string is its list index.
+# Tuples of strings (e.g. gene id lists) are stored as json lists and read back as tuples.
+# Ids are stable: an existing dictionary file is extended, never renumbered.
+# Only dictionaries that outputs refer to by id are persisted (association_count.npz);
+# stages that write strings keep theirs in memory for one run.
+
+
+def new_string_dictionary(id_to_string=None):
+    if id_to_string is None:
+        id_to_string = []
+    string_to_id = {string: _id for _id, string in enumerate(id_to_string)}
+    dictionary = {
+        "string_to_id": string_to_id,
+        "id_to_string": id_to_string,
+    }
+    return dictionary
+
+
+def get_string_id(dictionary, string):
+    string_to_id = dictionary["string_to_id"]
+    _id = string_to_id.get(string)
+    if _id is None:
+        _id = len(string_to_id)
+        string_to_id[string] = _id
+        dictionary["id_to_string"].append(string)
+    return _id
+
+
+def read_string_dictionary(file):
+    if not os.path.exists(file):
+        return new_string_dictionary()
+    id_to_string = read_json(file, write_log=False)
+    id_to_string = [
+        tuple(string) if isinstance(string, list) else string
+        for string in id_to_string
+    ]
+    return new_string_dictionary(id_to_string)
+
+
+def read_string_dictionary_dir(dictionary_dir, name_list):
+    name_to_dictionary = {
+        name: read_string_dictionary(os.path.join(dictionary_dir, f"{name}.json"))
+        for name in name_list
+    }
+    return name_to_dictionary
+
+
+def write_string_dictionary_dir(dictionary_dir, name_to_dictionary):
+    os.makedirs(dictionary_dir, exist_ok=True)
+    for name, dictionary in name_to_dictionary.items():
+        dictionary_file = os.path.join(dictionary_dir, f"{name}.json")
+        write_json(dictionary_file, dictionary["id_to_string"], write_log=False)
+        strings = len(dictionary["id_to_string"])
+        logger.info(f"{strings:,} {name} strings written to {dictionary_file}")
+    return
+
+
+"""
+manifest
+"""
+# manifest format:
+# {
+#     stage: {
+#         batch_key: {
+#             "input": {input_name: sha1 of file content},
+#             "version": sha1 of the code (and options) that produce the output,
+#             "output": {output_name: sha1 of file content},
+#             ...stage-specific fields
+#         }
+#     }
+# }
+# A batch is skipped when its inputs and version are unchanged and its outputs are intact.
+
+
+def get_file_hash(file):
+    sha = hashlib.sha1()
+    with open(file, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 24), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def get_code_global_name_set(code):
+    # global names used by a function, including its nested functions, lambdas and comprehensions
+    name_set = set(code.co_names)
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            name_set |= get_code_global_name_set(const)
+    return name_set
+
+
+def get_code_version(function_list, option=""):
+    # Hashes the given stage functions and everything of this module they use, transitively:
+    # module-level functions (called or passed around by name) and constants (headers, patterns, tables),
+    # so editing any function on a stage's code path invalidates the stage's manifest records.
+    name_to_function = {}
+    name_to_constant = {}
+    function_stack = list(function_list)
+
+    while function_stack:
+        function = function_stack.pop()
+        if function.__name__ in name_to_function:
+            continue
+        name_to_function[function.__name__] = function
+        for name in get_code_global_name_set(function.__code__):
+            value = function.__globals__.get(name)
+            if inspect.isfunction(value) and value.__module__ == function.__module__:
+                function_stack.append(value)
+            elif isinstance(value, re.Pattern):
+                name_to_constant[name] = value.pattern
+            elif isinstance(value, (str, int, float, list, tuple, dict)):
+                name_to_constant[name] = repr(value)
+
+    sha = hashlib.sha1()
+    for name in sorted(name_to_function):
+        sha.update(inspect.getsource(name_to_function[name]).encode("utf8"))
+    for name in sorted(name_to_constant):
+        sha.update(f"{name}={name_to_constant[name]}".encode("utf8"))
+    sha.update(option.encode("utf8"))
+    return sha.hexdigest()
+
+
+def read_manifest(manifest_file):
+    if manifest_file is None or not os.path.exists(manifest_file):
+        return {}
+    return read_json(manifest_file, write_log=False)
+
+
+def write_manifest(manifest_file, manifest):
+    # write then rename, so an interrupted run never leaves a broken manifest
+    if manifest_file is None:
+        return
+    tmp_file = f"{manifest_file}.tmp"
+    write_json(tmp_file, manifest, indent=2, write_log=False)
+    os.replace(tmp_file, manifest_file)
+    return
+
+
+def is_output_intact(record, name_to_output_file):
+    name_to_output_hash = record.get("output", {})
+    for name, output_file in name_to_output_file.items():
+        if name not in name_to_output_hash or not os.path.exists(output_file):
+            return False
+        if get_file_hash(output_file) != name_to_output_hash[name]:
+            return False
+    return True
+
+
+def is_record_up_to_date(record, name_to_input_hash, version, name_to_output_file):
+    if record is None:
+        return False
+    if record["version"] != version or record["input"] != name_to_input_hash:
+        return False
+    return is_output_intact(record, name_to_output_file)
+
+
+def get_manifest_record(name_to_input_hash, version, name_to_output_file, **kwargs):
+    record = {
+        "input": name_to_input_hash,
+        "version": version,
+        "output": {
+            name: get_file_hash(output_file)
+            for name, output_file in name_to_output_file.items()
+        },
+    }
+    record.update(kwargs)
+    return record
+
+
+def run_aggregate_stage(manifest_file, stage, version, input_file_list, name_to_output_file, function, *arg):
+    # For stages that read many batches and write a few combined files:
+    # the whole stage is one manifest record, re-run only if any input batch changed
+    manifest = read_manifest(manifest_file)
+    name_to_input_hash = {
+        os.path.basename(os.path.dirname(input_file)) + "/" + os.path.basename(input_file): get_file_hash(input_file)
+        for input_file in input_file_list
+    }
+    record = manifest.get(stage, {}).get("all")
+
+    if manifest_file is not None and is_record_up_to_date(record, name_to_input_hash, version, name_to_output_file):
+        logger.info(f"[{stage}] inputs unchanged; skipped")
+        return
+
+    function(*arg)
+
+    if manifest_file is not None:
+        record = get_manifest_record(name_to_input_hash, version, name_to_output_file)
+        manifest = read_manifest(manifest_file)
+        manifest.setdefault(stage, {})["all"] = record
+        write_manifest(manifest_file, manifest)
+    return
+
+
 """
 NER
 """
 
 
+def get_ner_batch_file(batch_dir):
+    # target.jsonl / target.msgpack of plant_ner/tool/main.py --output_format, or target.json
+    return find_record_file(batch_dir) or get_record_file(batch_dir, "json")
+
+
 def collect_ner_data(sentence_ner_dir, ner_file, start, end):
     data = []
     type_to_count = defaultdict(lambda: 0)
@@ -117,9 +365,8 @@ def collect_ner_data(sentence_ner_dir, ner_file, start, end):
     ner_sentences = 0
 
     for bi in range(start, end + 1):
-        batch_file = os.path.join(sentence_ner_dir, f"batch_{bi}", "target.json")
-        batch_data = read_json(batch_file, write_log=False)
-        for datum in batch_data:
+        # jsonl and msgpack batches are streamed
+        for datum in iterate_record_file(get_ner_batch_file(os.path.join(sentence_ner_dir, f"batch_{bi}"))):
             sentences += 1
 
             mention_list = datum["mention_list"]
@@ -168,6 +415,94 @@ def split_batch(single_file, batch_dir, batch_size):
     return
 
 
+def get_sentence_key(sentence):
+    # same key as plant_ner/tool/plant_utils.py::get_sentence_key()
+    return hashlib.sha1(sentence.encode("utf8")).digest()[:16]
+
+
+def fan_out_sentence_data(unique_dir, unique_start, unique_end, occurrence_dir, target_dir, batch_size):
+    # unique_dir holds results for the deduplicated sentences of plant_utils.py::dedup_sentence_data();
+    # write them to target_dir once for every (pmid, sent_id) that has the same sentence text,
+    # in the original sentence order and with split_batch() boundaries,
+    # i.e. the same batches as if every stage had run on the full corpus.
+    # Results are staged in sqlite so memory does not grow with the corpus.
+    os.makedirs(target_dir, exist_ok=True)
+    db_file = os.path.join(target_dir, "fan_out.sqlite")
+    if os.path.exists(db_file):
+        os.remove(db_file)
+    conn = sqlite3.connect(db_file)
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute("CREATE TABLE result (key BLOB PRIMARY KEY, datum TEXT) WITHOUT ROWID")
+
+    unique_results = 0
+    for bi in range(unique_start, unique_end + 1):
+        unique_file = os.path.join(unique_dir, f"batch_{bi}.json")
+        data = read_json(unique_file, write_log=False)
+        conn.executemany(
+            "INSERT INTO result VALUES (?, ?)",
+            ((get_sentence_key(datum["sentence"]), json.dumps(datum)) for datum in data),
+        )
+        conn.commit()
+        unique_results += len(data)
+    logger.info(f"Staged {unique_results:,} unique sentence results")
+
+    report = read_json(os.path.join(occurrence_dir, "..", "dedup_report.json"), write_log=False)
+    occurrence_start, occurrence_end = report["source_batches"]
+
+    sentences = 0
+    results = 0
+    pmid_set = set()
+    batch = []
+    tbi = 1
+
+    for obi in range(occurrence_start, occurrence_end + 1):
+        occurrence_file = os.path.join(occurrence_dir, f"batch_{obi}.json")
+        occurrence_list = read_json(occurrence_file, write_log=False)
+        sentences += len(occurrence_list)
+
+        key_to_datum = {}
+        key_list = list({bytes.fromhex(key) for _pmid, _sent_id, key in occurrence_list})
+        for i in range(0, len(key_list), 500):
+            chunk = key_list[i:i + 500]
+            query = f"SELECT key, datum FROM result WHERE key IN ({', '.join('?' * len(chunk))})"
+            for key, datum in conn.execute(query, chunk):
+                key_to_datum[key.hex()] = datum
+
+        for pmid, sent_id, key in occurrence_list:
+            datum = key_to_datum.get(key)
+            if datum is None:
+                continue
+            datum = json.loads(datum)
+            datum["pmid"] = pmid
+            datum["sent_id"] = sent_id
+
+            if pmid not in pmid_set and len(batch) >= batch_size:
+                target_file = os.path.join(target_dir, f"batch_{tbi}.json")
+                write_json(target_file, batch, write_log=False)
+                pmid_set = set()
+                batch = []
+                tbi += 1
+
+            pmid_set.add(pmid)
+            batch.append(datum)
+            results += 1
+
+        logger.info(
+            f"occurrence batch {obi}/[{occurrence_start},{occurrence_end}] cumulated:"
+            f" {results:,}/{sentences:,} sentences with results;"
+            f" {results:,} results fanned out from {unique_results:,}"
+        )
+
+    target_file = os.path.join(target_dir, f"batch_{tbi}.json")
+    write_json(target_file, batch, write_log=False)
+    logger.info(f"Wrote batch 1-{tbi} to {target_dir}")
+
+    conn.close()
+    os.remove(db_file)
+    return
+
+
 """
 GeneID
 """
@@ -195,18 +530,17 @@ def tag_gene_id_by_sentence(sentence, length_name_type_id):
     return mention_list
 
 
-def tag_gene_id_for_directory(gene_id_dir, source_dir, target_dir, start, end):
-    gene_id_type_list = [
-        "Arabidopsis thaliana",
-        "Populus trichocarpa",
-    ]
+def get_gene_id_file(gene_id_dir, _type):
+    escape_type = _type.replace(" ", "_")
+    gene_id_file = os.path.join(gene_id_dir, f"{escape_type}.csv")
+    return gene_id_file
 
-    # Read gene ids and aliases
+
+def read_gene_id_dictionary(gene_id_dir, gene_id_type_list):
     length_name_type_id = {}
 
     for _type in gene_id_type_list:
-        escape_type = _type.replace(" ", "_")
-        gene_id_file = os.path.join(gene_id_dir, f"{escape_type}.csv")
+        gene_id_file = get_gene_id_file(gene_id_dir, _type)
         gene_id_data = read_csv(gene_id_file, "csv")
         ids = 0
         names = 0
@@ -232,22 +566,581 @@ def tag_gene_id_for_directory(gene_id_dir, source_dir, target_dir, start, end):
         lengths = len(length_name_type_id.keys())
         logger.info(f"{ids:,} ids; {names:,} names; {lengths:,} lengths")
 
+    return length_name_type_id
+
+
+def merge_gene_id_mention_list(mention_list, new_mention_list, length_to_rank, type_to_rank):
+    # tag_gene_id_by_sentence() outputs mentions ordered by (length in dictionary order, position, type order);
+    # sorting by the same key makes a partial re-tag identical to a full re-tag
+    mention_list = mention_list + new_mention_list
+    mention_list = sorted(
+        mention_list,
+        key=lambda mention: (
+            length_to_rank[len(mention["name"])],
+            mention["real_pos"][0],
+            type_to_rank[mention["type"]],
+        ),
+    )
+    return mention_list
+
+
+def get_gene_id_type_list(gene_id_dir):
+    # every {Genus}_{species}.csv in gene_id_dir is the alias table of one species
+    gene_id_type_list = sorted(
+        file[:-len(".csv")].replace("_", " ")
+        for file in os.listdir(gene_id_dir)
+        if file.endswith(".csv")
+    )
+    return gene_id_type_list
+
+
+def build_trie(name_list, payload_list):
+    # Compact trie over sorted unique names, stored as flat arrays:
+    #   node_edge_start[node]...node_edge_start[node + 1] is the range of the node's edges
+    #   edge_char/edge_child hold the (code point, child node) of each edge, sorted by code point
+    #   node_payload[node] is the payload id of the name ending at the node, or -1
+    # Nodes are numbered breadth-first, so the edges of a node are contiguous.
+    edge_char = array("I")
+    edge_child = array("i")
+    node_edge_start = array("i")
+    node_payload = array("i", [-1])
+    queue = deque([(0, 0, len(name_list), 0)])  # node, names[lo:hi] share the node's prefix, depth
+
+    while queue:
+        node, lo, hi, depth = queue.popleft()
+        node_edge_start.append(len(edge_char))
+
+        # sorted order puts the name equal to the prefix first
+        if lo < hi and len(name_list[lo]) == depth:
+            node_payload[node] = payload_list[lo]
+            lo += 1
+
+        while lo < hi:
+            char = name_list[lo][depth]
+            mid = lo + 1
+            while mid < hi and name_list[mid][depth] == char:
+                mid += 1
+            child = len(node_payload)
+            node_payload.append(-1)
+            edge_char.append(ord(char))
+            edge_child.append(child)
+            queue.append((child, lo, mid, depth + 1))
+            lo = mid
+
+    node_edge_start.append(len(edge_char))
+    trie = {
+        "edge_char": edge_char,
+        "edge_child": edge_child,
+        "node_edge_start": node_edge_start,
+        "node_payload": node_payload,
+    }
+    return trie
+
+
+def get_trie_child(trie, node, char):
+    edge_char = trie["edge_char"]
+    lo = trie["node_edge_start"][node]
+    hi = trie["node_edge_start"][node + 1]
+    ei = bisect_left(edge_char, char, lo, hi)
+    if ei < hi and edge_char[ei] == char:
+        return trie["edge_child"][ei]
+    return -1
+
+
+def lookup_trie(trie, name):
+    node = 0
+    for char in name:
+        node = get_trie_child(trie, node, ord(char))
+        if node == -1:
+            return -1
+    return trie["node_payload"][node]
+
+
+def read_gene_id_trie(gene_id_dir, gene_id_type_list):
+    # All species' aliases go into one trie; memory grows with unique alias strings.
+    # A terminal payload is an interned tuple of (species index, interned gene id list) references.
+    idlist_dictionary = new_string_dictionary()
+    payload_dictionary = new_string_dictionary()
+    name_to_typeindex_to_idset = {}
+    length_list = {}  # dict as an ordered set; same length order as read_gene_id_dictionary()
+
+    for ti, _type in enumerate(gene_id_type_list):
+        gene_id_file = get_gene_id_file(gene_id_dir, _type)
+        gene_id_data = read_csv(gene_id_file, "csv")
+        ids = 0
+        names = 0
+
+        for row in gene_id_data:
+            name_list = []
+            for name in row:
+                name = name.strip().lower()
+                if name:
+                    name_list.append(name)
+            if not name_list:
+                continue
+            ids += 1
+            _id = name_list[0]
+
+            for name in name_list:
+                names += 1
+                length_list[len(name)] = None
+                typeindex_to_idset = name_to_typeindex_to_idset.setdefault(name, {})
+                typeindex_to_idset.setdefault(ti, set()).add(_id)
+
+        logger.info(f"{_type}: {ids:,} ids; {names:,} names")
+
+    name_list = sorted(name_to_typeindex_to_idset)
+    payload_list = []
+    for name in name_list:
+        typeindex_to_idset = name_to_typeindex_to_idset[name]
+        payload = tuple(
+            (ti, get_string_id(idlist_dictionary, tuple(sorted(typeindex_to_idset[ti]))))
+            for ti in sorted(typeindex_to_idset)
+        )
+        payload_list.append(get_string_id(payload_dictionary, payload))
+    del name_to_typeindex_to_idset
+
+    trie = build_trie(name_list, payload_list)
+    trie["type_list"] = gene_id_type_list
+    trie["idlist_list"] = idlist_dictionary["id_to_string"]
+    trie["payload_list"] = payload_dictionary["id_to_string"]
+    trie["length_list"] = list(length_list)
+
+    nodes = len(trie["node_payload"])
+    edges = len(trie["edge_char"])
+    kilobytes = sum(
+        trie[key].itemsize * len(trie[key]) for key in ["edge_char", "edge_child", "node_edge_start", "node_payload"]
+    ) // 1024
+    logger.info(
+        f"trie: {len(name_list):,} unique names; {nodes:,} nodes; {edges:,} edges; {kilobytes:,} KB;"
+        f" {len(trie['payload_list']):,} unique payloads; {len(trie['idlist_list']):,} unique id lists"
+    )
+    return trie
+
+
+def get_trie_mention_list(trie, sentence, ci, cj, payload_id):
+    mention_list = []
+    name = sentence[ci:cj]
+    for ti, idlist_id in trie["payload_list"][payload_id]:
+        mention = {
+            "name": name,
+            "real_pos": (ci, cj),
+            "type": trie["type_list"][ti],
+            "id": list(trie["idlist_list"][idlist_id]),
+        }
+        mention_list.append(mention)
+    return mention_list
+
+
+def tag_gene_id_by_sentence_trie(sentence, trie):
+    # Same output as tag_gene_id_by_sentence(), including mention order
+    mention_list = []
+
+    # non-ASCII text may change length or context (final sigma) when lowercased,
+    # so look up each lowercased substring exactly as tag_gene_id_by_sentence() does;
+    # that searches only aliases of the substring's length, so a substring whose lowercase is longer
+    # (e.g. "İ" -> "i̇") must not match an alias of the lowercased length
+    if len(sentence) != len(sentence.encode("utf8")):
+        for length in trie["length_list"]:
+            for ci in range(len(sentence) - length + 1):
+                lower_name = sentence[ci:ci + length].lower()
+                if len(lower_name) != length:
+                    continue
+                payload_id = lookup_trie(trie, lower_name)
+                if payload_id != -1:
+                    mention_list.extend(get_trie_mention_list(trie, sentence, ci, ci + length, payload_id))
+        return mention_list
+
+    # ASCII text: walk the trie once from every position
+    lower_sentence = sentence.lower()
+    node_payload = trie["node_payload"]
+    length_to_rank = {length: rank for rank, length in enumerate(trie["length_list"])}
+    rank_ci_mentionlist = []
+
+    for ci in range(len(sentence)):
+        node = 0
+        for cj in range(ci, len(sentence)):
+            node = get_trie_child(trie, node, ord(lower_sentence[cj]))
+            if node == -1:
+                break
+            payload_id = node_payload[node]
+            if payload_id != -1:
+                rank = length_to_rank[cj + 1 - ci]
+                rank_ci_mentionlist.append((rank, ci, get_trie_mention_list(trie, sentence, ci, cj + 1, payload_id)))
+
+    rank_ci_mentionlist = sorted(rank_ci_mentionlist, key=lambda x: (x[0], x[1]))
+    for _rank, _ci, trie_mention_list in rank_ci_mentionlist:
+        mention_list.extend(trie_mention_list)
+    return mention_list
+
+
+def read_gene_id_tagger(gene_id_dir, gene_id_type_list, engine):
+    # returns (tagging function, its dictionary, alias lengths in dictionary order)
+    if engine == "trie":
+        trie = read_gene_id_trie(gene_id_dir, gene_id_type_list)
+        return tag_gene_id_by_sentence_trie, trie, trie["length_list"]
+    length_name_type_id = read_gene_id_dictionary(gene_id_dir, gene_id_type_list)
+    return tag_gene_id_by_sentence, length_name_type_id, list(length_name_type_id)
+
+
+"""
+approximate GeneID matching
+"""
+# Formatting variants (AtMYB-2, MYB 2, α-/alpha-) are matched with:
+#   1. normalization: Greek letters spelled out, lowercased, non-alphanumerics removed
+#   2. species prefix: "AtMYB2" is also looked up as "MYB2" within Arabidopsis thaliana (At, Pt, ...),
+#      or within every species sharing the prefix (Oryza sativa and Olea sativa are both Os)
+#   3. SymSpell-style deletion neighbourhood: every normalized alias of at least min_length characters
+#      is indexed under all its variants with up to max_distance deleted characters,
+#      so an edit-distance lookup is a few dict lookups instead of a scan over all aliases
+# Fuzzy candidates must keep the same digits, so MYB2 never matches MYB3,
+# and an n-gram matching aliases with different payloads at the same distance is ambiguous and skipped.
+GREEK_ALPHABETS_TRANS = str.maketrans({k: v.lower() for k, v in GREEK_ALPHABETS.items()})
+non_alphanumeric_pattern = re.compile(r"[\W_]+")
+digit_pattern = re.compile(r"\d+")
+gene_token_pattern = re.compile(r"[^\s()\[\]{},;:'\"]+")
+
+
+def normalize_gene_name(name):
+    name = name.translate(GREEK_ALPHABETS_TRANS).lower()
+    name = non_alphanumeric_pattern.sub("", name)
+    return name
+
+
+def get_species_prefix(_type):
+    # Arabidopsis thaliana -> At; None for a type name without a species word, e.g. Arabidopsis
+    word_list = _type.split()
+    if len(word_list) < 2:
+        return None
+    genus, species = word_list[:2]
+    return genus[0].upper() + species[0].lower()
+
+
+def get_prefix_to_typeindex_list(gene_id_type_list):
+    prefix_to_typeindex_list = defaultdict(lambda: [])
+    for ti, _type in enumerate(gene_id_type_list):
+        prefix = get_species_prefix(_type)
+        if prefix is not None:
+            prefix_to_typeindex_list[prefix].append(ti)
+
+    for prefix, typeindex_list in prefix_to_typeindex_list.items():
+        if len(typeindex_list) > 1:
+            type_list = [gene_id_type_list[ti] for ti in typeindex_list]
+            logger.info(f"species prefix {prefix} is shared by {type_list}")
+    return {prefix: tuple(typeindex_list) for prefix, typeindex_list in prefix_to_typeindex_list.items()}
+
+
+def get_deletion_variant_set(name, max_distance):
+    variant_set = {name}
+    frontier_set = {name}
+    for _ in range(max_distance):
+        frontier_set = {
+            variant[:i] + variant[i + 1:]
+            for variant in frontier_set
+            for i in range(len(variant))
+        }
+        variant_set |= frontier_set
+    return variant_set
+
+
+def get_edit_distance(a, b, max_distance):
+    # optimal string alignment distance, or max_distance + 1 if larger than max_distance
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous_previous_row = None
+    previous_row = list(range(len(b) + 1))
+
+    for i in range(1, len(a) + 1):
+        row = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            row[j] = min(previous_row[j] + 1, row[j - 1] + 1, previous_row[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                row[j] = min(row[j], previous_previous_row[j - 2] + 1)
+        if min(row) > max_distance:
+            return max_distance + 1
+        previous_previous_row, previous_row = previous_row, row
+
+    return previous_row[-1]
+
+
+def read_gene_id_approximate_index(gene_id_dir, gene_id_type_list, max_distance=1, min_length=5):
+    idlist_dictionary = new_string_dictionary()
+    payload_dictionary = new_string_dictionary()
+    normalized_to_typeindex_to_idset = {}
+
+    for ti, _type in enumerate(gene_id_type_list):
+        gene_id_file = get_gene_id_file(gene_id_dir, _type)
+        gene_id_data = read_csv(gene_id_file, "csv")
+
+        for row in gene_id_data:
+            name_list = [name.strip() for name in row if name.strip()]
+            if not name_list:
+                continue
+            _id = name_list[0].lower()
+
+            for name in name_list:
+                normalized_name = normalize_gene_name(name)
+                if not normalized_name:
+                    continue
+                typeindex_to_idset = normalized_to_typeindex_to_idset.setdefault(normalized_name, {})
+                typeindex_to_idset.setdefault(ti, set()).add(_id)
+
+    normalized_list = sorted(normalized_to_typeindex_to_idset)
+    normalized_to_payload = {}
+    variant_to_aliasindex = {}
+
+    for ai, normalized_name in enumerate(normalized_list):
+        typeindex_to_idset = normalized_to_typeindex_to_idset[normalized_name]
+        payload = tuple(
+            (ti, get_string_id(idlist_dictionary, tuple(sorted(typeindex_to_idset[ti]))))
+            for ti in sorted(typeindex_to_idset)
+        )
+        normalized_to_payload[normalized_name] = get_string_id(payload_dictionary, payload)
+
+        if len(normalized_name) < min_length:
+            continue
+        for variant in get_deletion_variant_set(normalized_name, max_distance):
+            aliasindex = variant_to_aliasindex.get(variant)
+            if aliasindex is None:
+                variant_to_aliasindex[variant] = ai
+            elif isinstance(aliasindex, int):
+                variant_to_aliasindex[variant] = [aliasindex, ai]
+            else:
+                aliasindex.append(ai)
+    del normalized_to_typeindex_to_idset
+
+    index = {
+        "type_list": gene_id_type_list,
+        "prefix_to_typeindex_list": get_prefix_to_typeindex_list(gene_id_type_list),
+        "idlist_list": idlist_dictionary["id_to_string"],
+        "payload_list": payload_dictionary["id_to_string"],
+        "normalized_list": normalized_list,
+        "normalized_to_payload": normalized_to_payload,
+        "variant_to_aliasindex": variant_to_aliasindex,
+        "max_distance": max_distance,
+        "min_length": min_length,
+        # the longest n-gram worth looking up: an alias with max_distance insertions and a species prefix
+        "max_normalized_length": max((len(name) for name in normalized_list), default=0) + max_distance + 2,
+    }
+    logger.info(
+        f"approximate index: {len(normalized_list):,} normalized names;"
+        f" {len(variant_to_aliasindex):,} deletion variants;"
+        f" max_distance={max_distance}; min_length={min_length}"
+    )
+    return index
+
+
+def lookup_approximate_gene_name(index, normalized_name):
+    # returns (payload id, distance), or None if no match or ambiguous
+    payload_id = index["normalized_to_payload"].get(normalized_name)
+    if payload_id is not None:
+        return payload_id, 0
+
+    max_distance = index["max_distance"]
+    if len(normalized_name) < index["min_length"] or max_distance == 0:
+        return None
+
+    normalized_list = index["normalized_list"]
+    variant_to_aliasindex = index["variant_to_aliasindex"]
+    digit_list = digit_pattern.findall(normalized_name)
+    best_distance = max_distance + 1
+    best_payload_set = set()
+    aliasindex_set = set()
+
+    for variant in get_deletion_variant_set(normalized_name, max_distance):
+        aliasindex = variant_to_aliasindex.get(variant)
+        if aliasindex is None:
+            continue
+        if isinstance(aliasindex, int):
+            aliasindex_set.add(aliasindex)
+        else:
+            aliasindex_set.update(aliasindex)
+
+    for ai in aliasindex_set:
+        alias = normalized_list[ai]
+        if digit_pattern.findall(alias) != digit_list:
+            continue
+        distance = get_edit_distance(normalized_name, alias, max_distance)
+        if distance < best_distance:
+            best_distance = distance
+            best_payload_set = {index["normalized_to_payload"][alias]}
+        elif distance == best_distance:
+            best_payload_set.add(index["normalized_to_payload"][alias])
+
+    if len(best_payload_set) != 1:
+        return None
+    return best_payload_set.pop(), best_distance
+
+
+def tag_gene_id_by_sentence_approximate(sentence, index, exact_mention_list, max_ngram=3):
+    # Approximate mentions for candidate token n-grams not overlapping any exact mention.
+    # Overlapping approximate candidates are resolved by (distance, longer span, earlier span).
+    covered = bytearray(len(sentence))
+    for mention in exact_mention_list:
+        ci, cj = mention["real_pos"]
+        covered[ci:cj] = b"\x01" * (cj - ci)
+
+    span_list = []
+    for match in gene_token_pattern.finditer(sentence):
+        ci, cj = match.span()
+        while cj > ci and sentence[cj - 1] == ".":
+            cj -= 1
+        if cj > ci:
+            span_list.append((ci, cj))
+
+    candidate_list = []
+    max_normalized_length = index["max_normalized_length"]
+    prefix_to_typeindex_list = index["prefix_to_typeindex_list"]
+
+    for si in range(len(span_list)):
+        normalized_name = ""
+        for sj in range(si, min(si + max_ngram, len(span_list))):
+            ci, cj = span_list[si][0], span_list[sj][1]
+            normalized_name += normalize_gene_name(sentence[span_list[sj][0]:span_list[sj][1]])
+            if len(normalized_name) > max_normalized_length:
+                break
+            if not normalized_name or any(covered[ci:cj]):
+                continue
+
+            # whole n-gram, for all species
+            result = lookup_approximate_gene_name(index, normalized_name)
+            if result is not None:
+                payload_id, distance = result
+                candidate_list.append((distance, -(cj - ci), ci, cj, payload_id, None))
+                continue
+
+            # species prefix removed, for the species with that prefix only
+            typeindex_list = prefix_to_typeindex_list.get(sentence[ci:ci + 2])
+            if typeindex_list is not None and sentence[ci + 2:ci + 3].isupper():
+                result = lookup_approximate_gene_name(index, normalize_gene_name(sentence[ci + 2:cj]))
+                if result is not None:
+                    payload_id, distance = result
+                    candidate_list.append((distance, -(cj - ci), ci, cj, payload_id, typeindex_list))
+
+    mention_list = []
+    for distance, _length, ci, cj, payload_id, typeindex_list in sorted(candidate_list):
+        if any(covered[ci:cj]):
+            continue
+        for ti, idlist_id in index["payload_list"][payload_id]:
+            if typeindex_list is not None and ti not in typeindex_list:
+                continue
+            mention_list.append({
+                "name": sentence[ci:cj],
+                "real_pos": (ci, cj),
+                "type": index["type_list"][ti],
+                "id": list(index["idlist_list"][idlist_id]),
+                "match": "approximate",
+                "distance": distance,
+            })
+            covered[ci:cj] = b"\x01" * (cj - ci)
+
+    mention_list = sorted(mention_list, key=lambda mention: mention["real_pos"])
+    return mention_list
+
+
+def tag_gene_id_for_directory(
+        gene_id_dir, source_dir, target_dir, start, end, manifest_file=None, engine="trie",
+        approximate=False, max_distance=1, min_length=5,
+):
+    gene_id_type_list = get_gene_id_type_list(gene_id_dir)
+    logger.info(f"{len(gene_id_type_list):,} species: {gene_id_type_list}")
+
+    # Read gene ids and aliases
+    tag_function, gene_id_dictionary, length_list = read_gene_id_tagger(gene_id_dir, gene_id_type_list, engine)
+    approximate_index = None
+    if approximate:
+        approximate_index = read_gene_id_approximate_index(gene_id_dir, gene_id_type_list, max_distance, min_length)
+
+    # With a manifest, unchanged batches are skipped,
+    # and batches whose only changed inputs are some species' dictionaries re-tag only those species
+    stage = "tag_gene_id"
+    manifest = read_manifest(manifest_file)
+    stage_manifest = manifest.setdefault(stage, {})
+    version = get_code_version(
+        [tag_gene_id_for_directory], option=f"approximate={approximate},{max_distance},{min_length}",
+    )
+    type_to_hash = {}
+    if manifest_file is not None:
+        type_to_hash = {
+            _type: get_file_hash(get_gene_id_file(gene_id_dir, _type))
+            for _type in gene_id_type_list
+        }
+    length_to_rank = {length: rank for rank, length in enumerate(length_list)}
+    type_to_rank = {_type: rank for rank, _type in enumerate(gene_id_type_list)}
+    changedtypes_to_dictionary = {}
+
     # Add exact match tags to data
     sentences = 0
     id_set = set()
     mentions = 0
+    approximate_mentions = 0
     si = 0
 
     for bi in range(start, end + 1):
         source_file = os.path.join(source_dir, f"batch_{bi}.json")
         target_file = os.path.join(target_dir, f"batch_{bi}.json")
 
-        data = read_json(source_file)
+        changed_type_list = gene_id_type_list
+        if manifest_file is not None:
+            name_to_input_hash = {"source": get_file_hash(source_file)}
+            for _type, _hash in type_to_hash.items():
+                name_to_input_hash[f"dictionary/{_type}"] = _hash
+            name_to_output_file = {"target": target_file}
+            record = stage_manifest.get(f"batch_{bi}")
+
+            if is_record_up_to_date(record, name_to_input_hash, version, name_to_output_file):
+                logger.info(f"batch {bi}: inputs unchanged; skipped")
+                continue
+
+            if (
+                record is not None
+                and record["version"] == version
+                and record["input"].keys() == name_to_input_hash.keys()
+                and record["input"]["source"] == name_to_input_hash["source"]
+                and is_output_intact(record, name_to_output_file)
+            ):
+                changed_type_list = [
+                    _type
+                    for _type in gene_id_type_list
+                    if record["input"][f"dictionary/{_type}"] != type_to_hash[_type]
+                ]
+                # approximate mentions depend on the exact mentions of all species
+                if approximate:
+                    changed_type_list = gene_id_type_list
+
+        if changed_type_list == gene_id_type_list:
+            data = read_json(source_file)
+            type_gene_id_dictionary = gene_id_dictionary
+        else:
+            logger.info(f"batch {bi}: re-tagging {changed_type_list}")
+            data = read_json(target_file)
+            changed_types = tuple(changed_type_list)
+            if changed_types not in changedtypes_to_dictionary:
+                changedtypes_to_dictionary[changed_types] = read_gene_id_tagger(
+                    gene_id_dir, changed_type_list, engine,
+                )[1]
+            type_gene_id_dictionary = changedtypes_to_dictionary[changed_types]
         sentences += len(data)
 
         for di, datum in enumerate(data):
             sentence = datum["sentence"]
-            mention_list = tag_gene_id_by_sentence(sentence, length_name_type_id)
+            mention_list = tag_function(sentence, type_gene_id_dictionary)
+            if changed_type_list != gene_id_type_list:
+                kept_mention_list = [
+                    mention
+                    for mention in datum["gene_id_mention_list"]
+                    if mention["type"] not in changed_type_list
+                ]
+                mention_list = merge_gene_id_mention_list(
+                    kept_mention_list, mention_list, length_to_rank, type_to_rank,
+                )
+            if approximate:
+                approximate_mention_list = tag_gene_id_by_sentence_approximate(
+                    sentence, approximate_index, mention_list,
+                )
+                approximate_mentions += len(approximate_mention_list)
+                mention_list = mention_list + approximate_mention_list
             for mention in mention_list:
                 for _id in mention["id"]:
                     id_set.add(_id)
@@ -263,9 +1156,14 @@ def tag_gene_id_for_directory(gene_id_dir, source_dir, target_dir, start, end):
                     f" sentence {si:,}/{sentences:,}:"
                     f" {ids:,} unique ids;"
                     f" {mentions:,} mentions"
+                    f" ({approximate_mentions:,} approximate)"
                 )
 
         write_json(target_file, data)
+
+        if manifest_file is not None:
+            stage_manifest[f"batch_{bi}"] = get_manifest_record(name_to_input_hash, version, name_to_output_file)
+            write_manifest(manifest_file, manifest)
     return
 
 
@@ -274,121 +1172,355 @@ misc
 """
 
 
-def extract_result(source_dir, target_dir, start, end):
-    os.makedirs(target_dir, exist_ok=True)
+result_name_list = [
+    "ner",
+    "geneid_commonname",
+    "geneid_location_compound_process",
+    "spacy_triplet",
+]
+
+
+def get_result_string_and_name_list(datum, json_backend="json"):
+    pmid = datum["pmid"]
+    sentence = datum["sentence"]
+    mention_list = datum["mention_list"]
+    gene_id_mention_list = datum["gene_id_mention_list"]
+    triplet_list = datum["triplet_list"]
+
+    # clean datum
+    mention_list = [
+        {
+            "name": mention["name"],
+            "type": mention["type"],
+        }
+        for mention in mention_list
+    ]
+    gene_id_mention_list = [
+        {
+            "name": mention["name"],
+            "type": mention["type"],
+            "id": mention["id"],
+        }
+        for mention in gene_id_mention_list
+    ]
+    triplet_list = [
+        {
+            "head_ner_mention_index": triplet["h_mention"],
+            "tail_ner_mention_index": triplet["t_mention"],
+            "triplet": triplet["triplet"],
+        }
+        for triplet in triplet_list
+    ]
+    datum_string = dump_json_string({
+        "pmid": pmid,
+        "sentence": sentence,
+        "ner_mention_list": mention_list,
+        "gene_id_mention_list": gene_id_mention_list,
+        "triplet_list": triplet_list,
+    }, json_backend=json_backend) + "\n"
+
+    # ner data
+    name_list = ["ner"]
+
+    # geneid to commonname data
+    geneidtuple_set = {
+        tuple(mention["id"])
+        for mention in gene_id_mention_list
+    }
+    commonname_set = {
+        mention["name"]
+        for mention in mention_list
+        if mention["type"] == "CommonName"
+    }
+    geneidtuples = len(geneidtuple_set)
+    commonnames = len(commonname_set)
+    if 1 <= geneidtuples <= 2 and 1 <= commonnames <= 2:
+        name_list.append("geneid_commonname")
+
+    # geneid to location/compound/process data
+    if 1 <= geneidtuples <= 2:
+        for mention in mention_list:
+            if mention["type"] in ["Location", "Compound", "Process"]:
+                name_list.append("geneid_location_compound_process")
+                break
+
+    # spacy_ore data
+    if triplet_list:
+        name_list.append("spacy_triplet")
+
+    return datum_string, name_list
+
+
+def extract_result_batch(source_file, name_to_f, json_backend="json"):
+    data = read_json(source_file, write_log=False, json_backend=json_backend)
+    name_to_count = {name: 0 for name in result_name_list}
+
+    for datum in data:
+        datum_string, name_list = get_result_string_and_name_list(datum, json_backend=json_backend)
+        for name in name_list:
+            name_to_f[name].write(datum_string)
+            name_to_count[name] += 1
+
+    return name_to_count
+
+
+def log_result_count(start, bi, name_to_count):
+    logger.info(
+        f"batch {start}-{bi} cumulates:"
+        f" {name_to_count['geneid_commonname']:,} GeneID-CommonName sentences;"
+        f" {name_to_count['geneid_location_compound_process']:,} GeneID-Location/Compound/Process sentences;"
+        f" {name_to_count['spacy_triplet']:,} SpacyORE sentences;"
+        f" {name_to_count['ner']:,} NER sentences"
+    )
+    return
 
-    gene_gene_file = os.path.join(target_dir, "geneid_commonname.jsonl")
-    gene_other_file = os.path.join(target_dir, "geneid_location_compound_process.jsonl")
-    spacy_file = os.path.join(target_dir, "spacy_triplet.jsonl")
-    ner_file = os.path.join(target_dir, "ner.jsonl")
 
-    f_gene_gene = open(gene_gene_file, "w", encoding="utf8")
-    f_gene_other = open(gene_other_file, "w", encoding="utf8")
-    f_spacy = open(spacy_file, "w", encoding="utf8")
-    f_ner = open(ner_file, "w", encoding="utf8")
+def extract_result(source_dir, target_dir, start, end, json_backend="json"):
+    os.makedirs(target_dir, exist_ok=True)
+    json_backend = get_json_backend(json_backend)
 
-    ggs = 0
-    gos = 0
-    spacys = 0
-    ners = 0
+    name_to_f = {
+        name: open(os.path.join(target_dir, f"{name}.jsonl"), "w", encoding="utf8")
+        for name in result_name_list
+    }
+    name_to_count = {name: 0 for name in result_name_list}
 
     for bi in range(start, end + 1):
         source_file = os.path.join(source_dir, f"batch_{bi}.json")
-        data = read_json(source_file)
+        logger.info(f"Reading {source_file}")
+        batch_name_to_count = extract_result_batch(source_file, name_to_f, json_backend=json_backend)
+        for name, count in batch_name_to_count.items():
+            name_to_count[name] += count
+        log_result_count(start, bi, name_to_count)
+
+    for f in name_to_f.values():
+        f.close()
+    return
 
-        for datum in data:
-            pmid = datum["pmid"]
-            sentence = datum["sentence"]
-            mention_list = datum["mention_list"]
-            gene_id_mention_list = datum["gene_id_mention_list"]
-            triplet_list = datum["triplet_list"]
-
-            # clean datum
-            mention_list = [
-                {
-                    "name": mention["name"],
-                    "type": mention["type"],
-                }
-                for mention in mention_list
-            ]
-            gene_id_mention_list = [
-                {
-                    "name": mention["name"],
-                    "type": mention["type"],
-                    "id": mention["id"],
-                }
-                for mention in gene_id_mention_list
-            ]
-            triplet_list = [
-                {
-                    "head_ner_mention_index": triplet["h_mention"],
-                    "tail_ner_mention_index": triplet["t_mention"],
-                    "triplet": triplet["triplet"],
-                }
-                for triplet in triplet_list
-            ]
-            datum_string = json.dumps({
-                "pmid": pmid,
-                "sentence": sentence,
-                "ner_mention_list": mention_list,
-                "gene_id_mention_list": gene_id_mention_list,
-                "triplet_list": triplet_list,
-            }) + "\n"
-
-            # ner data
-            f_ner.write(datum_string)
-            ners += 1
-
-            # geneid to commonname data
-            geneidtuple_set = {
-                tuple(mention["id"])
-                for mention in gene_id_mention_list
-            }
-            commonname_set = {
-                mention["name"]
-                for mention in mention_list
-                if mention["type"] == "CommonName"
-            }
-            geneidtuples = len(geneidtuple_set)
-            commonnames = len(commonname_set)
-            if 1 <= geneidtuples <= 2 and 1 <= commonnames <= 2:
-                f_gene_gene.write(datum_string)
-                ggs += 1
-
-            # geneid to location/compound/process data
-            if 1 <= geneidtuples <= 2:
-                has_other_entity = False
-                for mention in mention_list:
-                    if mention["type"] in ["Location", "Compound", "Process"]:
-                        has_other_entity = True
-                        break
-                if has_other_entity:
-                    f_gene_other.write(datum_string)
-                    gos += 1
-
-            # spacy_ore data
-            if triplet_list:
-                f_spacy.write(datum_string)
-                spacys += 1
 
-        logger.info(
-            f"batch {start}-{bi} cumulates:"
-            f" {ggs:,} GeneID-CommonName sentences;"
-            f" {gos:,} GeneID-Location/Compound/Process sentences;"
-            f" {spacys:,} SpacyORE sentences;"
-            f" {ners:,} NER sentences"
+def extract_result_part(arg):
+    source_file, part_dir, bi, json_backend, record, version = arg
+
+    name_to_part_file = {
+        name: os.path.join(part_dir, f"{name}.batch_{bi}.jsonl")
+        for name in result_name_list
+    }
+
+    # with a manifest, part files of unchanged batches are reused
+    if version is not None:
+        name_to_input_hash = {"source": get_file_hash(source_file)}
+        if is_record_up_to_date(record, name_to_input_hash, version, name_to_part_file):
+            return bi, name_to_part_file, record["count"], record
+
+    name_to_f = {
+        name: open(part_file, "w", encoding="utf8")
+        for name, part_file in name_to_part_file.items()
+    }
+    name_to_count = extract_result_batch(source_file, name_to_f, json_backend=json_backend)
+    for f in name_to_f.values():
+        f.close()
+
+    if version is not None:
+        record = get_manifest_record(name_to_input_hash, version, name_to_part_file, count=name_to_count)
+    return bi, name_to_part_file, name_to_count, record
+
+
+def extract_result_parallel(source_dir, target_dir, start, end, processes, json_backend="json", manifest_file=None):
+    # Same output as extract_result() with the same json_backend, but batches are processed by a worker pool.
+    # Each worker writes one part file per output for its batch;
+    # part files are appended to the final outputs in batch order, then removed.
+    # With a manifest, part files are kept, and only batches whose source changed are re-processed.
+    os.makedirs(target_dir, exist_ok=True)
+    json_backend = get_json_backend(json_backend)
+    logger.info(f"extract_result_parallel: {processes} processes; json_backend={json_backend}")
+
+    part_dir = os.path.join(target_dir, "part")
+    os.makedirs(part_dir, exist_ok=True)
+
+    stage = "extract_result"
+    manifest = read_manifest(manifest_file)
+    stage_manifest = manifest.setdefault(stage, {})
+    version = None
+    if manifest_file is not None:
+        version = get_code_version([extract_result_parallel], option=json_backend)
+
+    arg_list = [
+        (
+            os.path.join(source_dir, f"batch_{bi}.json"), part_dir, bi, json_backend,
+            stage_manifest.get(f"batch_{bi}"), version,
         )
+        for bi in range(start, end + 1)
+    ]
+    name_to_f = {
+        name: open(os.path.join(target_dir, f"{name}.jsonl"), "w", encoding="utf8")
+        for name in result_name_list
+    }
+    name_to_count = {name: 0 for name in result_name_list}
+
+    with multiprocessing.Pool(processes) as pool:
+        # imap() yields in submission order, so outputs are concatenated in batch order
+        for bi, name_to_part_file, batch_name_to_count, record in pool.imap(extract_result_part, arg_list):
+            for name, part_file in name_to_part_file.items():
+                with open(part_file, "r", encoding="utf8") as f_part:
+                    shutil.copyfileobj(f_part, name_to_f[name])
+                if manifest_file is None:
+                    os.remove(part_file)
+                name_to_count[name] += batch_name_to_count[name]
+            log_result_count(start, bi, name_to_count)
+
+            if manifest_file is not None:
+                if stage_manifest.get(f"batch_{bi}") == record:
+                    logger.info(f"batch {bi}: source unchanged; reused part files")
+                else:
+                    stage_manifest[f"batch_{bi}"] = record
+                    write_manifest(manifest_file, manifest)
+
+    for f in name_to_f.values():
+        f.close()
+    if manifest_file is None:
+        os.rmdir(part_dir)
+    return
 
-    f_gene_gene.close()
-    f_gene_other.close()
-    f_spacy.close()
-    f_ner.close()
+
+# read back by geneid-commonname-relation-visualization/server.py, whose relation_column_list must match
+geneid_header = ["plant", "GeneID", "CommonName", "alias_GeneIDs_in_the_sentence", "pmid", "sentence"]
+relation_header = [
+    "head", "relation", "tail",
+    "head_entity", "head_type",
+    "tail_entity", "tail_type",
+    "pmid", "sentence",
+]
+
+
+def get_website_evidence(datum):
+    pmid = datum["pmid"]
+    sentence = datum["sentence"]
+    mention_list = datum["mention_list"]
+    triplet_list = datum["triplet_list"]
+    gene_mention_list = datum["gene_id_mention_list"]
+    geneid_evidence_list = []
+    relation_evidence_list = []
+
+    # GeneIDs in the sentence
+    plant_geneidlist_to_alias_set = defaultdict(lambda: set())
+    for gene_mention in gene_mention_list:
+        geneidlist = tuple(gene_mention["id"])
+        alias = gene_mention["name"]
+        plant = gene_mention["type"]
+        plant_geneidlist_to_alias_set[(plant, geneidlist)].add(alias)
+
+    # CommonNames in the sentence
+    commonname_set = set()
+    for mention in mention_list:
+        if mention["type"] == "CommonName":
+            commonname = mention["name"]
+            commonname_set.add(commonname)
+
+    # (plant, GeneID, CommonName) -> (pmid, sentence, GeneIDs in the sentence, Alias GeneIDs in sentence) list
+    g_matches = len(plant_geneidlist_to_alias_set)
+    c_matches = len(commonname_set)
+    if (g_matches, c_matches) in [(1, 1), (1, 2), (2, 1), (2, 2)]:
+        for (plant, geneid_list), alias_set in plant_geneidlist_to_alias_set.items():
+            alias_list = sorted(alias_set)
+
+            for commonname in commonname_set:
+                geneid_evidence_list.append(((plant, geneid_list, commonname), (pmid, sentence, alias_list)))
+
+    # relation data among (CommonName, Species, Location, Compound, Process)
+    for triplet_datum in triplet_list:
+        head, relation, tail = triplet_datum["triplet"]
+        hi = triplet_datum["h_mention"]
+        ti = triplet_datum["t_mention"]
+        h_mention = mention_list[hi]
+        t_mention = mention_list[ti]
+        h_name = h_mention["name"]
+        t_name = t_mention["name"]
+        h_type = h_mention["type"]
+        t_type = t_mention["type"]
+
+        relation_datum = [
+            head, relation, tail,
+            h_name, h_type,
+            t_name, t_type,
+            pmid, sentence,
+        ]
+
+        # only collect CommonName relations
+        if h_type == "CommonName":
+            relation_evidence_list.append((h_name, relation_datum))
+        if t_type == "CommonName" and (h_type, h_name) != (t_type, t_name):
+            relation_evidence_list.append((t_name, relation_datum))
+
+    return geneid_evidence_list, relation_evidence_list, len(triplet_list)
+
+
+def update_website_type_to_set(type_to_set, geneid_evidence_list):
+    for (plant, geneid_list, commonname), (pmid, _sentence, _alias_list) in geneid_evidence_list:
+        type_to_set["pmid"].add(pmid)
+        type_to_set["plant"].add(plant)
+        type_to_set["commonname"].add(commonname)
+        for geneid in geneid_list:
+            type_to_set["geneid"].add(geneid)
+    return
+
+
+def log_website_batch(start, end, bi, type_to_set, triplets):
+    logger.info(
+        f"batch [{start:,}-{bi:,}]/[{start:,}-{end:,}]"
+        f" {len(type_to_set['plant']):,} plants;"
+        f" {len(type_to_set['geneid']):,} GeneIDs;"
+        f" {len(type_to_set['commonname']):,} CommonNames;"
+        f" {len(type_to_set['pmid']):,} pmids;"
+        f" {triplets:,} triplets"
+    )
+    return
+
+
+def log_website_statistics(triplets, type_count_list):
+    type_count_list = sorted(type_count_list, key=lambda tc: tc[1], reverse=True)
+    logger.info(f"In the GeneID-CommonName-Entity graph:")
+    logger.info(f" {triplets:,} unique triplets")
+    for _type, count in type_count_list:
+        logger.info(f" {count:,} unique {_type}s have relations")
     return
 
 
-def extract_website_data(geneid_relation_dir, website_dir, start, end):
-    plant_geneidlist_commonname_to_pmid_sentence_aliaslist = defaultdict(lambda: [])
-    commonname_to_relation_list = defaultdict(lambda: [])
+def extract_website_data(geneid_relation_dir, website_dir, start, end, columnar=False):
+    # Evidence is held as integer arrays over string dictionaries; strings are only decoded when the CSVs are written.
+    # The dictionaries are built from scratch and not persisted:
+    # the CSVs hold strings, and a reloaded dictionary would keep every sentence of every earlier run.
+    name_to_dictionary = {
+        name: new_string_dictionary()
+        for name in ["plant", "geneid", "geneid_list", "name", "type", "text", "alias_list", "pmid", "sentence"]
+    }
+    plant_dictionary = name_to_dictionary["plant"]
+    geneid_dictionary = name_to_dictionary["geneid"]
+    geneidlist_dictionary = name_to_dictionary["geneid_list"]
+    name_dictionary = name_to_dictionary["name"]
+    type_dictionary = name_to_dictionary["type"]
+    text_dictionary = name_to_dictionary["text"]
+    aliaslist_dictionary = name_to_dictionary["alias_list"]
+    pmid_dictionary = name_to_dictionary["pmid"]
+    sentence_dictionary = name_to_dictionary["sentence"]
+
+    # (plant, geneid_list, commonname) tag ids -> parallel evidence arrays
+    tag_dictionary = new_string_dictionary()
+    evidence_tag = array("q")
+    evidence_pmid = array("q")
+    evidence_pmid_int = array("q")
+    evidence_sentence = array("q")
+    evidence_aliaslist = array("q")
+
+    # relations: 9 ids per relation (head, relation, tail, h_name, h_type, t_name, t_type, pmid, sentence)
+    relation_commonname = array("q")
+    relation_field = array("q")
+    relation_field_dictionary_list = [
+        text_dictionary, text_dictionary, text_dictionary,
+        name_dictionary, type_dictionary,
+        name_dictionary, type_dictionary,
+        pmid_dictionary, sentence_dictionary,
+    ]
+
     type_to_set = defaultdict(lambda: set())
     triplets = 0
 
@@ -397,146 +1529,519 @@ def extract_website_data(geneid_relation_dir, website_dir, start, end):
         data = read_json(data_file, write_log=False)
 
         for datum in data:
-            pmid = datum["pmid"]
-            sentence = datum["sentence"]
-            mention_list = datum["mention_list"]
-            triplet_list = datum["triplet_list"]
-            gene_mention_list = datum["gene_id_mention_list"]
-
-            # GeneIDs in the sentence
-            plant_geneidlist_to_alias_set = defaultdict(lambda: set())
-            for gene_mention in gene_mention_list:
-                geneidlist = tuple(gene_mention["id"])
-                alias = gene_mention["name"]
-                plant = gene_mention["type"]
-                plant_geneidlist_to_alias_set[(plant, geneidlist)].add(alias)
-
-            # CommonNames in the sentence
-            commonname_set = set()
-            for mention in mention_list:
-                if mention["type"] == "CommonName":
-                    commonname = mention["name"]
-                    commonname_set.add(commonname)
-
-            # (plant, GeneID, CommonName) -> (pmid, sentence, GeneIDs in the sentence, Alias GeneIDs in sentence) list
-            g_matches = len(plant_geneidlist_to_alias_set)
-            c_matches = len(commonname_set)
-            if (g_matches, c_matches) in [(1, 1), (1, 2), (2, 1), (2, 2)]:
-                type_to_set["pmid"].add(pmid)
-
-                for (plant, geneid_list), alias_set in plant_geneidlist_to_alias_set.items():
-                    type_to_set["plant"].add(plant)
-                    alias_list = sorted(alias_set)
-
-                    for geneid in geneid_list:
-                        type_to_set["geneid"].add(geneid)
-
-                    for commonname in commonname_set:
-                        type_to_set["commonname"].add(commonname)
-
-                        plant_geneidlist_commonname_to_pmid_sentence_aliaslist[
-                            (plant, geneid_list, commonname)
-                        ].append(
-                            (pmid, sentence, alias_list)
-                        )
-
-            # relation data among (CommonName, Species, Location, Compound, Process)
-            for triplet_datum in triplet_list:
-                head, relation, tail = triplet_datum["triplet"]
-                hi = triplet_datum["h_mention"]
-                ti = triplet_datum["t_mention"]
-                h_mention = mention_list[hi]
-                t_mention = mention_list[ti]
-                h_name = h_mention["name"]
-                t_name = t_mention["name"]
-                h_type = h_mention["type"]
-                t_type = t_mention["type"]
-                triplets += 1
-
-                relation_datum = [
-                    head, relation, tail,
-                    h_name, h_type,
-                    t_name, t_type,
-                    pmid, sentence,
-                ]
-
-                # only collect CommonName relations
-                if h_type == "CommonName":
-                    commonname_to_relation_list[h_name].append(relation_datum)
-                if t_type == "CommonName" and (h_type, h_name) != (t_type, t_name):
-                    commonname_to_relation_list[t_name].append(relation_datum)
+            geneid_evidence_list, relation_evidence_list, datum_triplets = get_website_evidence(datum)
+            triplets += datum_triplets
+
+            for (plant, geneid_list, commonname), (pmid, sentence, alias_list) in geneid_evidence_list:
+                plant_id = get_string_id(plant_dictionary, plant)
+                geneidlist_id = get_string_id(geneidlist_dictionary, geneid_list)
+                commonname_id = get_string_id(name_dictionary, commonname)
+                pmid_id = get_string_id(pmid_dictionary, pmid)
+
+                type_to_set["pmid"].add(pmid_id)
+                type_to_set["plant"].add(plant_id)
+                type_to_set["commonname"].add(commonname_id)
+                for geneid in geneid_list:
+                    type_to_set["geneid"].add(get_string_id(geneid_dictionary, geneid))
+
+                evidence_tag.append(get_string_id(tag_dictionary, (plant_id, geneidlist_id, commonname_id)))
+                evidence_pmid.append(pmid_id)
+                evidence_pmid_int.append(int(pmid))
+                evidence_sentence.append(get_string_id(sentence_dictionary, sentence))
+                evidence_aliaslist.append(get_string_id(aliaslist_dictionary, tuple(alias_list)))
+
+            for commonname, relation_datum in relation_evidence_list:
+                relation_commonname.append(get_string_id(name_dictionary, commonname))
+                for dictionary, field in zip(relation_field_dictionary_list, relation_datum):
+                    relation_field.append(get_string_id(dictionary, field))
+
+        log_website_batch(start, end, bi, type_to_set, triplets)
 
-        logger.info(
-            f"batch [{start:,}-{bi:,}]/[{start:,}-{end:,}]"
-            f" {len(type_to_set['plant']):,} plants;"
-            f" {len(type_to_set['geneid']):,} GeneIDs;"
-            f" {len(type_to_set['commonname']):,} CommonNames;"
-            f" {len(type_to_set['pmid']):,} pmids;"
-            f" {triplets:,} triplets"
+    # format gene id data csv
+    # tags are ranked by their decoded strings; evidence of a tag by pmid, then by insertion order
+    def decode_tag(tag):
+        plant_id, geneidlist_id, commonname_id = tag
+        return (
+            plant_dictionary["id_to_string"][plant_id],
+            geneidlist_dictionary["id_to_string"][geneidlist_id],
+            name_dictionary["id_to_string"][commonname_id],
         )
 
-    # format gene id data csv
-    geneid_header = ["plant", "GeneID", "CommonName", "alias_GeneIDs_in_the_sentence", "pmid", "sentence"]
-    geneid_data = [geneid_header]
-    tag_list = sorted(plant_geneidlist_commonname_to_pmid_sentence_aliaslist.keys())
+    tag_list = [decode_tag(tag) for tag in tag_dictionary["id_to_string"]]
+    tag_rank = array("q", bytes(8 * len(tag_list)))
+    for rank, tag_id in enumerate(sorted(range(len(tag_list)), key=lambda ti: tag_list[ti])):
+        tag_rank[tag_id] = rank
+    evidence_index_list = sorted(
+        range(len(evidence_tag)),
+        key=lambda ei: (tag_rank[evidence_tag[ei]], evidence_pmid_int[ei]),
+    )
 
-    for tag in tag_list:
-        plant, geneid_list, commonname = tag
-        evidence_list = plant_geneidlist_commonname_to_pmid_sentence_aliaslist[tag]
-        evidence_list = sorted(evidence_list, key=lambda x: int(x[0]))
+    geneid_data = [geneid_header]
 
-        for pmid, sentence, alias_list in evidence_list:
-            geneid_string = ", ".join(geneid_list)
-            alias_string = ", ".join(alias_list)
-            geneid_data.append([plant, geneid_string, commonname, alias_string, pmid, sentence])
+    for ei in evidence_index_list:
+        plant, geneid_list, commonname = tag_list[evidence_tag[ei]]
+        geneid_string = ", ".join(geneid_list)
+        alias_string = ", ".join(aliaslist_dictionary["id_to_string"][evidence_aliaslist[ei]])
+        pmid = pmid_dictionary["id_to_string"][evidence_pmid[ei]]
+        sentence = sentence_dictionary["id_to_string"][evidence_sentence[ei]]
+        geneid_data.append([plant, geneid_string, commonname, alias_string, pmid, sentence])
 
     # format relation data csv
-    relation_header = [
-        "head", "relation", "tail",
-        "head_entity", "head_type",
-        "tail_entity", "tail_type",
-        "pmid", "sentence",
-    ]
+    # only collect relations for GeneID-CommonName-Entity
+    relation_index_list = sorted(
+        (ri for ri, commonname_id in enumerate(relation_commonname) if commonname_id in type_to_set["commonname"]),
+        key=lambda ri: name_dictionary["id_to_string"][relation_commonname[ri]],
+    )
     relation_data = [relation_header]
-    commonname_list = sorted(commonname_to_relation_list.keys())
     statistics_type_to_set = defaultdict(lambda: set())
 
-    for commonname in commonname_list:
-        # only collect relations for GeneID-CommonName-Entity
-        if commonname not in type_to_set["commonname"]:
-            continue
-        for relation in commonname_to_relation_list[commonname]:
-            relation_data.append(relation)
+    for ri in relation_index_list:
+        (
+            head, relation, tail,
+            h_name, h_type,
+            t_name, t_type,
+            pmid, sentence,
+        ) = relation_field[9 * ri: 9 * ri + 9]
 
-            # statistics
-            (
-                head, relation, tail,
-                h_name, h_type,
-                t_name, t_type,
-                pmid, sentence,
-            ) = relation
+        relation_data.append([
+            dictionary["id_to_string"][field]
+            for dictionary, field in zip(relation_field_dictionary_list, relation_field[9 * ri: 9 * ri + 9])
+        ])
 
-            statistics_type_to_set["triplet"].add((head, relation, tail))
-            statistics_type_to_set[h_type].add(h_name)
-            statistics_type_to_set[t_type].add(t_name)
+        # statistics
+        statistics_type_to_set["triplet"].add((head, relation, tail))
+        statistics_type_to_set[h_type].add(h_name)
+        statistics_type_to_set[t_type].add(t_name)
 
     type_count_list = [
-        (_type, len(_set))
+        (type_dictionary["id_to_string"][_type], len(_set))
         for _type, _set in statistics_type_to_set.items()
-        if "triplet" not in _type
+        if _type != "triplet"
     ]
     triplets = len(statistics_type_to_set["triplet"])
-    type_count_list = sorted(type_count_list, key=lambda tc: tc[1], reverse=True)
-    logger.info(f"In the GeneID-CommonName-Entity graph:")
-    logger.info(f" {triplets:,} unique triplets")
-    for _type, count in type_count_list:
-        logger.info(f" {count:,} unique {_type}s have relations")
+    log_website_statistics(triplets, type_count_list)
 
     geneid_data_file = os.path.join(website_dir, "geneid_commonname.csv")
     write_csv(geneid_data_file, "csv", geneid_data)
 
     relation_data_file = os.path.join(website_dir, "commonname_relation.csv")
     write_csv(relation_data_file, "csv", relation_data)
+
+    if columnar:
+        write_website_columnar(website_dir, geneid_data, relation_data)
+    return
+
+
+def write_csv_from_cursor(file, dialect, header, cursor, write_log=True):
+    if write_log:
+        logger.info(f"Writing {file}")
+    rows = 1
+
+    with open(file, "w", encoding="utf8", newline="") as f:
+        writer = csv.writer(f, dialect=dialect)
+        writer.writerow(header)
+        for row in cursor:
+            writer.writerow(row)
+            rows += 1
+
+    if write_log:
+        logger.info(f"Written {rows:,} rows to {file}")
+    return
+
+
+def extract_website_data_sqlite(geneid_relation_dir, website_dir, start, end, db_file=None, keep_db=False):
+    # Same output as extract_website_data(), but evidence rows are spilled to an sqlite file after every batch.
+    # Sorting is done by sqlite, which falls back to an external merge sort on temp files,
+    # so memory holds one batch plus the unique plant/GeneID/CommonName/pmid sets used for logging.
+    #
+    # geneid_list is stored joined by "\x01", which sorts below every printable character,
+    # so ORDER BY on the joined string matches Python's tuple ordering.
+    # rowid keeps insertion order, which matches the stable sorts of the in-memory version.
+    if db_file is None:
+        db_file = os.path.join(website_dir, "website_data.sqlite")
+    if os.path.exists(db_file):
+        os.remove(db_file)
+    logger.info(f"Aggregating in {db_file}")
+
+    conn = sqlite3.connect(db_file)
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute("PRAGMA temp_store = FILE")
+    conn.execute(
+        "CREATE TABLE geneid_evidence ("
+        "plant TEXT, geneid TEXT, commonname TEXT, pmid_int INTEGER,"
+        " alias TEXT, pmid TEXT, sentence TEXT)"
+    )
+    conn.execute(
+        "CREATE TABLE relation_evidence ("
+        "commonname TEXT,"
+        " head TEXT, relation TEXT, tail TEXT,"
+        " h_name TEXT, h_type TEXT, t_name TEXT, t_type TEXT,"
+        " pmid TEXT, sentence TEXT)"
+    )
+
+    type_to_set = defaultdict(lambda: set())
+    triplets = 0
+
+    for bi in range(start, end + 1):
+        data_file = os.path.join(geneid_relation_dir, f"batch_{bi}.json")
+        data = read_json(data_file, write_log=False)
+        geneid_row_list = []
+        relation_row_list = []
+
+        for datum in data:
+            geneid_evidence_list, relation_evidence_list, datum_triplets = get_website_evidence(datum)
+            update_website_type_to_set(type_to_set, geneid_evidence_list)
+            for (plant, geneid_list, commonname), (pmid, sentence, alias_list) in geneid_evidence_list:
+                geneid_row_list.append((
+                    plant, "\x01".join(geneid_list), commonname, int(pmid),
+                    ", ".join(alias_list), pmid, sentence,
+                ))
+            for commonname, relation_datum in relation_evidence_list:
+                relation_row_list.append((commonname, *relation_datum))
+            triplets += datum_triplets
+        del data
+
+        conn.executemany("INSERT INTO geneid_evidence VALUES (?, ?, ?, ?, ?, ?, ?)", geneid_row_list)
+        conn.executemany("INSERT INTO relation_evidence VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", relation_row_list)
+        conn.commit()
+        log_website_batch(start, end, bi, type_to_set, triplets)
+
+    # gene id data csv
+    cursor = conn.execute(
+        "SELECT plant, REPLACE(geneid, char(1), ', '), commonname, alias, pmid, sentence"
+        " FROM geneid_evidence"
+        " ORDER BY plant, geneid, commonname, pmid_int, rowid"
+    )
+    geneid_data_file = os.path.join(website_dir, "geneid_commonname.csv")
+    write_csv_from_cursor(geneid_data_file, "csv", geneid_header, cursor)
+
+    # relation data csv, only for GeneID-CommonName-Entity
+    conn.execute("CREATE TABLE geneid_commonname AS SELECT DISTINCT commonname FROM geneid_evidence")
+    conn.execute(
+        "CREATE TABLE graph_relation AS"
+        " SELECT * FROM relation_evidence"
+        " WHERE commonname IN (SELECT commonname FROM geneid_commonname)"
+        " ORDER BY commonname, rowid"
+    )
+    cursor = conn.execute(
+        "SELECT head, relation, tail, h_name, h_type, t_name, t_type, pmid, sentence"
+        " FROM graph_relation ORDER BY rowid"
+    )
+    relation_data_file = os.path.join(website_dir, "commonname_relation.csv")
+    write_csv_from_cursor(relation_data_file, "csv", relation_header, cursor)
+
+    # statistics
+    triplets = conn.execute(
+        "SELECT COUNT(*) FROM (SELECT DISTINCT head, relation, tail FROM graph_relation)"
+    ).fetchone()[0]
+    type_count_list = conn.execute(
+        "SELECT _type, COUNT(*) FROM ("
+        " SELECT h_type AS _type, h_name AS name FROM graph_relation"
+        " UNION"
+        " SELECT t_type AS _type, t_name AS name FROM graph_relation"
+        ") GROUP BY _type"
+    ).fetchall()
+    log_website_statistics(triplets, type_count_list)
+
+    conn.close()
+    if not keep_db:
+        os.remove(db_file)
+    return
+
+
+"""
+columnar website data
+"""
+# columnar format, in website_dir/columnar:
+#   {table}.json:                 {"rows", "byteorder", "column_list"}
+#   {table}.{column}.codes:       one native int32 dictionary code per row
+#   {dictionary}.offsets:         native int64 byte offsets into {dictionary}.strings, one more than strings
+#   {dictionary}.strings:         utf8 bytes of all dictionary strings, concatenated
+# Dictionaries are sorted, so codes compare like the strings they encode.
+# The "sentence" dictionary is shared by both tables, so every sentence is stored once.
+
+
+def write_columnar_dictionary(columnar_dir, dictionary_name, id_to_string):
+    offsets = array("q", [0])
+    strings_file = os.path.join(columnar_dir, f"{dictionary_name}.strings")
+    offsets_file = os.path.join(columnar_dir, f"{dictionary_name}.offsets")
+
+    with open(strings_file, "wb") as f:
+        for string in id_to_string:
+            string = string.encode("utf8")
+            f.write(string)
+            offsets.append(offsets[-1] + len(string))
+
+    with open(offsets_file, "wb") as f:
+        offsets.tofile(f)
+    return
+
+
+def write_website_columnar(website_dir, geneid_data, relation_data):
+    # geneid_data and relation_data are CSV row lists with a header row
+    assert geneid_data[0] == geneid_header and relation_data[0] == relation_header
+    columnar_dir = os.path.join(website_dir, "columnar")
+    os.makedirs(columnar_dir, exist_ok=True)
+    table_to_data = {
+        "geneid_commonname": geneid_data,
+        "commonname_relation": relation_data,
+    }
+
+    # build sorted dictionaries: one per column, except the shared sentence dictionary
+    dictionary_to_string_set = defaultdict(lambda: set())
+    table_to_column_dictionary_list = {}
+
+    for table, data in table_to_data.items():
+        header, row_list = data[0], data[1:]
+        column_dictionary_list = [
+            "sentence" if column == "sentence" else f"{table}.{column}"
+            for column in header
+        ]
+        table_to_column_dictionary_list[table] = column_dictionary_list
+        for ci, dictionary_name in enumerate(column_dictionary_list):
+            string_set = dictionary_to_string_set[dictionary_name]
+            for row in row_list:
+                string_set.add(row[ci])
+
+    dictionary_to_string_to_id = {}
+    for dictionary_name, string_set in dictionary_to_string_set.items():
+        dictionary = new_string_dictionary(sorted(string_set))
+        write_columnar_dictionary(columnar_dir, dictionary_name, dictionary["id_to_string"])
+        dictionary_to_string_to_id[dictionary_name] = dictionary["string_to_id"]
+    sentences = len(dictionary_to_string_set["sentence"])
+    logger.info(f"{sentences:,} unique sentences")
+
+    # encode columns
+    for table, data in table_to_data.items():
+        header, row_list = data[0], data[1:]
+        rows = len(row_list)
+        column_dictionary_list = table_to_column_dictionary_list[table]
+        column_list = []
+
+        for ci, column in enumerate(header):
+            dictionary_name = column_dictionary_list[ci]
+            string_to_id = dictionary_to_string_to_id[dictionary_name]
+            code_array = array("i", (string_to_id[row[ci]] for row in row_list))
+            with open(os.path.join(columnar_dir, f"{table}.{column}.codes"), "wb") as f:
+                code_array.tofile(f)
+            column_list.append({"name": column, "dictionary": dictionary_name})
+
+        meta = {
+            "rows": rows,
+            "byteorder": sys.byteorder,
+            "column_list": column_list,
+        }
+        meta_file = os.path.join(columnar_dir, f"{table}.json")
+        write_json(meta_file, meta, indent=2, write_log=False)
+        logger.info(f"{rows:,} rows written to {meta_file}")
+    return
+
+
+def convert_website_csv_to_columnar(website_dir):
+    geneid_data = read_csv(os.path.join(website_dir, "geneid_commonname.csv"), "csv")
+    relation_data = read_csv(os.path.join(website_dir, "commonname_relation.csv"), "csv")
+    write_website_columnar(website_dir, geneid_data, relation_data)
+    return
+
+
+"""
+association statistics
+"""
+# Sparse co-occurrence counts, accumulated as (int64 key, count) arrays:
+#   a (row id, column id) pair is keyed as row_id << 32 | column_id.
+# Counts are kept at two levels:
+#   sentence: number of sentences where both appear
+#   pmid:     number of pmids where both appear
+# A pmid's sentences are contiguous in the source data, so split_batch() never puts one pmid in two batches,
+# and pmid-level pairs can be de-duplicated batch by batch.
+
+
+def add_sparse_count(key_count, key_array):
+    # key_count: (sorted unique keys, counts); key_array: new keys, possibly repeated
+    key_array = np.asarray(key_array, dtype=np.int64)
+    if key_count is None:
+        key_count = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+    key_array = np.concatenate([key_count[0], key_array])
+    weight_array = np.concatenate([key_count[1], np.ones(len(key_array) - len(key_count[0]), dtype=np.int64)])
+    unique_key_array, inverse_array = np.unique(key_array, return_inverse=True)
+    count_array = np.bincount(inverse_array.reshape(-1), weights=weight_array, minlength=len(unique_key_array))
+    return unique_key_array, count_array.astype(np.int64)
+
+
+def get_unique_pmid_key_array(pmid_array, key_array):
+    # keys counted once per pmid
+    if not len(key_array):
+        return np.zeros(0, dtype=np.int64)
+    pmid_key_array = np.stack([np.asarray(pmid_array, dtype=np.int64), np.asarray(key_array, dtype=np.int64)])
+    pmid_key_array = np.unique(pmid_key_array, axis=1)
+    return pmid_key_array[1]
+
+
+def get_association_score(pair_count, row_count, column_count, total):
+    # vectorized PMI and 2x2 chi-square for all pairs at once
+    a = pair_count.astype(np.float64)
+    b = row_count - a
+    c = column_count - a
+    d = total - a - b - c
+    pmi = np.log(a * total / (row_count * column_count.astype(np.float64)))
+    denominator = (a + b) * (c + d) * (a + c) * (b + d)
+    chi2 = np.divide(
+        total * (a * d - b * c) ** 2, denominator,
+        out=np.zeros_like(a), where=denominator > 0,
+    )
+    return pmi, chi2
+
+
+def format_score(score):
+    if isinstance(score, (np.integer, int)):
+        return str(int(score))
+    return f"{score:.6g}"
+
+
+def extract_association_statistics(geneid_relation_dir, website_dir, start, end):
+    # GeneID x CommonName and CommonName x Entity co-occurrence matrices, with PMI and chi-square.
+    # Writes geneid_commonname_association.csv, commonname_entity_association.csv,
+    # the sparse counts as association_count.npz, and the row/column dictionaries in website_dir/dictionary.
+    if np is None:
+        raise ImportError("extract_association_statistics requires numpy")
+
+    dictionary_dir = os.path.join(website_dir, "dictionary")
+    name_to_dictionary = read_string_dictionary_dir(dictionary_dir, ["plant_geneid", "name", "entity"])
+    gene_dictionary = name_to_dictionary["plant_geneid"]
+    commonname_dictionary = name_to_dictionary["name"]
+    entity_dictionary = name_to_dictionary["entity"]
+
+    # matrix -> level -> (keys, counts); marginal -> level -> (keys, counts)
+    matrix_list = ["geneid_commonname", "commonname_entity"]
+    marginal_list = ["geneid", "commonname", "entity"]
+    level_list = ["sentence", "pmid"]
+    name_level_to_count = {}
+    level_to_total = {"sentence": 0, "pmid": 0}
+
+    for bi in range(start, end + 1):
+        data_file = os.path.join(geneid_relation_dir, f"batch_{bi}.json")
+        data = read_json(data_file, write_log=False)
+        name_to_key_list = {name: [] for name in matrix_list + marginal_list}
+        name_to_pmid_list = {name: [] for name in matrix_list + marginal_list}
+        pmid_to_index = {}
+
+        for datum in data:
+            pmid = pmid_to_index.setdefault(datum["pmid"], len(pmid_to_index))
+            gene_set = {
+                get_string_id(gene_dictionary, (mention["type"], ", ".join(mention["id"])))
+                for mention in datum["gene_id_mention_list"]
+            }
+            commonname_set = set()
+            entity_set = set()
+            for mention in datum["mention_list"]:
+                if mention["type"] == "CommonName":
+                    commonname_set.add(get_string_id(commonname_dictionary, mention["name"]))
+                else:
+                    entity_set.add(get_string_id(entity_dictionary, (mention["type"], mention["name"])))
+
+            for name, key_iterable in [
+                ("geneid", gene_set),
+                ("commonname", commonname_set),
+                ("entity", entity_set),
+                ("geneid_commonname", (g << 32 | c for g in gene_set for c in commonname_set)),
+                ("commonname_entity", (c << 32 | e for c in commonname_set for e in entity_set)),
+            ]:
+                key_list = name_to_key_list[name]
+                before = len(key_list)
+                key_list.extend(key_iterable)
+                name_to_pmid_list[name].extend([pmid] * (len(key_list) - before))
+
+        level_to_total["sentence"] += len(data)
+        level_to_total["pmid"] += len(pmid_to_index)
+        for name, key_list in name_to_key_list.items():
+            name_level_to_count[(name, "sentence")] = add_sparse_count(
+                name_level_to_count.get((name, "sentence")), key_list,
+            )
+            name_level_to_count[(name, "pmid")] = add_sparse_count(
+                name_level_to_count.get((name, "pmid")),
+                get_unique_pmid_key_array(name_to_pmid_list[name], key_list),
+            )
+        del data
+
+        pairs = len(name_level_to_count[("geneid_commonname", "sentence")][0])
+        logger.info(
+            f"batch [{start:,}-{bi:,}]/[{start:,}-{end:,}]"
+            f" {level_to_total['sentence']:,} sentences;"
+            f" {level_to_total['pmid']:,} pmids;"
+            f" {pairs:,} GeneID-CommonName pairs"
+        )
+
+    write_string_dictionary_dir(dictionary_dir, name_to_dictionary)
+    np.savez(
+        os.path.join(website_dir, "association_count.npz"),
+        **{
+            f"{name}.{level}.{field}": key_count[fi]
+            for (name, level), key_count in name_level_to_count.items()
+            for fi, field in enumerate(["key", "count"])
+        },
+        **{f"total.{level}": np.int64(total) for level, total in level_to_total.items()},
+    )
+
+    # scores
+    matrix_to_marginal = {
+        "geneid_commonname": ("geneid", "commonname"),
+        "commonname_entity": ("commonname", "entity"),
+    }
+    matrix_to_row_column = {}
+    for matrix, (row_marginal, column_marginal) in matrix_to_marginal.items():
+        key_array = name_level_to_count[(matrix, "sentence")][0]
+        row_array = key_array >> 32
+        column_array = key_array & 0xFFFFFFFF
+        column_list = [row_array, column_array]
+
+        for level in level_list:
+            total = level_to_total[level]
+            # align pmid-level pairs with sentence-level pairs; every pmid-level pair is a sentence-level pair
+            pair_key_array, pair_count_array = name_level_to_count[(matrix, level)]
+            pair_count_array = pair_count_array[np.searchsorted(pair_key_array, key_array)]
+
+            marginal_count_list = []
+            for marginal, id_array in [(row_marginal, row_array), (column_marginal, column_array)]:
+                marginal_key_array, marginal_count_array = name_level_to_count[(marginal, level)]
+                marginal_count_list.append(marginal_count_array[np.searchsorted(marginal_key_array, id_array)])
+
+            pmi, chi2 = get_association_score(pair_count_array, *marginal_count_list, total)
+            column_list += [pair_count_array, *marginal_count_list, pmi, chi2]
+        matrix_to_row_column[matrix] = column_list
+
+    count_header = [
+        f"{level}_{field}"
+        for level in level_list
+        for field in ["count", "row_count", "column_count", "pmi", "chi2"]
+    ]
+
+    geneid_association_data = [["plant", "GeneID", "CommonName"] + count_header]
+    row_array, column_array, *score_array_list = matrix_to_row_column["geneid_commonname"]
+    for i in range(len(row_array)):
+        plant, geneid = gene_dictionary["id_to_string"][row_array[i]]
+        commonname = commonname_dictionary["id_to_string"][column_array[i]]
+        geneid_association_data.append(
+            [plant, geneid, commonname] + [format_score(score_array[i]) for score_array in score_array_list]
+        )
+
+    entity_association_data = [["CommonName", "entity", "entity_type"] + count_header]
+    row_array, column_array, *score_array_list = matrix_to_row_column["commonname_entity"]
+    for i in range(len(row_array)):
+        commonname = commonname_dictionary["id_to_string"][row_array[i]]
+        entity_type, entity = entity_dictionary["id_to_string"][column_array[i]]
+        entity_association_data.append(
+            [commonname, entity, entity_type] + [format_score(score_array[i]) for score_array in score_array_list]
+        )
+
+    geneid_association_data[1:] = sorted(geneid_association_data[1:], key=lambda row: row[:3])
+    entity_association_data[1:] = sorted(entity_association_data[1:], key=lambda row: row[:3])
+
+    geneid_association_file = os.path.join(website_dir, "geneid_commonname_association.csv")
+    write_csv(geneid_association_file, "csv", geneid_association_data)
+
+    entity_association_file = os.path.join(website_dir, "commonname_entity_association.csv")
+    write_csv(entity_association_file, "csv", entity_association_data)
     return
 
 
@@ -544,27 +2049,105 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--start", type=int)
     parser.add_argument("--end", type=int)
+    parser.add_argument(
+        "--stage", type=str, default="extract_website_data",
+        choices=[
+            "collect_ner_data", "split_batch", "tag_gene_id",
+            "extract_result", "extract_result_parallel",
+            "extract_website_data", "extract_website_data_sqlite", "website_columnar",
+            "association_statistics", "fan_out",
+        ],
+    )
+    parser.add_argument("--dedup", action="store_true")
+    parser.add_argument("--columnar", action="store_true")
+    parser.add_argument("--gene_id_engine", type=str, default="trie", choices=["trie", "dict"])
+    parser.add_argument("--approximate", action="store_true")
+    parser.add_argument("--max_distance", type=int, default=1)
+    parser.add_argument("--min_length", type=int, default=5)
+    parser.add_argument("--use_manifest", action="store_true")
+    parser.add_argument("--processes", type=int, default=8)
+    # orjson writes the same data as json in different bytes; see get_json_backend()
+    parser.add_argument("--json_backend", type=str, default="json", choices=["json", "orjson"])
     arg = parser.parse_args()
     for key, value in vars(arg).items():
         if value is not None:
             logger.info(f"[arg.{key}] {value}")
 
     data_dir = os.path.join("/", "volume", "penghsuanli-genome2-nas2", "plant", "dataset_20230926")
-
-    sentence_ner_dir = os.path.join(data_dir, "sentence_ner")
-    ner_file = os.path.join(data_dir, "ner.json")
-    ner_dir = os.path.join(data_dir, "ner")
+    manifest_file = os.path.join(data_dir, "manifest.json") if arg.use_manifest else None
+
+    # --dedup: NER, GeneID and spaCy run on plant_utils.py --stage dedup_sentence_data output,
+    # and fan_out writes their results for every sentence occurrence to ner_geneid_spacy
+    suffix = "_unique" if arg.dedup else ""
+    sentence_ner_dir = os.path.join(data_dir, f"sentence_ner{suffix}")
+    ner_file = os.path.join(data_dir, f"ner{suffix}.json")
+    ner_dir = os.path.join(data_dir, f"ner{suffix}")
     gene_id_dir = os.path.join(data_dir, "gene_id")
-    ner_geneid_dir = os.path.join(data_dir, "ner_geneid")
+    ner_geneid_dir = os.path.join(data_dir, f"ner_geneid{suffix}")
+    ner_geneid_spacy_unique_dir = os.path.join(data_dir, "ner_geneid_spacy_unique")
     ner_geneid_spacy_dir = os.path.join(data_dir, "ner_geneid_spacy")
+    occurrence_dir = os.path.join(data_dir, "sentence_unique", "occurrence")
+    result_dir = os.path.join(data_dir, "result")
+
+    if arg.stage == "collect_ner_data":
+        run_aggregate_stage(
+            manifest_file, arg.stage, get_code_version([collect_ner_data]),
+            [get_ner_batch_file(os.path.join(sentence_ner_dir, f"batch_{bi}")) for bi in range(arg.start, arg.end + 1)],
+            {"ner": ner_file},
+            collect_ner_data, sentence_ner_dir, ner_file, arg.start, arg.end,
+        )
 
-    # collect_ner_data(sentence_ner_dir, ner_file, arg.start, arg.end)
-    # split_batch(ner_file, ner_dir, 313607)
-    # tag_gene_id_for_directory(gene_id_dir, ner_dir, ner_geneid_dir, arg.start, arg.end)
+    elif arg.stage == "split_batch":
+        split_batch(ner_file, ner_dir, 313607)
 
-    result_dir = os.path.join(data_dir, "result")
-    # extract_result(ner_geneid_spacy_dir, result_dir, arg.start, arg.end)
-    extract_website_data(ner_geneid_spacy_dir, result_dir, arg.start, arg.end)
+    elif arg.stage == "tag_gene_id":
+        tag_gene_id_for_directory(
+            gene_id_dir, ner_dir, ner_geneid_dir, arg.start, arg.end, manifest_file, arg.gene_id_engine,
+            arg.approximate, arg.max_distance, arg.min_length,
+        )
+
+    elif arg.stage == "fan_out":
+        fan_out_sentence_data(
+            ner_geneid_spacy_unique_dir, arg.start, arg.end, occurrence_dir, ner_geneid_spacy_dir, 313607,
+        )
+
+    elif arg.stage == "extract_result":
+        extract_result(ner_geneid_spacy_dir, result_dir, arg.start, arg.end)
+
+    elif arg.stage == "extract_result_parallel":
+        extract_result_parallel(
+            ner_geneid_spacy_dir, result_dir, arg.start, arg.end, arg.processes, arg.json_backend, manifest_file,
+        )
+
+    elif arg.stage == "extract_website_data":
+        run_aggregate_stage(
+            manifest_file, arg.stage, get_code_version([extract_website_data], option=f"columnar={arg.columnar}"),
+            [os.path.join(ner_geneid_spacy_dir, f"batch_{bi}.json") for bi in range(arg.start, arg.end + 1)],
+            {
+                "geneid_commonname": os.path.join(result_dir, "geneid_commonname.csv"),
+                "commonname_relation": os.path.join(result_dir, "commonname_relation.csv"),
+            },
+            extract_website_data, ner_geneid_spacy_dir, result_dir, arg.start, arg.end, arg.columnar,
+        )
+
+    elif arg.stage == "extract_website_data_sqlite":
+        run_aggregate_stage(
+            manifest_file, arg.stage, get_code_version([extract_website_data_sqlite]),
+            [os.path.join(ner_geneid_spacy_dir, f"batch_{bi}.json") for bi in range(arg.start, arg.end + 1)],
+            {
+                "geneid_commonname": os.path.join(result_dir, "geneid_commonname.csv"),
+                "commonname_relation": os.path.join(result_dir, "commonname_relation.csv"),
+            },
+            extract_website_data_sqlite, ner_geneid_spacy_dir, result_dir, arg.start, arg.end,
+        )
+        if arg.columnar:
+            convert_website_csv_to_columnar(result_dir)
+
+    elif arg.stage == "website_columnar":
+        convert_website_csv_to_columnar(result_dir)
+
+    elif arg.stage == "association_statistics":
+        extract_association_statistics(ner_geneid_spacy_dir, result_dir, arg.start, arg.end)
     return
 
 
@@ -1,6 +1,8 @@
+import os
 import csv
 import sys
 import json
+import mmap
 import logging
 import argparse
 from collections import defaultdict
@@ -33,6 +35,110 @@ def read_csv(file, dialect, write_log=True):
     return row_list
 
 
+def read_columnar_buffer(file):
+    # mmap cannot map an empty file
+    if os.path.getsize(file) == 0:
+        return memoryview(b"")
+    with open(file, "rb") as f:
+        return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+def read_columnar_table(columnar_dir, table):
+    # format written by gene_id/main_2023.py::write_website_columnar()
+    # column codes and dictionaries are memory-mapped; strings are decoded only on access
+    meta_file = os.path.join(columnar_dir, f"{table}.json")
+    logger.info(f"Reading {meta_file}")
+    with open(meta_file, "r", encoding="utf8") as f:
+        meta = json.load(f)
+    assert meta["byteorder"] == sys.byteorder
+
+    column_to_codes = {}
+    column_to_dictionary = {}
+
+    for column in meta["column_list"]:
+        name = column["name"]
+        dictionary_name = column["dictionary"]
+        column_to_codes[name] = read_columnar_buffer(os.path.join(columnar_dir, f"{table}.{name}.codes")).cast("i")
+        column_to_dictionary[name] = (
+            read_columnar_buffer(os.path.join(columnar_dir, f"{dictionary_name}.strings")),
+            read_columnar_buffer(os.path.join(columnar_dir, f"{dictionary_name}.offsets")).cast("q"),
+        )
+
+    rows = meta["rows"]
+    logger.info(f"Read {rows:,} rows")
+    return column_to_codes, column_to_dictionary
+
+
+def get_columnar_string(dictionary, code):
+    strings, offsets = dictionary
+    return bytes(strings[offsets[code]:offsets[code + 1]]).decode("utf8")
+
+
+def get_columnar_decoder(dictionary):
+    code_to_string = {}
+
+    def decode(code):
+        string = code_to_string.get(code)
+        if string is None:
+            string = get_columnar_string(dictionary, code)
+            code_to_string[code] = string
+        return string
+    return decode
+
+
+def get_columnar_row(column_to_codes, column_to_dictionary, column_list, ri):
+    row = tuple(
+        get_columnar_string(column_to_dictionary[column], column_to_codes[column][ri])
+        for column in column_list
+    )
+    return row
+
+
+def get_global_data_from_columnar(columnar_dir):
+    geneid_codes, geneid_dictionary = read_columnar_table(columnar_dir, "geneid_commonname")
+    relation_codes, relation_dictionary = read_columnar_table(columnar_dir, "commonname_relation")
+    assert list(relation_codes) == relation_column_list
+
+    # rows are visited in file order, like get_global_data(), so both formats give the same graphs;
+    # each distinct code is decoded once
+    plant_to_geneid = defaultdict(lambda: set())
+    geneid_commonname_pmid = defaultdict(lambda: defaultdict(lambda: set()))
+    plant_decoder = get_columnar_decoder(geneid_dictionary["plant"])
+    geneid_decoder = get_columnar_decoder(geneid_dictionary["GeneID"])
+    commonname_decoder = get_columnar_decoder(geneid_dictionary["CommonName"])
+    pmid_decoder = get_columnar_decoder(geneid_dictionary["pmid"])
+
+    for plant, geneid, commonname, pmid in zip(
+            geneid_codes["plant"], geneid_codes["GeneID"], geneid_codes["CommonName"], geneid_codes["pmid"],
+    ):
+        geneid = geneid_decoder(geneid)
+        plant_to_geneid[plant_decoder(plant)].add(geneid)
+        geneid_commonname_pmid[geneid][commonname_decoder(commonname)].add(pmid_decoder(pmid))
+
+    # CommonName -> relation row indices; rows are decoded when a graph is generated
+    commonname_to_relation = defaultdict(lambda: [])
+    head_type_decoder = get_columnar_decoder(relation_dictionary["head_type"])
+    tail_type_decoder = get_columnar_decoder(relation_dictionary["tail_type"])
+    head_entity_decoder = get_columnar_decoder(relation_dictionary["head_entity"])
+    tail_entity_decoder = get_columnar_decoder(relation_dictionary["tail_entity"])
+
+    for ri, (head_type, tail_type, head_entity, tail_entity) in enumerate(zip(
+            relation_codes["head_type"], relation_codes["tail_type"],
+            relation_codes["head_entity"], relation_codes["tail_entity"],
+    )):
+        if head_type_decoder(head_type) == "CommonName":
+            commonname_to_relation[head_entity_decoder(head_entity)].append(ri)
+        if tail_type_decoder(tail_type) == "CommonName":
+            commonname_to_relation[tail_entity_decoder(tail_entity)].append(ri)
+
+    plant_to_geneid = {
+        plant: sorted(geneid_set)
+        for plant, geneid_set in plant_to_geneid.items()
+    }
+    relation_table = (relation_codes, relation_dictionary)
+    return plant_to_geneid, geneid_commonname_pmid, commonname_to_relation, relation_table
+
+
 def get_global_data():
     geneid_data_file = "geneid_commonname.csv"
     relation_data_file = "commonname_relation.csv"
@@ -46,23 +152,19 @@ def get_global_data():
         "plant", "GeneID", "CommonName",
         "alias_GeneIDs_in_the_sentence", "pmid", "sentence",
     ]
-    assert relation_header == [
-        "head", "relation", "tail",
-        "head_entity", "head_type",
-        "tail_entity", "tail_type",
-        "simple", "pmid", "sentence",
-    ]
+    assert relation_header in [relation_column_list, legacy_relation_column_list]
 
     plant_to_geneid = defaultdict(lambda: set())
     geneid_commonname_pmid = defaultdict(lambda: defaultdict(lambda: set()))
-    commonname_to_relation = defaultdict(lambda: set())
+    # relations are kept once each, in file order
+    commonname_to_relation = defaultdict(lambda: {})
 
     for plant, geneid, commonname, _alias_geneids_in_the_sentence, pmid, _sentence in geneid_data:
         plant_to_geneid[plant].add(geneid)
         geneid_commonname_pmid[geneid][commonname].add(pmid)
 
     for relation_datum in relation_data:
-        relation_datum = tuple(relation_datum)
+        relation_datum = get_relation_datum(relation_header, relation_datum)
         (
             head, relation, tail,
             head_entity, head_type,
@@ -70,18 +172,73 @@ def get_global_data():
             simple, pmid, sentence,
         ) = relation_datum
         if head_type == "CommonName":
-            commonname_to_relation[head_entity].add(relation_datum)
+            commonname_to_relation[head_entity][relation_datum] = None
         if tail_type == "CommonName":
-            commonname_to_relation[tail_entity].add(relation_datum)
+            commonname_to_relation[tail_entity][relation_datum] = None
 
     plant_to_geneid = {
         plant: sorted(geneid_set)
         for plant, geneid_set in plant_to_geneid.items()
     }
-    return plant_to_geneid, geneid_commonname_pmid, commonname_to_relation
-
-
-plant_to_geneid, geneid_commonname_pmid, commonname_to_relation = get_global_data()
+    return plant_to_geneid, geneid_commonname_pmid, commonname_to_relation, None
+
+
+def get_relation_datum_list(commonname):
+    # csv data stores decoded relation tuples; columnar data stores row indices;
+    # both give the distinct relations in file order
+    relation_list = commonname_to_relation.get(commonname, [])
+    if relation_table is None:
+        return list(relation_list)
+    relation_codes, relation_dictionary = relation_table
+    return list(dict.fromkeys(
+        get_relation_datum(
+            relation_column_list, get_columnar_row(relation_codes, relation_dictionary, relation_column_list, ri),
+        )
+        for ri in relation_list
+    ))
+
+
+def get_data(data_format, columnar_dir):
+    if data_format == "columnar":
+        return get_global_data_from_columnar(columnar_dir)
+    return get_global_data()
+
+
+def get_relation_datum(header, row):
+    # a relation is simple when its head and tail are exactly the two entities (perfect_match of spacy_openrel_tool);
+    # gene_id/main_2023.py does not write the column, so it is derived here
+    if header == legacy_relation_column_list:
+        return tuple(row)
+    (
+        head, relation, tail,
+        head_entity, head_type,
+        tail_entity, tail_type,
+        pmid, sentence,
+    ) = row
+    simple = "T" if head == head_entity and tail == tail_entity else "F"
+    return (
+        head, relation, tail,
+        head_entity, head_type,
+        tail_entity, tail_type,
+        simple, pmid, sentence,
+    )
+
+
+# commonname_relation columns; must equal relation_header of gene_id/main_2023.py, which writes both table formats
+relation_column_list = [
+    "head", "relation", "tail",
+    "head_entity", "head_type",
+    "tail_entity", "tail_type",
+    "pmid", "sentence",
+]
+# older CSVs with a stored simple column
+legacy_relation_column_list = relation_column_list[:7] + ["simple"] + relation_column_list[7:]
+
+# Loaded at import time, so the app has its data however it is served (python server.py, a WSGI server, ...);
+# GENEID_DATA_FORMAT=columnar and GENEID_COLUMNAR_DIR select the columnar tables
+data_format = os.environ.get("GENEID_DATA_FORMAT", "csv")
+columnar_dir = os.environ.get("GENEID_COLUMNAR_DIR", "columnar")
+plant_to_geneid, geneid_commonname_pmid, commonname_to_relation, relation_table = get_data(data_format, columnar_dir)
 
 
 @app.route("/")
@@ -103,7 +260,11 @@ def run_load_gene_list():
 @app.route("/run_generate_graph", methods=["POST"])
 def run_generate_graph():
     data = json.loads(request.data)
+    response = generate_graph(data["geneid"])
+    return json.dumps(response)
+
 
+def generate_graph(geneid):
     type_to_color = {
         "GeneID": "#d5abff",  # 270°, 33%, 100% violet
         "CommonName": "#abffff",  # 180°, 33%, 100% cyan
@@ -136,7 +297,6 @@ def run_generate_graph():
     pair_to_width = defaultdict(lambda: 0)
 
     # GeneID
-    geneid = data["geneid"]
     name_to_nid[geneid] = 0
     node_list.append({"id": 0, "label": geneid, "color": type_to_color["GeneID"]})
     edge_list.append({"from": 0, "to": -1})
@@ -157,7 +317,7 @@ def run_generate_graph():
 
     # Entity relations
     for commonname in commonname_to_pmid_set:
-        for relation_datum in commonname_to_relation.get(commonname, []):
+        for relation_datum in get_relation_datum_list(commonname):
             (
                 head, relation, tail,
                 head_entity, head_type,
@@ -207,19 +367,57 @@ def run_generate_graph():
         "node_list": node_list,
         "edge_list": edge_list,
     }
-    return json.dumps(response)
+    return response
+
+
+def check_data(data_list, max_geneids):
+    # build graphs from every loaded data set and check that they agree
+    global plant_to_geneid, geneid_commonname_pmid, commonname_to_relation, relation_table
+    geneid_list = sorted({
+        geneid
+        for geneid_list in data_list[0][0].values()
+        for geneid in geneid_list
+    })[:max_geneids]
+
+    graph_list_list = []
+    for data in data_list:
+        plant_to_geneid, geneid_commonname_pmid, commonname_to_relation, relation_table = data
+        graph_list_list.append([generate_graph(geneid) for geneid in geneid_list])
+
+    edges = sum(len(graph["edge_list"]) for graph in graph_list_list[0])
+    if any(graph_list != graph_list_list[0] for graph_list in graph_list_list[1:]):
+        logger.error("Graphs differ across data formats")
+        return False
+    logger.info(f"Built {len(geneid_list):,} GeneID graphs with {edges:,} edges; identical across data formats")
+    return True
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-host", default="0.0.0.0")
     parser.add_argument("-port", default="12345")
+    parser.add_argument("-data_format", default=data_format, choices=["csv", "columnar"])
+    parser.add_argument("-columnar_dir", default=columnar_dir)
+    # build graphs from the CSVs and the columnar tables, compare them, and exit
+    parser.add_argument("-check", action="store_true")
+    parser.add_argument("-check_geneids", type=int, default=1000)
     arg = parser.parse_args()
 
+    global plant_to_geneid, geneid_commonname_pmid, commonname_to_relation, relation_table
+    data = plant_to_geneid, geneid_commonname_pmid, commonname_to_relation, relation_table
+    if arg.check:
+        other_format = "columnar" if data_format == "csv" else "csv"
+        data_list = [data, get_data(other_format, arg.columnar_dir)]
+        return 0 if check_data(data_list, arg.check_geneids) else 1
+
+    # data from the command line options, if they differ from the import-time ones
+    if (arg.data_format, arg.columnar_dir) != (data_format, columnar_dir):
+        data = get_data(arg.data_format, arg.columnar_dir)
+        plant_to_geneid, geneid_commonname_pmid, commonname_to_relation, relation_table = data
+
     app.run(host=arg.host, port=arg.port)
     return
 
 
 if __name__ == "__main__":
-    main()
-    sys.exit()
+    sys.exit(main())
@@ -0,0 +1,150 @@
+""" Vectorized BIO decoding of label-id arrays into word-level labels and mention spans. """
+
+
+from itertools import chain
+from typing import Callable, Dict, List, Sequence, Tuple
+
+import numpy as np
+
+
+O_KIND, B_KIND, I_KIND = 0, 1, 2
+
+
+def get_default_type(label: str) -> str:
+    return label[2:]
+
+
+class BioDecoder:
+    """
+    Decodes a whole batch of BIO label ids at once, instead of one word at a time.
+
+    A batch is either a padded (sequences, max_length) array of label ids with a word mask,
+    e.g. the argmax of token classification logits and label_ids != ignore_index,
+    or the flat label ids of all words with the number of words of every sentence.
+
+    Mention spans follow the decoding tool/main.py has always used:
+    a mention begins at a B label and continues through I labels of the same type;
+    another B label or an O label closes it, an I label of another type discards it;
+    a mention that begins at the first word is only kept when it reaches the end of the sentence.
+    """
+
+    def __init__(self, label_list: Sequence[str] = (), get_type: Callable[[str], str] = get_default_type):
+        self.get_type = get_type
+        self.label_list: List[str] = []
+        self.label_to_id: Dict[str, int] = {}
+        self.type_list: List[str] = []
+        self.type_to_id: Dict[str, int] = {}
+        kind_list = []
+        type_id_list = []
+        for label in label_list:
+            self.add_label(label, kind_list, type_id_list)
+        self.set_label_arrays(kind_list, type_id_list)
+
+    def add_label(self, label: str, kind_list: List[int], type_id_list: List[int]):
+        self.label_to_id[label] = len(self.label_list)
+        self.label_list.append(label)
+
+        if label[0] == "O":
+            kind_list.append(O_KIND)
+            type_id_list.append(-1)
+            return
+        kind_list.append(B_KIND if label[0] == "B" else I_KIND)
+        mention_type = self.get_type(label)
+        if mention_type not in self.type_to_id:
+            self.type_to_id[mention_type] = len(self.type_list)
+            self.type_list.append(mention_type)
+        type_id_list.append(self.type_to_id[mention_type])
+        return
+
+    def set_label_arrays(self, kind_list: List[int], type_id_list: List[int]):
+        self.label_array = np.array(self.label_list, dtype=object)
+        self.type_array = np.array(self.type_list, dtype=object)
+        self.label_to_kind = np.array(kind_list, dtype=np.int8)
+        self.label_to_type_id = np.array(type_id_list, dtype=np.int64)
+        return
+
+    def get_label_ids(self, labellist_list: List[List[str]]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the flat label ids and the lengths of label strings, e.g. tags from a model output file.
+        Labels outside label_list are added on the fly.
+        """
+        label_list = list(chain.from_iterable(labellist_list))
+        new_label_set = set(label_list) - self.label_to_id.keys()
+        if new_label_set:
+            kind_list = self.label_to_kind.tolist()
+            type_id_list = self.label_to_type_id.tolist()
+            for label in sorted(new_label_set):
+                self.add_label(label, kind_list, type_id_list)
+            self.set_label_arrays(kind_list, type_id_list)
+
+        label_ids = np.array(list(map(self.label_to_id.__getitem__, label_list)), dtype=np.int64)
+        lengths = np.array([len(label_list) for label_list in labellist_list], dtype=np.int64)
+        return label_ids, lengths
+
+    @staticmethod
+    def get_word_label_ids(label_ids: np.ndarray, word_mask: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # the label ids of masked-in positions, row by row, and the number of words of every row
+        return label_ids[word_mask], word_mask.sum(axis=1)
+
+    def get_label_list_list(self, label_ids: np.ndarray, lengths: np.ndarray) -> List[List[str]]:
+        label_list = self.label_array[label_ids].tolist()
+        end_list = np.cumsum(lengths).tolist()
+        return [label_list[j - length:j] for j, length in zip(end_list, lengths.tolist())]
+
+    def get_span_arrays(self, label_ids: np.ndarray, lengths: np.ndarray) -> Tuple[np.ndarray, ...]:
+        """
+        Returns (sentence index, begin, end, type id) arrays of all mentions, ordered by sentence and begin;
+        begin and end are word positions within the sentence, end exclusive.
+        """
+        words = len(label_ids)
+        kind = self.label_to_kind[label_ids]
+        type_id = self.label_to_type_id[label_ids]
+        sentence_start = np.cumsum(lengths) - lengths
+        sentence_index = np.repeat(np.arange(len(lengths)), lengths)
+        position = np.arange(words) - sentence_start[sentence_index]
+
+        # an I label continues the mention of the previous word when the types match;
+        # every other word ends whatever mention came before it
+        continues = np.zeros(words, dtype=bool)
+        continues[1:] = (kind[1:] == I_KIND) & (type_id[1:] == type_id[:-1])
+        continues &= position > 0
+        stop_array = np.append(np.flatnonzero(~continues), words)
+
+        begin = np.flatnonzero(kind == B_KIND)
+        end = stop_array[np.searchsorted(stop_array, begin, side="right")]
+        sentence_end = (sentence_start + lengths)[sentence_index[begin]]
+        at_sentence_end = end == sentence_end
+        stop_kind = kind[np.minimum(end, words - 1)]
+        keep = at_sentence_end | (stop_kind != I_KIND)
+
+        # a mention at the first word is neither closed nor discarded by later labels;
+        # it is kept, up to the end of the sentence, when no later B or O label resets it
+        first = position[begin] == 0
+        resets = np.bincount(sentence_index, weights=(kind != I_KIND) & (position > 0), minlength=len(lengths))
+        keep[first] = resets[sentence_index[begin[first]]] == 0
+        end[first] = sentence_end[first]
+
+        begin, end = begin[keep], end[keep]
+        mention_sentence_index = sentence_index[begin]
+        mention_start = sentence_start[mention_sentence_index]
+        return mention_sentence_index, begin - mention_start, end - mention_start, type_id[begin]
+
+    def get_mention_list_list(self, label_ids: np.ndarray, lengths: np.ndarray) -> List[List[Dict]]:
+        # token-position mention_list of every sentence: [{"pos": [begin, end], "type": type}, ...]
+        mentionlist_list = [[] for _ in range(len(lengths))]
+        if len(label_ids) == 0:
+            return mentionlist_list
+        sentence_index, begin, end, type_id = self.get_span_arrays(label_ids, lengths)
+        mention_list = [
+            {"pos": [b, e], "type": mention_type}
+            for b, e, mention_type in zip(begin.tolist(), end.tolist(), self.type_array[type_id].tolist())
+        ]
+
+        # mentions are ordered by sentence, so every sentence takes one slice
+        mention_end_list = np.searchsorted(sentence_index, np.arange(1, len(lengths) + 1)).tolist()
+        mention_start = 0
+        for si, mention_end in enumerate(mention_end_list):
+            if mention_end > mention_start:
+                mentionlist_list[si] = mention_list[mention_start:mention_end]
+                mention_start = mention_end
+        return mentionlist_list
@@ -0,0 +1,157 @@
+""" Accuracy gate and throughput benchmark of NerEngine runtimes against the fp32 predictions of run_ner.py. """
+
+
+import argparse
+import logging
+import os
+import sys
+import time
+from typing import List
+
+import torch
+from seqeval.metrics import f1_score
+
+from ner_engine import NerEngine
+from utils_ner import Split, read_examples_from_file
+
+
+logger = logging.getLogger(__name__)
+
+
+def read_prediction_file(file_path: str) -> List[List[str]]:
+    # test_predictions.txt: "word tag" lines, sentences separated by blank lines
+    tag_list_list = []
+    with open(file_path, encoding="utf-8") as f:
+        tag_list = []
+        for line in f:
+            if line.startswith("-DOCSTART-") or line == "" or line == "\n":
+                if tag_list:
+                    tag_list_list.append(tag_list)
+                    tag_list = []
+            else:
+                tag_list.append(line.split()[-1])
+        if tag_list:
+            tag_list_list.append(tag_list)
+    return tag_list_list
+
+
+def normalize_tag(tag: str) -> str:
+    # test.txt and labels.txt use "B-CommonName", get_labels() and the predictions "B-CommonName-bio";
+    # seqeval counts the two as different entity types, so everything is scored without "-bio"
+    return tag[:-len("-bio")] if tag.endswith("-bio") else tag
+
+
+def pad_tag_list_list(tag_list_list, word_list_list):
+    # one tag scheme for gold and predicted tags;
+    # words beyond max_seq_length wordpieces have no prediction; count them as O
+    return [
+        [normalize_tag(tag) for tag in tag_list] + ["O"] * (len(word_list) - len(tag_list))
+        for tag_list, word_list in zip(tag_list_list, word_list_list)
+    ]
+
+
+def run_runtime(args, runtime, word_list_list):
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    export_prefix = None
+    if runtime == "torchscript":
+        export_prefix = os.path.join(args.export_dir, f"model.torchscript.{args.max_seq_length}")
+    engine = NerEngine(
+        args.model_dir,
+        args.labels,
+        max_seq_length=args.max_seq_length,
+        batch_size=args.batch_size,
+        max_tokens=args.max_tokens,
+        runtime=runtime,
+        export_prefix=export_prefix,
+        device="cpu",
+    )
+
+    # the fast tokenizer is checked on the whole test set, then the timed run skips the check
+    engine.validate(word_list_list)
+    # warm-up, including TorchScript tracing of the padded lengths
+    engine.predict(word_list_list[:1000])
+
+    start_time = time.perf_counter()
+    tag_list_list = engine.predict(word_list_list)
+    seconds = time.perf_counter() - start_time
+
+    words = sum(len(word_list) for word_list in word_list_list)
+    result = {
+        "seconds": seconds,
+        "words_per_second": words / seconds,
+        "wordpieces_per_second": engine.wordpieces / seconds,
+    }
+    return pad_tag_list_list(tag_list_list, word_list_list), result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    data_dir = os.path.join("..", "datasets", "NER", "plant_20210831")
+    parser.add_argument("--data_dir", type=str, default=data_dir)
+    parser.add_argument("--labels", type=str, default=os.path.join(data_dir, "labels.txt"))
+    parser.add_argument("--model_dir", type=str, default=os.path.join("output_20210831", "plant_20210831"))
+    # fp32 predictions of run_ner.py made with the same max_seq_length
+    parser.add_argument("--prediction_file", type=str, default=None)
+    parser.add_argument("--export_dir", type=str, default=os.path.join("output_20210831", "plant_20210831"))
+    # the max_sentence_pieces of tool/main.py, so the checked TorchScript export is the deployed one
+    parser.add_argument("--max_seq_length", type=int, default=128)
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--max_tokens", type=int, default=4096)
+    parser.add_argument("--threads", type=int, default=0)
+    parser.add_argument("--runtime", type=str, nargs="+", default=["pytorch", "quantized", "torchscript"])
+    # a runtime passes if its test F1 is within max_f1_drop of the fp32 F1
+    # and its entity-level F1 against the fp32 predictions is at least min_agreement_f1
+    parser.add_argument("--max_f1_drop", type=float, default=0.005)
+    parser.add_argument("--min_agreement_f1", type=float, default=0.99)
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+    prediction_file = args.prediction_file or os.path.join(args.model_dir, "test_predictions.txt")
+
+    examples = read_examples_from_file(args.data_dir, Split.test)
+    word_list_list = [example.words for example in examples]
+    gold_list_list = pad_tag_list_list([example.labels for example in examples], word_list_list)
+    fp32_list_list = pad_tag_list_list(read_prediction_file(prediction_file), word_list_list)
+    assert len(fp32_list_list) == len(gold_list_list)
+    fp32_f1 = f1_score(gold_list_list, fp32_list_list)
+    logger.info(f"[fp32 {prediction_file}] test F1 {fp32_f1:.4f}")
+    if fp32_f1 == 0:
+        logger.error(f"fp32 predictions match no gold mention; check the tag scheme and length of {prediction_file}")
+        return 1
+
+    failed_runtime_list = []
+    baseline_words_per_second = None
+    for runtime in args.runtime:
+        tag_list_list, result = run_runtime(args, runtime, word_list_list)
+        f1 = f1_score(gold_list_list, tag_list_list)
+        # entity-level agreement with the fp32 predictions
+        agreement_f1 = f1_score(fp32_list_list, tag_list_list)
+        if baseline_words_per_second is None:
+            baseline_words_per_second = result["words_per_second"]
+        passed = f1 >= fp32_f1 - args.max_f1_drop and agreement_f1 >= args.min_agreement_f1
+        if not passed:
+            failed_runtime_list.append(runtime)
+        logger.info(
+            f"[{runtime}] test F1 {f1:.4f} ({f1 - fp32_f1:+.4f} vs fp32; {'pass' if passed else 'FAIL'});"
+            f" F1 against fp32 predictions {agreement_f1:.4f};"
+            f" {result['words_per_second']:,.0f} words/s;"
+            f" {result['wordpieces_per_second']:,.0f} wordpieces/s;"
+            f" {result['words_per_second'] / baseline_words_per_second:.2f}x {args.runtime[0]}"
+        )
+
+    if failed_runtime_list:
+        logger.error(
+            f"F1 drops more than {args.max_f1_drop} or agreement F1 is below {args.min_agreement_f1}"
+            f" for {failed_runtime_list}"
+        )
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
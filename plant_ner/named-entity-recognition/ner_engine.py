@@ -0,0 +1,472 @@
+""" In-process inference for a token classification model trained by run_ner.py. """
+
+
+import os
+import time
+import inspect
+import logging
+from collections import defaultdict
+from typing import List, Optional
+
+import numpy as np
+import torch
+from torch import nn
+
+from transformers import AutoConfig, AutoModelForTokenClassification, AutoTokenizer
+from bio_decoder import BioDecoder
+from utils_ner import InputExample, convert_examples_to_features, get_labels
+
+
+logger = logging.getLogger(__name__)
+
+
+class NerEngine:
+    """
+    Loads the model and tokenizer once and predicts tags for many batches of sentences.
+
+    Features, labels and predictions are the same as `run_ner.py --do_predict`,
+    without rebuilding a Trainer and re-reading the model for every batch file.
+    Inference batches are bucketed by wordpiece length and padded to their own longest example,
+    instead of max_seq_length; the attention mask keeps per-token logits unchanged.
+    With pack=True, several short sequences share one max_seq_length window instead:
+    a block-diagonal attention mask keeps them from attending to each other
+    and position ids restart at every sequence, so each sequence sees the same input as unpacked.
+    Features come from one batched fast-tokenizer call when it reproduces the word-by-word features.
+    Both shortcuts are checked against the plain path on whole batches:
+    the first predict() call, every call with validate_every_batch=True, or explicitly with validate().
+    """
+
+    pad_token_label_id: int = nn.CrossEntropyLoss().ignore_index
+
+    def __init__(
+        self,
+        model_dir: str,
+        label_file: str,
+        max_seq_length: int = 128,
+        batch_size: int = 64,
+        max_tokens: Optional[int] = 4096,
+        pack: bool = False,
+        validate_every_batch: bool = False,
+        fast_tokenizer: bool = True,
+        runtime: str = "pytorch",
+        export_prefix: Optional[str] = None,
+        device: Optional[str] = None,
+    ):
+        self.labels = get_labels(label_file)
+        self.label_map = {i: label for i, label in enumerate(self.labels)}
+        self.bio_decoder = BioDecoder(self.labels)
+        self.max_seq_length = max_seq_length
+        self.batch_size = batch_size
+        # token budget of a batch: examples x padded length
+        self.max_tokens = max_tokens if max_tokens is not None else batch_size * max_seq_length
+        # pack: short sequences share max_seq_length windows
+        # fast_tokenizer: features from one batched call of the fast tokenizer
+        # the first predict() call (every call with validate_every_batch) checks both against the plain path
+        # on all its sequences, predicts that batch with the plain path,
+        # and falls back to the plain path for the rest of the run on any difference
+        self.pack = pack
+        self.validate_every_batch = validate_every_batch
+        self.pack_validated = False
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.device = torch.device(device)
+        # runtime:
+        #   pytorch: the fp32 checkpoint as trained
+        #   quantized: dynamic int8 quantization of all linear layers, CPU only
+        #   torchscript: the quantized model traced into TorchScript graphs (saved to / loaded from
+        #     {export_prefix}.{length}.pt); traced shapes are not reliable across sequence lengths,
+        #     so batches are padded to multiples of length_step and there is one graph per padded length
+        assert runtime in ["pytorch", "quantized", "torchscript"]
+        assert runtime == "pytorch" or self.device.type == "cpu"
+        assert not (runtime == "torchscript" and pack)
+        self.runtime = runtime
+        self.length_step = 32 if runtime == "torchscript" else 1
+        self.export_prefix = export_prefix
+        self.traced_model = {}
+
+        config = AutoConfig.from_pretrained(
+            model_dir,
+            num_labels=len(self.labels),
+            id2label=self.label_map,
+            label2id={label: i for i, label in enumerate(self.labels)},
+        )
+        config.torchscript = runtime == "torchscript"
+        self.model_type = config.model_type
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir, use_fast=False)
+        self.fast_tokenizer = AutoTokenizer.from_pretrained(model_dir, use_fast=True) if fast_tokenizer else None
+        self.fast_tokenizer_validated = False
+        self.model = AutoModelForTokenClassification.from_pretrained(model_dir, config=config)
+        self.model.to(self.device)
+        self.model.eval()
+        if runtime in ["quantized", "torchscript"]:
+            self.model = torch.quantization.quantize_dynamic(self.model, {nn.Linear}, dtype=torch.qint8)
+        logger.info(f"Loaded {model_dir} on {self.device} ({runtime})")
+
+    def get_torchscript_model(self, length):
+        # the graph traced for batches padded to length, loaded or traced on first use
+        model = self.traced_model.get(length)
+        if model is not None:
+            return model
+        export_file = None if self.export_prefix is None else f"{self.export_prefix}.{length}.pt"
+        if export_file is not None and os.path.exists(export_file):
+            logger.info(f"Loading TorchScript model from {export_file}")
+            model = torch.jit.load(export_file)
+            self.traced_model[length] = model
+            return model
+
+        shape = (2, length)
+        example_input = (
+            torch.full(shape, self.tokenizer.unk_token_id, dtype=torch.long),
+            torch.ones(shape, dtype=torch.long),
+            torch.zeros(shape, dtype=torch.long),
+        )
+        with torch.no_grad():
+            model = torch.jit.trace(self.model, example_input)
+        if export_file is not None:
+            torch.jit.save(model, export_file)
+            logger.info(f"Saved TorchScript model to {export_file}")
+        self.traced_model[length] = model
+        return model
+
+    def get_logits(self, inputs):
+        if self.runtime == "torchscript":
+            # a traced graph takes positional inputs
+            model = self.get_torchscript_model(inputs["input_ids"].shape[1])
+            return model(inputs["input_ids"], inputs["attention_mask"], inputs["token_type_ids"])[0]
+        return self.model(**inputs)[0]
+
+    def convert_token_lists_to_features(self, tokenlist_list: List[List[str]]):
+        """
+        Word-by-word features of utils_ner.convert_examples_to_features(), as arrays of shape (examples, max_seq_length).
+        """
+        examples = [
+            InputExample(guid=f"test-{i + 1}", words=token_list, labels=["O"] * len(token_list))
+            for i, token_list in enumerate(tokenlist_list)
+        ]
+        features = convert_examples_to_features(
+            examples,
+            self.labels,
+            self.max_seq_length,
+            self.tokenizer,
+            cls_token_at_end=bool(self.model_type in ["xlnet"]),
+            cls_token=self.tokenizer.cls_token,
+            cls_token_segment_id=2 if self.model_type in ["xlnet"] else 0,
+            sep_token=self.tokenizer.sep_token,
+            sep_token_extra=False,
+            pad_on_left=bool(self.tokenizer.padding_side == "left"),
+            pad_token=self.tokenizer.pad_token_id,
+            pad_token_segment_id=self.tokenizer.pad_token_type_id,
+            pad_token_label_id=self.pad_token_label_id,
+        )
+        feature_arrays = {
+            "input_ids": np.array([f.input_ids for f in features], dtype=np.int64),
+            "attention_mask": np.array([f.attention_mask for f in features], dtype=np.int64),
+            "label_ids": np.array([f.label_ids for f in features], dtype=np.int64),
+        }
+        if features[0].token_type_ids is not None:
+            feature_arrays["token_type_ids"] = np.array([f.token_type_ids for f in features], dtype=np.int64)
+        return feature_arrays
+
+    def convert_token_lists_to_features_fast(self, tokenlist_list: List[List[str]]):
+        """
+        Same arrays as convert_token_lists_to_features() for BERT-style models,
+        from one batched call of the fast tokenizer on pre-split words and its word ids.
+        """
+        assert self.model_type not in ["xlnet"] and self.tokenizer.padding_side != "left"
+        tokenizer = self.fast_tokenizer
+        encoding = tokenizer(tokenlist_list, add_special_tokens=False, **get_split_into_words_kwargs(tokenizer))
+        get_word_ids = encoding.word_ids if hasattr(encoding, "word_ids") else encoding.words
+
+        examples = len(tokenlist_list)
+        body = self.max_seq_length - 2
+        input_ids = np.full((examples, self.max_seq_length), tokenizer.pad_token_id, dtype=np.int64)
+        attention_mask = np.zeros((examples, self.max_seq_length), dtype=np.int64)
+        token_type_ids = np.full((examples, self.max_seq_length), tokenizer.pad_token_type_id, dtype=np.int64)
+        label_ids = np.full((examples, self.max_seq_length), self.pad_token_label_id, dtype=np.int64)
+        o_id = self.labels.index("O")
+
+        for i in range(examples):
+            piece_ids = encoding["input_ids"][i][:body]
+            word_ids = np.array(get_word_ids(i)[:body], dtype=np.int64)
+            n = len(piece_ids)
+            input_ids[i, 0] = tokenizer.cls_token_id
+            input_ids[i, 1:n + 1] = piece_ids
+            input_ids[i, n + 1] = tokenizer.sep_token_id
+            attention_mask[i, :n + 2] = 1
+            token_type_ids[i, :n + 2] = 0
+            # the first piece of every word carries its label; words without pieces are skipped as in utils_ner
+            first_piece = np.ones(n, dtype=bool)
+            first_piece[1:] = word_ids[1:] != word_ids[:-1]
+            label_ids[i, 1:n + 1][first_piece] = o_id
+
+        feature_arrays = {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "label_ids": label_ids,
+        }
+        if "token_type_ids" in tokenizer.model_input_names:
+            feature_arrays["token_type_ids"] = token_type_ids
+        return feature_arrays
+
+    def validate_fast_tokenizer(self, tokenlist_list):
+        # compares fast and word-by-word features of all sequences and returns the word-by-word ones;
+        # falls back to the word-by-word tokenizer for the rest of the run if any feature differs
+        slow = self.convert_token_lists_to_features(tokenlist_list)
+        fast = self.convert_token_lists_to_features_fast(tokenlist_list)
+        same = slow.keys() == fast.keys() and all(np.array_equal(slow[k], fast[k]) for k in slow)
+        if not same:
+            logger.warning(f"Fast tokenizer features differ on {len(tokenlist_list):,} sequences; using slow tokenizer")
+            self.fast_tokenizer = None
+        elif not self.fast_tokenizer_validated:
+            logger.info(f"Fast tokenizer features are identical on {len(tokenlist_list):,} sequences")
+        self.fast_tokenizer_validated = True
+        return slow
+
+    def get_features(self, tokenlist_list: List[List[str]]):
+        if self.fast_tokenizer is None:
+            return self.convert_token_lists_to_features(tokenlist_list)
+        if self.validate_every_batch or not self.fast_tokenizer_validated:
+            return self.validate_fast_tokenizer(tokenlist_list)
+        return self.convert_token_lists_to_features_fast(tokenlist_list)
+
+    def get_length_batch_list(self, length_array):
+        """
+        Sorts examples by wordpiece length and groups them under a token budget:
+        a batch of n examples padded to length L costs n * L tokens.
+        Returns (example indices, padded length) per batch.
+        """
+        batch_list = []
+        batch = []
+        batch_length = 0
+
+        for i in np.argsort(length_array, kind="stable"):
+            # padded length: the example's own, or for torchscript the next multiple of length_step
+            length = min(-(-int(length_array[i]) // self.length_step) * self.length_step, self.max_seq_length)
+            if batch and (
+                len(batch) >= self.batch_size
+                or (len(batch) + 1) * max(batch_length, length) > self.max_tokens
+            ):
+                batch_list.append((batch, batch_length))
+                batch = []
+                batch_length = 0
+            batch.append(i)
+            batch_length = max(batch_length, length)
+
+        if batch:
+            batch_list.append((batch, batch_length))
+        return batch_list
+
+    def predict_label_ids(self, features):
+        """
+        Returns the predicted label id of every position, shape (examples, max_seq_length).
+        Each batch is padded only to its longest example; positions beyond it keep the pad label id.
+        """
+        input_ids = features["input_ids"]
+        attention_mask = features["attention_mask"]
+        token_type_ids = features.get("token_type_ids")
+
+        length_array = attention_mask.sum(axis=1)
+        batch_list = self.get_length_batch_list(length_array)
+        pred_ids = np.full(input_ids.shape, self.pad_token_label_id, dtype=np.int64)
+
+        # padding of fixed max_seq_length batches vs. length-bucketed batches
+        real_tokens = int(length_array.sum())
+        self.wordpieces = real_tokens
+        padded_tokens = sum(len(batch) * length for batch, length in batch_list)
+        self.padded_wordpieces = padded_tokens
+        self.padding_ratio_before = 1 - real_tokens / input_ids.size
+        self.padding_ratio_after = 1 - real_tokens / padded_tokens
+        logger.info(
+            f"{len(input_ids):,} sequences; {len(batch_list):,} batches;"
+            f" padding ratio {self.padding_ratio_before:.2%} -> {self.padding_ratio_after:.2%}"
+        )
+
+        pad_on_left = self.tokenizer.padding_side == "left"
+        with torch.no_grad():
+            for batch, length in batch_list:
+                # features are padded to max_seq_length, so a batch is a slice of the longest example's length
+                columns = slice(input_ids.shape[1] - length, None) if pad_on_left else slice(0, length)
+                inputs = {
+                    "input_ids": torch.from_numpy(input_ids[batch, columns]),
+                    "attention_mask": torch.from_numpy(attention_mask[batch, columns]),
+                }
+                if token_type_ids is not None:
+                    inputs["token_type_ids"] = torch.from_numpy(token_type_ids[batch, columns])
+                inputs = {k: v.to(self.device) for k, v in inputs.items()}
+                logits = self.get_logits(inputs)
+                pred_ids[np.ix_(batch, np.arange(input_ids.shape[1])[columns])] = logits.argmax(dim=2).cpu().numpy()
+        return pred_ids
+
+    def get_pack_window_list(self, length_array):
+        """
+        Best-fit decreasing: every sequence goes to the open window with the least room that still fits it.
+        Returns, per window, a list of (example index, offset in window).
+        """
+        window_list = []
+        window_fill = []
+        room_to_window = defaultdict(list)
+
+        for i in np.argsort(-length_array, kind="stable"):
+            length = int(length_array[i])
+            for room in range(length, self.max_seq_length + 1):
+                if room_to_window[room]:
+                    w = room_to_window[room].pop()
+                    break
+            else:
+                w = len(window_list)
+                window_list.append([])
+                window_fill.append(0)
+                room = self.max_seq_length
+            window_list[w].append((i, window_fill[w]))
+            window_fill[w] += length
+            room_to_window[room - length].append(w)
+
+        return window_list, window_fill
+
+    def predict_label_ids_packed(self, features):
+        """
+        Same output as predict_label_ids(), computed on packed windows.
+        """
+        assert self.tokenizer.padding_side != "left"
+        input_ids = features["input_ids"]
+        attention_mask = features["attention_mask"]
+        token_type_ids = features.get("token_type_ids")
+        if token_type_ids is None:
+            token_type_ids = np.zeros(input_ids.shape, dtype=np.int64)
+
+        length_array = attention_mask.sum(axis=1)
+        window_list, window_fill = self.get_pack_window_list(length_array)
+        windows_per_batch = max(1, min(self.batch_size, self.max_tokens // self.max_seq_length))
+        pred_ids = np.full(input_ids.shape, self.pad_token_label_id, dtype=np.int64)
+
+        real_tokens = int(length_array.sum())
+        self.wordpieces = real_tokens
+        padded_tokens = 0
+        with torch.no_grad():
+            for wi in range(0, len(window_list), windows_per_batch):
+                batch_window_list = window_list[wi:wi + windows_per_batch]
+                length = max(window_fill[wi:wi + windows_per_batch])
+                padded_tokens += len(batch_window_list) * length
+
+                batch_input_ids = np.full((len(batch_window_list), length), self.tokenizer.pad_token_id, dtype=np.int64)
+                batch_token_type_ids = np.full(
+                    (len(batch_window_list), length), self.tokenizer.pad_token_type_id, dtype=np.int64,
+                )
+                batch_position_ids = np.zeros((len(batch_window_list), length), dtype=np.int64)
+                batch_segment = np.full((len(batch_window_list), length), -1, dtype=np.int64)
+                for b, window in enumerate(batch_window_list):
+                    for si, (i, offset) in enumerate(window):
+                        n = length_array[i]
+                        batch_input_ids[b, offset:offset + n] = input_ids[i, :n]
+                        batch_token_type_ids[b, offset:offset + n] = token_type_ids[i, :n]
+                        batch_position_ids[b, offset:offset + n] = np.arange(n)
+                        batch_segment[b, offset:offset + n] = si
+
+                # (batch, from, to): a position attends only to positions of its own sequence
+                batch_attention_mask = (
+                    (batch_segment[:, :, None] == batch_segment[:, None, :]) & (batch_segment[:, :, None] >= 0)
+                ).astype(np.int64)
+
+                inputs = {
+                    "input_ids": torch.from_numpy(batch_input_ids),
+                    "attention_mask": torch.from_numpy(batch_attention_mask),
+                    "token_type_ids": torch.from_numpy(batch_token_type_ids),
+                    "position_ids": torch.from_numpy(batch_position_ids),
+                }
+                inputs = {k: v.to(self.device) for k, v in inputs.items()}
+                window_pred_ids = self.get_logits(inputs).argmax(dim=2).cpu().numpy()
+
+                for b, window in enumerate(batch_window_list):
+                    for i, offset in window:
+                        n = length_array[i]
+                        pred_ids[i, :n] = window_pred_ids[b, offset:offset + n]
+
+        self.padded_wordpieces = padded_tokens
+        self.padding_ratio_before = 1 - real_tokens / input_ids.size
+        self.padding_ratio_after = 1 - real_tokens / max(padded_tokens, 1)
+        logger.info(
+            f"{len(input_ids):,} sequences packed into {len(window_list):,} windows;"
+            f" padding ratio {self.padding_ratio_before:.2%} -> {self.padding_ratio_after:.2%}"
+        )
+        return pred_ids
+
+    def validate_packing(self, features):
+        # packed vs. unpacked predictions of all sequences, compared on word positions; returns the unpacked ones;
+        # turns packing off for the rest of the run if any prediction differs
+        word_mask = features["label_ids"] != self.pad_token_label_id
+        packed = self.predict_label_ids_packed(features)[word_mask]
+        pred_ids = self.predict_label_ids(features)
+        unpacked = pred_ids[word_mask]
+        agreement = float((packed == unpacked).mean()) if packed.size else 1.0
+        if agreement < 1:
+            logger.warning(
+                f"Packed predictions agree with unpacked ones on {agreement:.4%} of {packed.size:,} words;"
+                f" not packing"
+            )
+            self.pack = False
+        elif not self.pack_validated:
+            logger.info(f"Packed predictions agree with unpacked ones on all {packed.size:,} words")
+        self.pack_validated = True
+        return pred_ids
+
+    def validate(self, tokenlist_list: List[List[str]]):
+        """
+        Checks the fast tokenizer and packing against the plain path on all given sentences, e.g. a devel set,
+        before a run; a shortcut that differs is turned off.
+        Returns which shortcuts remain on.
+        """
+        if self.fast_tokenizer is None:
+            features = self.convert_token_lists_to_features(tokenlist_list)
+        else:
+            features = self.validate_fast_tokenizer(tokenlist_list)
+        if self.pack:
+            self.validate_packing(features)
+        return {"fast_tokenizer": self.fast_tokenizer is not None, "pack": self.pack}
+
+    def predict(self, tokenlist_list: List[List[str]]) -> List[List[str]]:
+        """
+        Returns one tag per word for every sentence, in input order.
+        Words beyond max_seq_length wordpieces get no tag, as in run_ner.py.
+        Counts and stage timings of the call are left in self.metrics.
+        """
+        self.metrics = {
+            "sequences": len(tokenlist_list),
+            "wordpieces": 0,
+            "padded_wordpieces": 0,
+            "max_length_wordpieces": 0,
+            "tokenize_seconds": 0.0,
+            "forward_seconds": 0.0,
+            "decode_seconds": 0.0,
+        }
+        if not tokenlist_list:
+            return []
+
+        start_time = time.perf_counter()
+        features = self.get_features(tokenlist_list)
+        self.metrics["tokenize_seconds"] = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        if self.pack and (self.validate_every_batch or not self.pack_validated):
+            preds = self.validate_packing(features)
+        elif self.pack:
+            preds = self.predict_label_ids_packed(features)
+        else:
+            preds = self.predict_label_ids(features)
+        self.metrics["forward_seconds"] = time.perf_counter() - start_time
+        self.metrics["wordpieces"] = self.wordpieces
+        self.metrics["padded_wordpieces"] = self.padded_wordpieces
+        self.metrics["max_length_wordpieces"] = int(preds.size)
+
+        start_time = time.perf_counter()
+        word_mask = features["label_ids"] != self.pad_token_label_id
+        tag_list_list = self.bio_decoder.get_label_list_list(*self.bio_decoder.get_word_label_ids(preds, word_mask))
+        self.metrics["decode_seconds"] = time.perf_counter() - start_time
+        return tag_list_list
+
+
+def get_split_into_words_kwargs(tokenizer):
+    # transformers 3.0 calls pre-split input is_pretokenized; later versions is_split_into_words
+    parameter_set = set(inspect.signature(tokenizer.__call__).parameters)
+    if "is_split_into_words" in parameter_set:
+        return {"is_split_into_words": True}
+    return {"is_pretokenized": True}
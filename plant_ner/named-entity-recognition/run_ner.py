@@ -40,6 +40,7 @@ from transformers import (
     TrainingArguments,
     set_seed,
 )
+from bio_decoder import BioDecoder
 from utils_ner import NerDataset, Split, get_labels
 
 logger = logging.getLogger(__name__)
@@ -204,20 +205,14 @@ def main():
         else None
     )
 
+    bio_decoder = BioDecoder(labels)
+
     def align_predictions(predictions: np.ndarray, label_ids: np.ndarray) -> Tuple[List[int], List[int]]:
         preds = np.argmax(predictions, axis=2)
+        word_mask = label_ids != nn.CrossEntropyLoss().ignore_index
 
-        batch_size, seq_len = preds.shape
-
-        out_label_list = [[] for _ in range(batch_size)]
-        preds_list = [[] for _ in range(batch_size)]
-        
-        for i in range(batch_size):
-            for j in range(seq_len):
-                if label_ids[i, j] != nn.CrossEntropyLoss().ignore_index:
-                    out_label_list[i].append(label_map[label_ids[i][j]])
-                    preds_list[i].append(label_map[preds[i][j]])
-
+        preds_list = bio_decoder.get_label_list_list(*bio_decoder.get_word_label_ids(preds, word_mask))
+        out_label_list = bio_decoder.get_label_list_list(*bio_decoder.get_word_label_ids(label_ids, word_mask))
         return preds_list, out_label_list
 
     def compute_metrics(p: EvalPrediction) -> Dict:
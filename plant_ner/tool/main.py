@@ -2,14 +2,29 @@ import os
 import csv
 import sys
 import json
+import time
+import random
 import shutil
+import sqlite3
+import hashlib
 import logging
 import argparse
 import subprocess
+import multiprocessing
+from collections import OrderedDict
 
+import torch
+import numpy as np
 from transformers import AutoTokenizer
 from nltk.tokenize.treebank import TreebankWordDetokenizer
 
+from record_file import check_output_format, get_record_file, write_record_file
+
+# bio_decoder and ner_engine
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "named-entity-recognition"))
+from bio_decoder import BioDecoder
+from ner_engine import NerEngine, get_split_into_words_kwargs
+
 logger = logging.getLogger(__name__)
 logging.basicConfig(
     format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
@@ -44,6 +59,7 @@ datum format:
     ]
 }
 # span_list could be None if post-hoc matching of the sentence and its token sequence failed
+# token_span_list is added by NER when span_list is None: the character span of every token, or None if not found
 """
 
 
@@ -115,13 +131,66 @@ def write_csv(file, dialect, row_list, write_log=True):
     return
 
 
-def split_token_list(token_list, piecer):
+def get_piece_count_list(tokenlist_list, piecer):
+    # wordpieces of every token; one batched call when piecer is a fast tokenizer
+    if not tokenlist_list:
+        return []
+    if not piecer.is_fast:
+        return [[len(piecer.tokenize(token)) for token in token_list] for token_list in tokenlist_list]
+
+    encoding = piecer(tokenlist_list, add_special_tokens=False, **get_split_into_words_kwargs(piecer))
+    get_word_ids = encoding.word_ids if hasattr(encoding, "word_ids") else encoding.words
+    piececount_list = []
+    for i, token_list in enumerate(tokenlist_list):
+        word_ids = np.array(get_word_ids(i), dtype=np.int64)
+        piececount_list.append(np.bincount(word_ids, minlength=len(token_list)).tolist())
+    return piececount_list
+
+
+def read_ner_dataset(file):
+    # "token tag" lines, sentences separated by blank lines -> [(token_list, tag_list), ...]
+    sentence_list = []
+    token_list = []
+    tag_list = []
+    for line in read_lines(file, write_log=False):
+        if line:
+            token, tag = line.split(" ")[0], line.split(" ")[-1]
+            token_list.append(token)
+            tag_list.append(tag)
+        elif token_list:
+            sentence_list.append((token_list, tag_list))
+            token_list = []
+            tag_list = []
+    if token_list:
+        sentence_list.append((token_list, tag_list))
+    return sentence_list
+
+
+def load_piecer():
+    # the fast tokenizer is used only if it counts the same wordpieces as the slow one on the devel set
+    slow_piecer = AutoTokenizer.from_pretrained("bert-base-cased", use_fast=False)
+    fast_piecer = AutoTokenizer.from_pretrained("bert-base-cased", use_fast=True)
+
+    validation_file = os.path.join("plant_ner", "datasets", "NER", "plant_20210831", "devel.txt")
+    tokenlist_list = [token_list for token_list, _ in read_ner_dataset(validation_file)]
+
+    if get_piece_count_list(tokenlist_list, slow_piecer) == get_piece_count_list(tokenlist_list, fast_piecer):
+        logger.info(f"Fast tokenizer wordpiece counts are identical on {len(tokenlist_list):,} devel sentences")
+        return fast_piecer
+    logger.warning("Fast tokenizer wordpiece counts differ on devel sentences; using slow tokenizer")
+    return slow_piecer
+
+
+def split_token_list(token_list, piecer, piece_count_list=None):
     tokenlist_list = []
     sub_token_list = []
     pieces = 0
 
+    if piece_count_list is None:
+        piece_count_list = [len(piecer.tokenize(token)) for token in token_list]
+
     for ti, token in enumerate(token_list):
-        token_pieces = len(piecer.tokenize(token))
+        token_pieces = piece_count_list[ti]
 
         if pieces + token_pieces < max_sentence_pieces:
             sub_token_list.append(token)
@@ -137,29 +206,46 @@ def split_token_list(token_list, piecer):
     return tokenlist_list
 
 
-def create_model_input(source_file, target_dir):
-    data = read_json(source_file)
-    piecer = AutoTokenizer.from_pretrained("bert-base-cased")
-    extracted_data = []
-    split_sentences = 0
+def may_split(datum):
+    # a sentence of fewer characters than max_sentence_pieces cannot have max_sentence_pieces wordpieces
+    return len(datum["sentence"]) >= max_sentence_pieces
 
-    for datum in data:
-        token_list = [
-            token[:max_sentence_pieces]
-            for token in datum["token_list"]
-        ]
 
-        if len(datum["sentence"]) < max_sentence_pieces:
-            tokenlist_list = [token_list]
+def get_model_input(data, piecer):
+    # every datum becomes one or more token lists of less than max_sentence_pieces wordpieces
+    # datum_index_list[i] is the index in data of tokenlist_list[i]
+    datum_token_list = [
+        [token[:max_sentence_pieces] for token in datum["token_list"]]
+        for datum in data
+    ]
+
+    # wordpieces are counted only for sentences that may need splitting, in one batch
+    long_di_list = [di for di, datum in enumerate(data) if may_split(datum)]
+    long_piececount_list = get_piece_count_list([datum_token_list[di] for di in long_di_list], piecer)
+    di_to_piececount = dict(zip(long_di_list, long_piececount_list))
+
+    tokenlist_list = []
+    datum_index_list = []
+
+    for di, token_list in enumerate(datum_token_list):
+        if di not in di_to_piececount:
+            sub_tokenlist_list = [token_list]
         else:
-            tokenlist_list = split_token_list(token_list, piecer)
-        split_sentences += len(tokenlist_list)
+            sub_tokenlist_list = split_token_list(token_list, piecer, di_to_piececount[di])
+        tokenlist_list.extend(sub_tokenlist_list)
+        datum_index_list.extend([di] * len(sub_tokenlist_list))
 
-        for token_list in tokenlist_list:
-            for token in token_list:
-                extracted_data.append([token, "O"])
-            extracted_data.append([])
+    split_sentences = len(tokenlist_list)
     logger.info(f"{split_sentences:,} split_sentences")
+    return tokenlist_list, datum_index_list
+
+
+def write_model_input(tokenlist_list, target_dir):
+    extracted_data = []
+    for token_list in tokenlist_list:
+        for token in token_list:
+            extracted_data.append([token, "O"])
+        extracted_data.append([])
 
     text_file = os.path.join(target_dir, "test.txt")
     write_csv(text_file, "ssv", extracted_data)
@@ -170,6 +256,28 @@ def create_model_input(source_file, target_dir):
     return
 
 
+def write_model_output(tokenlist_list, taglist_list, target_dir):
+    # same format as test_predictions.txt of run_ner.py
+    output_data = []
+    for token_list, tag_list in zip(tokenlist_list, taglist_list):
+        for token, tag in zip(token_list, tag_list):
+            output_data.append([token, tag])
+        output_data.append([])
+
+    output_file = os.path.join(target_dir, "test_predictions.txt")
+    write_csv(output_file, "ssv", output_data)
+    return
+
+
+def create_model_input(source_file, target_dir, piecer=None):
+    data = read_json(source_file)
+    if piecer is None:
+        piecer = AutoTokenizer.from_pretrained("bert-base-cased")
+    tokenlist_list, datum_index_list = get_model_input(data, piecer)
+    write_model_input(tokenlist_list, target_dir)
+    return tokenlist_list, datum_index_list
+
+
 def run_model(target_dir):
     logger.info("Running model")
 
@@ -197,43 +305,434 @@ def run_model(target_dir):
     return
 
 
+def load_ner_engine(batch_size, max_tokens, pack, runtime, validate_every_batch=False):
+    # the model is loaded once and reused for every batch file of this process
+    model_dir = get_model_dir()
+    label_file = os.path.join("plant_ner", "datasets", "NER", "plant_20210831", "labels.txt")
+    export_prefix = None
+    if runtime == "torchscript":
+        export_prefix = os.path.join(model_dir, f"model.torchscript.{max_sentence_pieces}")
+    engine = NerEngine(
+        model_dir, label_file, max_seq_length=max_sentence_pieces, batch_size=batch_size, max_tokens=max_tokens,
+        pack=pack, validate_every_batch=validate_every_batch, runtime=runtime, export_prefix=export_prefix,
+    )
+    return engine
+
+
+"""
+prediction cache
+"""
+# sqlite table: sha1(model fingerprint, may_split, truncated token_list) -> json token-position mention_list
+# Mentions are cached before get_named_mention_list(), which depends on the sentence and span_list,
+# so sentences with the same tokens but different spacing share an entry,
+# unless the spacing puts them on different sides of the may_split() limit and they are split differently.
+
+
+def get_model_dir():
+    return os.path.join("plant_ner", "named-entity-recognition", "output_20210831", "plant_20210831")
+
+
+def get_model_fingerprint(model_dir, option):
+    # model files (not training outputs) and every option that changes predictions
+    sha1 = hashlib.sha1()
+    for file in sorted(os.listdir(model_dir)):
+        if file.endswith((".json", ".txt", ".bin")) and not file.startswith(("test_", "eval_", "training_")):
+            sha1.update(file.encode("utf8"))
+            with open(os.path.join(model_dir, file), "rb") as f:
+                for chunk in iter(lambda: f.read(2 ** 20), b""):
+                    sha1.update(chunk)
+    sha1.update(option.encode("utf8"))
+    return sha1.hexdigest()
+
+
+class NerCache:
+
+    def __init__(self, db_file, fingerprint, lru_size=200000):
+        self.fingerprint = fingerprint
+        self.lru_size = lru_size
+        self.lru = OrderedDict()
+        self.conn = sqlite3.connect(db_file)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS prediction (key BLOB PRIMARY KEY, mention_list TEXT) WITHOUT ROWID"
+        )
+        logger.info(f"Prediction cache {db_file} with model fingerprint {fingerprint}")
+
+    def get_key(self, datum):
+        token_list = [token[:max_sentence_pieces] for token in datum["token_list"]]
+        string = f"{self.fingerprint}\n{may_split(datum)}\n" + json.dumps(token_list, ensure_ascii=False)
+        return hashlib.sha1(string.encode("utf8")).digest()
+
+    def add_lru(self, key, mention_list):
+        self.lru[key] = mention_list
+        self.lru.move_to_end(key)
+        if len(self.lru) > self.lru_size:
+            self.lru.popitem(last=False)
+        return
+
+    def get_many(self, key_list):
+        key_to_mentionlist = {}
+        db_key_list = []
+        for key in set(key_list):
+            if key in self.lru:
+                self.lru.move_to_end(key)
+                key_to_mentionlist[key] = self.lru[key]
+            else:
+                db_key_list.append(key)
+
+        for i in range(0, len(db_key_list), 500):
+            chunk = db_key_list[i:i + 500]
+            query = f"SELECT key, mention_list FROM prediction WHERE key IN ({', '.join('?' * len(chunk))})"
+            for key, mention_list in self.conn.execute(query, chunk):
+                mention_list = json.loads(mention_list)
+                key_to_mentionlist[key] = mention_list
+                self.add_lru(key, mention_list)
+        return key_to_mentionlist
+
+    def put_many(self, key_to_mentionlist):
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO prediction VALUES (?, ?)",
+            [(key, json.dumps(mention_list)) for key, mention_list in key_to_mentionlist.items()],
+        )
+        self.conn.commit()
+        for key, mention_list in key_to_mentionlist.items():
+            self.add_lru(key, mention_list)
+        return
+
+    def close(self):
+        self.conn.close()
+        return
+
+
+"""
+pre-filter
+"""
+
+
+# mention types whose surface forms make up the lexicon: plant names and compounds
+prefilter_lexicon_type_set = {"CommonName", "Species", "Compound"}
+
+
+def mine_prefilter_lexicon(file_list, excluded_sentence_set=frozenset(), min_length=3):
+    # lowercased tokens inside annotated mentions of prefilter_lexicon_type_set,
+    # from the sentences whose token tuple is not in excluded_sentence_set
+    lexicon = set()
+    excluded_sentences = 0
+    for file in file_list:
+        for token_list, tag_list in read_ner_dataset(file):
+            if tuple(token_list) in excluded_sentence_set:
+                excluded_sentences += 1
+                continue
+            for token, tag in zip(token_list, tag_list):
+                if tag == "O" or get_mention_type(tag) not in prefilter_lexicon_type_set:
+                    continue
+                if len(token) >= min_length and any(c.isalpha() for c in token):
+                    lexicon.add(token.lower())
+    if excluded_sentence_set:
+        logger.info(f"Pre-filter lexicon: {excluded_sentences:,} excluded sentences")
+    return lexicon
+
+
+class SentencePrefilter:
+    """
+    Route sentences that obviously contain no mention to an empty mention_list without running the model:
+    fewer than min_words words (tokens of 2+ characters with a letter),
+    a letter ratio of non-space characters below min_alpha_ratio,
+    or no lexicon token and fewer than lexicon_min_words words or a letter ratio below lexicon_min_alpha_ratio.
+    """
+
+    def __init__(
+            self, lexicon, min_words=3, min_alpha_ratio=0.5, lexicon_min_words=5, lexicon_min_alpha_ratio=0.6,
+    ):
+        self.lexicon = lexicon
+        self.min_words = min_words
+        self.min_alpha_ratio = min_alpha_ratio
+        self.lexicon_min_words = lexicon_min_words
+        self.lexicon_min_alpha_ratio = lexicon_min_alpha_ratio
+
+    def is_empty(self, token_list):
+        characters = sum(len(token) for token in token_list)
+        alpha_ratio = sum(c.isalpha() for token in token_list for c in token) / max(characters, 1)
+        words = sum(1 for token in token_list if len(token) > 1 and any(c.isalpha() for c in token))
+
+        if words < self.min_words or alpha_ratio < self.min_alpha_ratio:
+            return True
+        if words < self.lexicon_min_words or alpha_ratio < self.lexicon_min_alpha_ratio:
+            return not any(token.lower() in self.lexicon for token in token_list)
+        return False
+
+
+def get_prefilter_dataset_file_list(split_list):
+    dataset_dir = os.path.join("plant_ner", "datasets", "NER")
+    return sorted(
+        os.path.join(dataset_dir, name, f"{split}.txt")
+        for name in os.listdir(dataset_dir)
+        for split in split_list
+        if os.path.exists(os.path.join(dataset_dir, name, f"{split}.txt"))
+    )
+
+
+def load_prefilter(arg, split_list=("devel", "test"), excluded_sentence_set=frozenset()):
+    lexicon = mine_prefilter_lexicon(get_prefilter_dataset_file_list(split_list), excluded_sentence_set)
+    logger.info(f"Pre-filter lexicon: {len(lexicon):,} surface forms")
+    return SentencePrefilter(
+        lexicon, arg.prefilter_min_words, arg.prefilter_min_alpha_ratio,
+        arg.prefilter_lexicon_min_words, arg.prefilter_lexicon_min_alpha_ratio,
+    )
+
+
+def report_prefilter(arg):
+    # The lexicon is mined from the test sets without the sentences that are also in the devel set
+    # (the test sets of plant, plant_20210831_ignore_method and plant_ignore_method share about a thousand each),
+    # so devel recall is not inflated by the mentions of its own sentences.
+    devel_file = os.path.join("plant_ner", "datasets", "NER", "plant_20210831", "devel.txt")
+    sentence_list = read_ner_dataset(devel_file)
+    devel_sentence_set = {tuple(token_list) for token_list, _tag_list in sentence_list}
+    prefilter = load_prefilter(arg, split_list=("test",), excluded_sentence_set=devel_sentence_set)
+
+    mentions = 0
+    skipped_sentences = 0
+    skipped_mentions = 0
+    skipped_mention_sentences = 0
+    for token_list, tag_list in sentence_list:
+        sentence_mentions = sum(1 for tag in tag_list if tag.startswith("B-"))
+        mentions += sentence_mentions
+        if prefilter.is_empty(token_list):
+            skipped_sentences += 1
+            skipped_mentions += sentence_mentions
+            skipped_mention_sentences += sentence_mentions > 0
+
+    report = {
+        "sentences": len(sentence_list),
+        "skipped_sentences": skipped_sentences,
+        "skipped_fraction": skipped_sentences / max(len(sentence_list), 1),
+        "mentions": mentions,
+        "skipped_mentions": skipped_mentions,
+        "skipped_sentences_with_mentions": skipped_mention_sentences,
+        "recall_loss": skipped_mentions / max(mentions, 1),
+    }
+    logger.info(
+        f"[pre-filter on {devel_file}]"
+        f" skipped {skipped_sentences:,}/{len(sentence_list):,} ({report['skipped_fraction']:.2%}) sentences;"
+        f" recall loss {skipped_mentions:,}/{mentions:,} ({report['recall_loss']:.2%}) gold mentions"
+        f" in {skipped_mention_sentences:,} sentences"
+    )
+    return report
+
+
+"""
+parallel NER on CPU
+"""
+# N spawned workers each load the model once with torch.set_num_threads(k);
+# sentence chunks are fed through Pool.imap, which returns results in submission order.
+ner_worker_engine = None
+
+
+def init_ner_worker(engine_arg, threads):
+    global ner_worker_engine
+    if threads > 0:
+        torch.set_num_threads(threads)
+    ner_worker_engine = load_ner_engine(*engine_arg)
+    return
+
+
+def predict_ner_chunk(tokenlist_list):
+    taglist_list = ner_worker_engine.predict(tokenlist_list)
+    return taglist_list, ner_worker_engine.metrics
+
+
+class ParallelNerEngine:
+    # same predict() as NerEngine, sharded over worker processes
+
+    def __init__(self, engine_arg, workers, threads, chunk_size=2000):
+        self.workers = workers
+        self.threads = threads
+        self.chunk_size = chunk_size
+        context = multiprocessing.get_context("spawn")
+        self.pool = context.Pool(workers, initializer=init_ner_worker, initargs=(engine_arg, threads))
+        logger.info(f"Started {workers} NER workers x {threads} threads")
+
+    def predict(self, tokenlist_list):
+        chunk_list = [
+            tokenlist_list[i:i + self.chunk_size]
+            for i in range(0, len(tokenlist_list), self.chunk_size)
+        ]
+        # metrics are summed over chunks; seconds are worker seconds, not wall-clock seconds
+        self.metrics = {}
+        taglist_list = []
+        for chunk_taglist_list, chunk_metrics in self.pool.imap(predict_ner_chunk, chunk_list):
+            taglist_list.extend(chunk_taglist_list)
+            for key, value in chunk_metrics.items():
+                self.metrics[key] = self.metrics.get(key, 0) + value
+        return taglist_list
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        return
+
+
+def tune_ner_workers(engine_arg, tokenlist_list, chunk_size, cpus=None):
+    # try every N x k with N * k == cpus (N a power of 2) on a sample and keep the most words/s
+    if cpus is None:
+        cpus = os.cpu_count()
+    words = sum(len(token_list) for token_list in tokenlist_list)
+    workers_threads_list = []
+    workers = 1
+    while workers <= cpus:
+        workers_threads_list.append((workers, cpus // workers))
+        workers *= 2
+
+    best = None
+    for workers, threads in workers_threads_list:
+        engine = ParallelNerEngine(engine_arg, workers, threads, chunk_size=min(chunk_size, len(tokenlist_list)))
+        # warm-up: model loading and the one-time checks of every worker
+        engine.pool.map(predict_ner_chunk, [tokenlist_list[:8]] * workers, chunksize=1)
+
+        start_time = time.perf_counter()
+        engine.predict(tokenlist_list)
+        seconds = time.perf_counter() - start_time
+        engine.close()
+
+        words_per_second = words / seconds
+        logger.info(f"[auto-tune] {workers} workers x {threads} threads: {words_per_second:,.0f} words/s")
+        if best is None or words_per_second > best[2]:
+            best = (workers, threads, words_per_second)
+
+    workers, threads, words_per_second = best
+    logger.info(f"[auto-tune] using {workers} workers x {threads} threads: {words_per_second:,.0f} words/s")
+    return workers, threads
+
+
+"""
+throughput metrics
+"""
+# one row per batch file: counts, padding and stage seconds;
+# the metrics file is rewritten after every batch with totals, stage shares and percentiles over batches
+
+
+def get_split_sentences(datum_index_list):
+    # sentences that split_token_list() cut into more than one token list
+    if not datum_index_list:
+        return 0
+    return int((np.bincount(datum_index_list) > 1).sum())
+
+
+def get_percentile_summary(value_list, percentile_list=(50, 90, 95, 99)):
+    value_array = np.array(value_list, dtype=np.float64)
+    summary = {
+        "min": float(value_array.min()),
+        "mean": float(value_array.mean()),
+        "max": float(value_array.max()),
+    }
+    for percentile, value in zip(percentile_list, np.percentile(value_array, percentile_list)):
+        summary[f"p{percentile}"] = float(value)
+    return summary
+
+
+class NerMetrics:
+    stage_list = ["split", "tokenize", "forward", "model", "decode", "collect", "write"]
+
+    def __init__(self, metrics_file, run_arg=None):
+        self.metrics_file = metrics_file
+        self.run_arg = run_arg or {}
+        self.batch_list = []
+        self.start_time = time.time()
+
+    def add_batch(self, batch_metrics):
+        wordpieces = batch_metrics.get("wordpieces")
+        if wordpieces is not None:
+            padded_wordpieces = max(batch_metrics["padded_wordpieces"], 1)
+            max_length_wordpieces = max(batch_metrics["max_length_wordpieces"], 1)
+            batch_metrics["padding_ratio"] = 1 - wordpieces / padded_wordpieces
+            batch_metrics["max_length_padding_ratio"] = 1 - wordpieces / max_length_wordpieces
+        seconds = batch_metrics["total_seconds"]
+        batch_metrics["sentences_per_second"] = batch_metrics["sentences"] / seconds if seconds > 0 else 0.0
+
+        self.batch_list.append(batch_metrics)
+        stage_log = ", ".join(
+            f"{stage} {batch_metrics[stage + '_seconds']:.2f}s"
+            for stage in self.stage_list
+            if stage + "_seconds" in batch_metrics
+        )
+        padding_log = ""
+        if "padding_ratio" in batch_metrics:
+            padding_log = f" {batch_metrics['wordpieces']:,} wordpieces; padding {batch_metrics['padding_ratio']:.2%};"
+        logger.info(
+            f"[metrics] {batch_metrics['sentences']:,} sentences;"
+            f" {batch_metrics['sequences']:,} sequences ({batch_metrics['split_sentences']:,} split sentences);"
+            f"{padding_log} {stage_log}; {batch_metrics['sentences_per_second']:,.0f} sentences/s"
+        )
+        self.write()
+        return
+
+    def get_summary(self):
+        key_list = [
+            key for key, value in self.batch_list[0].items()
+            if isinstance(value, (int, float)) and not isinstance(value, bool)
+        ]
+
+        total = {}
+        for key in key_list:
+            if key.endswith("_ratio") or key.endswith("_per_second"):
+                continue
+            total[key] = sum(batch_metrics.get(key, 0) for batch_metrics in self.batch_list)
+        if total.get("padded_wordpieces"):
+            total["padding_ratio"] = 1 - total["wordpieces"] / total["padded_wordpieces"]
+            total["max_length_padding_ratio"] = 1 - total["wordpieces"] / max(total["max_length_wordpieces"], 1)
+        seconds = total["total_seconds"]
+        total["sentences_per_second"] = total["sentences"] / seconds if seconds > 0 else 0.0
+        if "wordpieces" in total:
+            total["wordpieces_per_second"] = total["wordpieces"] / seconds if seconds > 0 else 0.0
+
+        # share of batch seconds spent in each stage
+        stage_share = {
+            stage: total[stage + "_seconds"] / seconds if seconds > 0 else 0.0
+            for stage in self.stage_list
+            if stage + "_seconds" in total
+        }
+
+        percentile = {
+            key: get_percentile_summary([batch_metrics[key] for batch_metrics in self.batch_list])
+            for key in key_list
+        }
+        return {
+            "batches": len(self.batch_list),
+            "total": total,
+            "stage_share": stage_share,
+            "percentile": percentile,
+        }
+
+    def write(self):
+        metrics = {
+            "run": self.run_arg,
+            "start_time": time.strftime("%Y/%m/%d %H:%M:%S", time.localtime(self.start_time)),
+            "summary": self.get_summary() if self.batch_list else {},
+            "batch_list": self.batch_list,
+        }
+        os.makedirs(os.path.dirname(self.metrics_file) or ".", exist_ok=True)
+        with open(self.metrics_file + ".tmp", "w", encoding="utf8") as f:
+            json.dump(metrics, f, indent=2)
+        os.replace(self.metrics_file + ".tmp", self.metrics_file)
+        return
+
+
+def get_mention_type(tag):
+    # tags are "B-CommonName-bio" style; dataset files have "B-CommonName"
+    return tag[2:-4] if tag.endswith("-bio") else tag[2:]
+
+
+mention_decoder = BioDecoder(get_type=get_mention_type)
+
+
 def get_mention_list(tag_list):
-    mention_list = []
-    begin_ti = None
-    begin_mention_label = None
-
-    for ti, tag in enumerate(tag_list):
-        seq_label = tag[0]
-        mention_label = None if seq_label == "O" else tag[2:-4]
-
-        if seq_label == "B":
-            if begin_ti:
-                mention_list.append({
-                    "pos": [begin_ti, ti],
-                    "type": begin_mention_label,
-                })
-            begin_ti = ti
-            begin_mention_label = mention_label
-
-        elif seq_label == "O":
-            if begin_ti:
-                mention_list.append({
-                    "pos": [begin_ti, ti],
-                    "type": begin_mention_label,
-                })
-            begin_ti = None
-            begin_mention_label = None
-
-        elif begin_ti and not mention_label == begin_mention_label:
-            begin_ti = None
-            begin_mention_label = None
-
-    if begin_ti is not None:
-        mention_list.append({
-            "pos": [begin_ti, len(tag_list)],
-            "type": begin_mention_label,
-        })
-    return mention_list
+    return get_mention_list_list([tag_list])[0]
+
+
+def get_mention_list_list(taglist_list):
+    label_ids, lengths = mention_decoder.get_label_ids(taglist_list)
+    return mention_decoder.get_mention_list_list(label_ids, lengths)
 
 
 def get_character_position(sentence, token_list, ti, tj):
@@ -265,8 +764,33 @@ def get_character_position(sentence, token_list, ti, tj):
     return -1, -1
 
 
-def get_named_mention_list(sentence, span_list, token_list, mention_list, detokenizer):
+def get_token_span_list(sentence, token_list):
+    # One left-to-right pass over the sentence for all tokens.
+    # A token must follow the previous aligned token after spaces only,
+    # except that tokens rewritten by the tokenizer (e.g. `` for ") are left None
+    # and allow up to 2 skipped characters each before the next aligned token.
+    token_span_list = []
+    cursor = 0
+    pending = 0
+
+    for token in token_list:
+        ci = sentence.find(token, cursor) if token else -1
+        if ci != -1 and len(sentence[cursor:ci].replace(" ", "")) <= 2 * pending:
+            cj = ci + len(token)
+            token_span_list.append((ci, cj))
+            cursor = cj
+            pending = 0
+        else:
+            token_span_list.append(None)
+            pending += 1
+
+    return token_span_list
+
+
+def get_named_mention_list(sentence, span_list, token_list, mention_list, detokenizer, token_span_list=None):
     named_mention_list = []
+    if span_list is None and token_span_list is None and mention_list:
+        token_span_list = get_token_span_list(sentence, token_list)
 
     for mention in mention_list:
         _type = mention["type"]
@@ -278,6 +802,10 @@ def get_named_mention_list(sentence, span_list, token_list, mention_list, detoke
             # method 1: use token_position-to-character_position mapping
             ci, cj = span_list[ti][0], span_list[tj - 1][1]
             name = sentence[ci:cj]
+        elif token_span_list[ti] is not None and token_span_list[tj - 1] is not None:
+            # method 1': use the token alignment of the whole sentence
+            ci, cj = token_span_list[ti][0], token_span_list[tj - 1][1]
+            name = sentence[ci:cj]
         else:
             # method 2: find the token sequence in the sentence
             ci, cj = get_character_position(sentence, token_list, ti, tj)
@@ -301,9 +829,98 @@ def get_named_mention_list(sentence, span_list, token_list, mention_list, detoke
     return named_mention_list
 
 
-def collect_result(source_file, target_dir, indent):
+def get_datum_mention_list(datums, tokenlist_list, datum_index_list, taglist_list):
+    # split token lists are joined back per datum; returns the token-position mention_list of every datum
+    datum_tag_list = [[] for _ in range(datums)]
+
+    for token_list, di, tag_list in zip(tokenlist_list, datum_index_list, taglist_list):
+        if len(tag_list) < len(token_list):
+            logger.warning(f"Maximum sequence length exceeded: No prediction for {token_list[len(tag_list):]}")
+            tag_list = tag_list + ["O"] * (len(token_list) - len(tag_list))
+        datum_tag_list[di].extend(tag_list)
+
+    return get_mention_list_list(datum_tag_list)
+
+
+def collect_mention_list(data, datum_mention_list):
+    # the in-memory counterpart of collect_result()
+    mentions = 0
+    detokenizer = TreebankWordDetokenizer()
+    logger.info("Collecting mentions")
+
+    for datum, mention_list in zip(data, datum_mention_list):
+        token_span_list = None
+        if datum["span_list"] is None:
+            token_span_list = get_token_span_list(datum["sentence"], datum["token_list"])
+            datum["token_span_list"] = token_span_list
+        mention_list = get_named_mention_list(
+            datum["sentence"], datum["span_list"], datum["token_list"], mention_list, detokenizer, token_span_list,
+        )
+        datum["mention_list"] = mention_list
+        mentions += len(mention_list)
+
+    logger.info(f"Collected {mentions:,} mentions")
+    return
+
+
+def benchmark_named_mention_list(tokens_list=(100, 500, 2000), sentences=20, seed=0):
+    # long sentences whose double quotes became `` and '' (so span_list is None), with a mention every few tokens:
+    # per-mention search (every token_span_list entry None) vs. one alignment per sentence
+    rng = random.Random(seed)
+    word_list = ["Arabidopsis", "thaliana", "AtMYB2", "expression", "in", "the", "root", "(", ")", ",", "of", "a"]
+    detokenizer = TreebankWordDetokenizer()
+
+    for tokens in tokens_list:
+        sample_list = []
+        for _ in range(sentences):
+            sentence_piece_list = []
+            token_list = []
+            for _ in range(tokens):
+                if rng.random() < 0.03:
+                    sentence_piece_list.append('"')
+                    token_list.append(rng.choice(["``", "''"]))
+                else:
+                    word = rng.choice(word_list)
+                    sentence_piece_list.append(word)
+                    token_list.append(word)
+            sentence = " ".join(sentence_piece_list)
+            mention_list = [
+                {"pos": [ti, min(ti + rng.randint(1, 3), tokens)], "type": "CommonName"}
+                for ti in range(0, tokens, 4)
+            ]
+            sample_list.append((sentence, token_list, mention_list))
+
+        name_to_seconds = {}
+        name_to_result = {}
+        for name in ["per_mention", "aligned"]:
+            start_time = time.perf_counter()
+            result = []
+            for sentence, token_list, mention_list in sample_list:
+                token_span_list = [None] * len(token_list) if name == "per_mention" else None
+                result.append(get_named_mention_list(
+                    sentence, None, token_list, mention_list, detokenizer, token_span_list,
+                ))
+            name_to_seconds[name] = time.perf_counter() - start_time
+            name_to_result[name] = result
+
+        mentions = 0
+        same_mentions = 0
+        for old_list, new_list in zip(name_to_result["per_mention"], name_to_result["aligned"]):
+            mentions += len(old_list)
+            same_mentions += sum(a == b for a, b in zip(old_list, new_list))
+        logger.info(
+            f"[{tokens:,} tokens x {sentences} sentences]"
+            f" per-mention {name_to_seconds['per_mention']:.3f}s;"
+            f" aligned {name_to_seconds['aligned']:.3f}s"
+            f" ({name_to_seconds['per_mention'] / name_to_seconds['aligned']:.1f}x);"
+            f" {same_mentions:,}/{mentions:,} identical mentions"
+        )
+    return
+
+
+def collect_result(source_file, target_dir, indent, output_format="json"):
     output_file = os.path.join(target_dir, "test_predictions.txt")
-    target_file = os.path.join(target_dir, "target.json")
+    target_file = get_record_file(target_dir, output_format)
 
     source_data = read_json(source_file)
     output_data = read_csv(output_file, "ssv")
@@ -329,7 +946,13 @@ def collect_result(source_file, target_dir, indent):
         sentence = source_data[di]["sentence"]
         span_list = source_data[di]["span_list"]
         token_list = source_data[di]["token_list"]
-        mention_list = get_named_mention_list(sentence, span_list, token_list, mention_list, detokenizer)
+        token_span_list = None
+        if span_list is None:
+            token_span_list = get_token_span_list(sentence, token_list)
+            source_data[di]["token_span_list"] = token_span_list
+        mention_list = get_named_mention_list(
+            sentence, span_list, token_list, mention_list, detokenizer, token_span_list,
+        )
 
         source_data[di]["mention_list"] = mention_list
         di += 1
@@ -342,17 +965,222 @@ def collect_result(source_file, target_dir, indent):
     assert di == len(source_data)
 
     logger.info(f"Collected {mentions:,} mentions")
-    write_json(target_file, source_data, indent=indent)
+    write_record_file(target_file, source_data, indent=indent)
+    return
+
+
+def run_ner_batch(source_file, target_dir, indent, piecer, output_format="json", metrics=None):
+    # text file round trip through run_ner.py;
+    # tokenization and forward passes happen inside the subprocess, so they are timed together as model_seconds
+    os.makedirs(target_dir, exist_ok=False)
+    batch_start_time = time.perf_counter()
+
+    start_time = time.perf_counter()
+    tokenlist_list, datum_index_list = create_model_input(source_file, target_dir, piecer)
+    split_seconds = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    run_model(target_dir)
+    model_seconds = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    collect_result(source_file, target_dir, indent, output_format)
+    collect_seconds = time.perf_counter() - start_time
+
+    if metrics is not None:
+        metrics.add_batch({
+            "source_file": source_file,
+            "sentences": len(set(datum_index_list)),
+            "sequences": len(tokenlist_list),
+            "split_sentences": get_split_sentences(datum_index_list),
+            "split_seconds": split_seconds,
+            "model_seconds": model_seconds,
+            "collect_seconds": collect_seconds,
+            "total_seconds": time.perf_counter() - batch_start_time,
+        })
+    return
+
+
+def run_ner_batch_in_memory(
+        source_file, target_dir, indent, piecer, engine, debug_dump=False, cache=None, output_format="json",
+        prefilter=None, metrics=None,
+):
+    # token_list -> tags -> mention_list without intermediate files;
+    # debug_dump also writes test.txt and test_predictions.txt as run_ner.py would;
+    # with a cache, only sentences without a cached prediction go to the model;
+    # with a prefilter, obviously empty sentences get an empty mention_list before the cache and the model
+    # with metrics, counts and stage seconds of the batch are added to it
+    os.makedirs(target_dir, exist_ok=False)
+    target_file = get_record_file(target_dir, output_format)
+    batch_start_time = time.perf_counter()
+
+    all_data = read_json(source_file)
+    if prefilter is None:
+        run_di_list = list(range(len(all_data)))
+    else:
+        run_di_list = [di for di, datum in enumerate(all_data) if not prefilter.is_empty(datum["token_list"])]
+        skipped = len(all_data) - len(run_di_list)
+        logger.info(f"Pre-filter: {skipped:,}/{len(all_data):,} ({skipped / max(len(all_data), 1):.2%}) skipped")
+    data = [all_data[di] for di in run_di_list]
+
+    if cache is None:
+        miss_data = data
+    else:
+        key_list = [cache.get_key(datum) for datum in data]
+        key_to_mentionlist = cache.get_many(key_list)
+        miss_di_list = [di for di, key in enumerate(key_list) if key not in key_to_mentionlist]
+        miss_data = [data[di] for di in miss_di_list]
+        logger.info(f"Prediction cache: {len(data) - len(miss_data):,}/{len(data):,} hits")
+
+    start_time = time.perf_counter()
+    tokenlist_list, datum_index_list = get_model_input(miss_data, piecer)
+    split_seconds = time.perf_counter() - start_time
+
+    logger.info("Running model")
+    start_time = time.perf_counter()
+    taglist_list = engine.predict(tokenlist_list)
+    predict_wall_seconds = time.perf_counter() - start_time
+    logger.info(f"Model finished")
+
+    if debug_dump:
+        write_model_input(tokenlist_list, target_dir)
+        write_model_output(tokenlist_list, taglist_list, target_dir)
+
+    start_time = time.perf_counter()
+    datum_mention_list = get_datum_mention_list(len(miss_data), tokenlist_list, datum_index_list, taglist_list)
+    decode_seconds = time.perf_counter() - start_time
+    if cache is not None:
+        cache.put_many({key_list[di]: mention_list for di, mention_list in zip(miss_di_list, datum_mention_list)})
+        key_to_mentionlist.update(zip((key_list[di] for di in miss_di_list), datum_mention_list))
+        datum_mention_list = [key_to_mentionlist[key] for key in key_list]
+
+    all_mention_list = [[] for _ in all_data]
+    for di, mention_list in zip(run_di_list, datum_mention_list):
+        all_mention_list[di] = mention_list
+    start_time = time.perf_counter()
+    collect_mention_list(all_data, all_mention_list)
+    collect_seconds = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    write_record_file(target_file, all_data, indent=indent)
+    write_seconds = time.perf_counter() - start_time
+
+    if metrics is not None:
+        engine_metrics = engine.metrics
+        metrics.add_batch({
+            "source_file": source_file,
+            "sentences": len(all_data),
+            "prefilter_skipped": len(all_data) - len(data),
+            "cache_hits": len(data) - len(miss_data),
+            "model_sentences": len(miss_data),
+            "sequences": len(tokenlist_list),
+            "split_sentences": get_split_sentences(datum_index_list),
+            "wordpieces": engine_metrics.get("wordpieces", 0),
+            "padded_wordpieces": engine_metrics.get("padded_wordpieces", 0),
+            "max_length_wordpieces": engine_metrics.get("max_length_wordpieces", 0),
+            "split_seconds": split_seconds,
+            "tokenize_seconds": engine_metrics.get("tokenize_seconds", 0.0),
+            "forward_seconds": engine_metrics.get("forward_seconds", 0.0),
+            "decode_seconds": engine_metrics.get("decode_seconds", 0.0) + decode_seconds,
+            # tokenize, forward and decode seconds of parallel workers add up beyond this
+            "predict_wall_seconds": predict_wall_seconds,
+            "collect_seconds": collect_seconds,
+            "write_seconds": write_seconds,
+            "total_seconds": time.perf_counter() - batch_start_time,
+        })
     return
 
 
 def run_ner(arg):
-    os.makedirs(arg.target_dir, exist_ok=False)
     indent = arg.indent if arg.indent >= 0 else None
+    check_output_format(arg.output_format)
+    piecer = load_piecer()
+    prefilter = None
+    if arg.prefilter:
+        if arg.backend == "subprocess":
+            logger.warning("--prefilter only applies to --backend engine")
+        else:
+            prefilter = load_prefilter(arg)
+
+    engine_arg = (arg.batch_size, arg.max_tokens, arg.pack, arg.runtime, arg.validate_every_batch)
+    if arg.source_dir is None:
+        first_source_file = arg.source_file
+    else:
+        first_source_file = os.path.join(arg.source_dir, f"batch_{arg.start}.json")
+
+    if arg.backend == "subprocess":
+        engine = None
+    elif arg.auto_tune or arg.workers > 1:
+        workers, threads = arg.workers, arg.threads
+        if arg.auto_tune:
+            sample_data = read_json(first_source_file)[:arg.tune_sentences]
+            sample_tokenlist_list, _ = get_model_input(sample_data, piecer)
+            workers, threads = tune_ner_workers(engine_arg, sample_tokenlist_list, arg.chunk_size)
+        engine = ParallelNerEngine(engine_arg, workers, threads, arg.chunk_size)
+    else:
+        if arg.threads > 0:
+            torch.set_num_threads(arg.threads)
+        engine = load_ner_engine(*engine_arg)
+
+    cache = None
+    if engine is not None and arg.cache_file:
+        # pack and runtime may change predictions; batching and sharding do not
+        option = f"max_sentence_pieces={max_sentence_pieces};pack={arg.pack};runtime={arg.runtime}"
+        cache = NerCache(arg.cache_file, get_model_fingerprint(get_model_dir(), option), arg.cache_lru_size)
+
+    metrics = None
+    if arg.metrics_file:
+        run_arg = {
+            key: getattr(arg, key)
+            for key in [
+                "backend", "batch_size", "max_tokens", "pack", "validate_every_batch", "runtime",
+                "workers", "threads", "chunk_size",
+                "auto_tune", "cache_file", "prefilter", "output_format",
+            ]
+        }
+        run_arg["max_sentence_pieces"] = max_sentence_pieces
+        if isinstance(engine, ParallelNerEngine):
+            run_arg["workers"], run_arg["threads"] = engine.workers, engine.threads
+        metrics = NerMetrics(arg.metrics_file, run_arg)
+
+    def run_batch(source_file, target_dir):
+        if engine is None:
+            run_ner_batch(source_file, target_dir, indent, piecer, arg.output_format, metrics)
+        else:
+            run_ner_batch_in_memory(
+                source_file, target_dir, indent, piecer, engine, arg.debug_dump, cache, arg.output_format, prefilter,
+                metrics,
+            )
+        return
+
+    if arg.source_dir is None:
+        run_batch(arg.source_file, arg.target_dir)
+        close_ner(engine, cache)
+        return
+
+    # many batch files in one process: source_dir/batch_{i}.json -> target_dir/batch_{i}/target.{json,jsonl,msgpack}
+    os.makedirs(arg.target_dir, exist_ok=True)
+
+    for bi in range(arg.start, arg.end + 1):
+        source_file = os.path.join(arg.source_dir, f"batch_{bi}.json")
+        target_dir = os.path.join(arg.target_dir, f"batch_{bi}")
+        if os.path.exists(get_record_file(target_dir, arg.output_format)):
+            logger.info(f"Skipping finished batch {bi}")
+            continue
+        if os.path.exists(target_dir):
+            shutil.rmtree(target_dir)
+        logger.info(f"batch {bi}/[{arg.start},{arg.end}]")
+        run_batch(source_file, target_dir)
 
-    create_model_input(arg.source_file, arg.target_dir)
-    run_model(arg.target_dir)
-    collect_result(arg.source_file, arg.target_dir, indent)
+    close_ner(engine, cache)
+    return
+
+
+def close_ner(engine, cache):
+    if isinstance(engine, ParallelNerEngine):
+        engine.close()
+    if cache is not None:
+        cache.close()
     return
 
 
@@ -361,8 +1189,60 @@ def main():
     parser.add_argument("--source_file", type=str, default="source.json")
     parser.add_argument("--target_dir", type=str, default="target_dir")
     parser.add_argument("--indent", type=int, default=2)
+    # --source_dir: run source_dir/batch_{start..end}.json in one process
+    parser.add_argument("--source_dir", type=str)
+    parser.add_argument("--start", type=int, default=1)
+    parser.add_argument("--end", type=int, default=1)
+    # subprocess: one run_ner.py call per batch, as always;
+    # engine (opt-in): load the model once in this process; check its parity with
+    # named-entity-recognition/evaluate_runtime.py before switching corpus runs to it
+    parser.add_argument("--backend", type=str, default="subprocess", choices=["subprocess", "engine"])
+    # engine backend: at most batch_size sentences and max_tokens padded wordpieces per forward pass
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--max_tokens", type=int, default=4096)
+    # engine backend: pack short sentences into shared max_sentence_pieces windows
+    parser.add_argument("--pack", action="store_true")
+    # engine backend: check the fast tokenizer and packing against the plain path on every batch,
+    # not only the first one of each process; every batch is then tokenized and predicted twice
+    parser.add_argument("--validate_every_batch", action="store_true")
+    # engine backend on CPU: int8 dynamic quantization, optionally traced to TorchScript;
+    # check with named-entity-recognition/evaluate_runtime.py before corpus runs
+    parser.add_argument("--runtime", type=str, default="pytorch", choices=["pytorch", "quantized", "torchscript"])
+    # engine backend: --workers processes with --threads torch threads each (0: torch default),
+    # fed --chunk_size sentences at a time; --auto_tune picks workers x threads on --tune_sentences sentences
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--threads", type=int, default=0)
+    parser.add_argument("--chunk_size", type=int, default=2000)
+    parser.add_argument("--auto_tune", action="store_true")
+    parser.add_argument("--tune_sentences", type=int, default=5000)
+    # engine backend: sqlite prediction cache shared across runs, with an in-memory LRU of --cache_lru_size sentences
+    parser.add_argument("--cache_file", type=str)
+    parser.add_argument("--cache_lru_size", type=int, default=200000)
+    # engine backend: also write test.txt and test_predictions.txt for debugging
+    parser.add_argument("--debug_dump", action="store_true")
+    # jsonl and msgpack also write target.index.tsv for seeking by (pmid, sent_id); see record_file.py
+    parser.add_argument("--output_format", type=str, default="json", choices=["json", "jsonl", "msgpack"])
+    # time token alignment in get_named_mention_list() on long synthetic sentences, then exit
+    parser.add_argument("--benchmark_alignment", action="store_true")
+    # skip obviously empty sentences (engine backend); see SentencePrefilter
+    parser.add_argument("--prefilter", action="store_true")
+    parser.add_argument("--prefilter_min_words", type=int, default=3)
+    parser.add_argument("--prefilter_min_alpha_ratio", type=float, default=0.5)
+    parser.add_argument("--prefilter_lexicon_min_words", type=int, default=5)
+    parser.add_argument("--prefilter_lexicon_min_alpha_ratio", type=float, default=0.6)
+    # report the skipped fraction and gold mention recall loss of the pre-filter on the devel set, then exit
+    parser.add_argument("--prefilter_report", action="store_true")
+    # per-batch sentences, wordpieces, padding, split sentences and stage seconds, with percentiles, as JSON
+    parser.add_argument("--metrics_file", type=str)
     arg = parser.parse_args()
 
+    if arg.benchmark_alignment:
+        benchmark_named_mention_list()
+        return
+    if arg.prefilter_report:
+        report_prefilter(arg)
+        return
+
     run_ner(arg)
     return
 
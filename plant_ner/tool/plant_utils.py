@@ -3,10 +3,14 @@ import csv
 import sys
 import json
 import random
+import hashlib
+import sqlite3
 import logging
 import argparse
+import multiprocessing
+from collections import defaultdict
 
-from nltk.tokenize.destructive import NLTKWordTokenizer
+from span_tokenizer import SpanWordTokenizer
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(
@@ -133,20 +137,85 @@ def write_csv(file, dialect, row_list, write_log=True):
     return
 
 
-def extract_sentence_data(pmid_to_text_file, sentence_dir, batch_size=500000):
+def get_shard_index(pmid, seed, shards):
+    # seeded hash, stable across processes and runs (unlike hash())
+    digest = hashlib.sha1(f"{seed}:{pmid}".encode("utf8")).digest()
+    return int.from_bytes(digest[:8], "big") % shards
+
+
+tokenizer = None
+
+
+def init_tokenizer():
+    global tokenizer
+    tokenizer = SpanWordTokenizer()
+    return
+
+
+def tokenize_pmid_line(line):
+    # line: one jsonl line of [pmid, sentence_list]
+    pmid, sentence_list = json.loads(line)
+    data = []
+    tokens = 0
+
+    # NLTKWordTokenizer tokens, always with spans (see span_tokenizer.py)
+    spansequence_list = tokenizer.span_tokenize_list(sentence_list)
+
+    for si, (sentence, span_sequence) in enumerate(zip(sentence_list, spansequence_list)):
+        token_sequence = [sentence[i:j] for i, j in span_sequence]
+        data.append({
+            "pmid": pmid,
+            "sent_id": si,
+            "sentence": sentence,
+            "span_list": span_sequence,
+            "token_list": token_sequence,
+        })
+        tokens += len(token_sequence)
+    return data, tokens
+
+
+def extract_sentence_data(
+        pmid_to_text_file, sentence_dir, batch_size=500000, seed=42, shards=128, processes=None, chunk_size=64,
+):
+    # Two-pass shuffle that never holds all texts:
+    #   pass 1 streams pmid_to_text_file and spills each pmid line to one of shards files by a seeded hash of pmid;
+    #   pass 2 shuffles one shard at a time with a seeded rng and tokenizes it in processes,
+    #   writing each batch as soon as it fills.
+    # The pmid order, and thus the batch files, only depend on the input, seed and shards.
     os.makedirs(sentence_dir, exist_ok=True)
-    
+    shard_dir = os.path.join(sentence_dir, "shard")
+    os.makedirs(shard_dir, exist_ok=True)
+    shard_file_list = [os.path.join(shard_dir, f"shard_{k}.jsonl") for k in range(shards)]
+
+    # pass 1
+    logger.info(f"Reading {pmid_to_text_file}")
     if pmid_to_text_file.endswith(".json"):
         pmid_to_text = read_json(pmid_to_text_file)
+        line_iterator = (json.dumps([pmid, text]) + "\n" for pmid, text in pmid_to_text.items())
     elif pmid_to_text_file.endswith(".jsonl"):
-        pmid_to_text = read_jsonl(pmid_to_text_file, "dict")
+        pmid_to_text = None
+        line_iterator = open(pmid_to_text_file, "r", encoding="utf8")
     else:
         assert False
-    pmid_list = list(pmid_to_text.keys())
-    random.shuffle(pmid_list)
 
-    tokenizer = NLTKWordTokenizer()
-    total_pmids = len(pmid_list)
+    total_pmids = 0
+    f_list = [open(shard_file, "w", encoding="utf8") for shard_file in shard_file_list]
+    try:
+        for line in line_iterator:
+            if not line.strip():
+                continue
+            pmid = json.loads(line)[0]
+            f_list[get_shard_index(pmid, seed, shards)].write(line if line.endswith("\n") else line + "\n")
+            total_pmids += 1
+    finally:
+        for f in f_list:
+            f.close()
+        if pmid_to_text is None:
+            line_iterator.close()
+    del pmid_to_text
+    logger.info(f"Spilled {total_pmids:,} pmids to {shards} shards in {shard_dir}")
+
+    # pass 2
     pmids = 0
     sentences = 0
     tokens = 0
@@ -154,38 +223,7 @@ def extract_sentence_data(pmid_to_text_file, sentence_dir, batch_size=500000):
     batch = []
     bi = 1
 
-    for pmid in pmid_list:
-        for si, sentence in enumerate(pmid_to_text[pmid]):
-            try:
-                span_sequence = list(tokenizer.span_tokenize(sentence))
-                token_sequence = [sentence[i:j] for i, j in span_sequence]
-            except ValueError:
-                span_sequence = None
-                token_sequence = tokenizer.tokenize(sentence)
-            batch.append({
-                "pmid": pmid,
-                "sent_id": si,
-                "sentence": sentence,
-                "span_list": span_sequence,
-                "token_list": token_sequence,
-            })
-            tokens += len(token_sequence)
-            sentences += 1
-        pmids += 1
-        batch_sentences = len(batch)
-
-        if batch_sentences >= batch_size:
-            batch_file = os.path.join(sentence_dir, f"batch_{bi}.json")
-            write_json(batch_file, batch, write_log=False)
-            logger.info(
-                f"batch 1-{bi:,} cumulates:"
-                f" {pmids:,}/{total_pmids:,} pmids;"
-                f" {sentences:,} sentences;"
-                f" {tokens:,} tokens"
-            )
-            batch = []
-            bi += 1
-    if batch:
+    def write_batch():
         batch_file = os.path.join(sentence_dir, f"batch_{bi}.json")
         write_json(batch_file, batch, write_log=False)
         logger.info(
@@ -194,6 +232,157 @@ def extract_sentence_data(pmid_to_text_file, sentence_dir, batch_size=500000):
             f" {sentences:,} sentences;"
             f" {tokens:,} tokens"
         )
+        return
+
+    with multiprocessing.Pool(processes, initializer=init_tokenizer) as pool:
+        for k, shard_file in enumerate(shard_file_list):
+            with open(shard_file, "r", encoding="utf8") as f:
+                line_list = f.readlines()
+            random.Random(f"{seed}:{k}").shuffle(line_list)
+
+            for data, pmid_tokens in pool.imap(tokenize_pmid_line, line_list, chunksize=chunk_size):
+                batch.extend(data)
+                sentences += len(data)
+                tokens += pmid_tokens
+                pmids += 1
+
+                if len(batch) >= batch_size:
+                    write_batch()
+                    batch = []
+                    bi += 1
+            os.remove(shard_file)
+
+    if batch:
+        write_batch()
+    os.rmdir(shard_dir)
+    return
+
+
+def get_sentence_key(sentence):
+    # the exact text is hashed: NER/GeneID/spaCy results carry character offsets into the sentence
+    return hashlib.sha1(sentence.encode("utf8")).digest()[:16]
+
+
+def dedup_sentence_data(sentence_dir, unique_dir, start, end, batch_size=500000, top_duplicates=20):
+    # Keep the first occurrence of every sentence text in unique_dir/batch_*.json for NER, GeneID and spaCy.
+    # unique_dir/occurrence/batch_{bi}.json lists [pmid, sent_id, key] for every sentence of source batch bi, in order,
+    # so gene_id/main_2023.py::fan_out_sentence_data() can fan results back out to every occurrence.
+    # Seen keys are kept in sqlite, so memory does not grow with the corpus.
+    occurrence_dir = os.path.join(unique_dir, "occurrence")
+    os.makedirs(occurrence_dir, exist_ok=True)
+    db_file = os.path.join(unique_dir, "sentence_key.sqlite")
+    if os.path.exists(db_file):
+        os.remove(db_file)
+    conn = sqlite3.connect(db_file)
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute(
+        "CREATE TABLE sentence (key BLOB PRIMARY KEY, unique_id INTEGER, count INTEGER, tokens INTEGER) WITHOUT ROWID"
+    )
+
+    sentences = 0
+    tokens = 0
+    unique_sentences = 0
+    unique_tokens = 0
+    unique_batch = []
+    ubi = 1
+
+    for bi in range(start, end + 1):
+        source_file = os.path.join(sentence_dir, f"batch_{bi}.json")
+        data = read_json(source_file, write_log=False)
+        key_list = [get_sentence_key(datum["sentence"]) for datum in data]
+
+        # keys seen in earlier batches
+        key_to_count = {}
+        unique_key_list = list(set(key_list))
+        for i in range(0, len(unique_key_list), 500):
+            chunk = unique_key_list[i:i + 500]
+            query = f"SELECT key, count FROM sentence WHERE key IN ({', '.join('?' * len(chunk))})"
+            for key, count in conn.execute(query, chunk):
+                key_to_count[key] = count
+        old_key_set = set(key_to_count)
+
+        new_row_list = []
+        occurrence_list = []
+        for datum, key in zip(data, key_list):
+            sentences += 1
+            tokens += len(datum["token_list"])
+            occurrence_list.append([datum["pmid"], datum["sent_id"], key.hex()])
+
+            if key in key_to_count:
+                key_to_count[key] += 1
+                continue
+            key_to_count[key] = 1
+            new_row_list.append([key, unique_sentences, len(datum["token_list"])])
+            unique_sentences += 1
+            unique_tokens += len(datum["token_list"])
+            unique_batch.append(datum)
+
+            if len(unique_batch) >= batch_size:
+                unique_file = os.path.join(unique_dir, f"batch_{ubi}.json")
+                write_json(unique_file, unique_batch, write_log=False)
+                unique_batch = []
+                ubi += 1
+
+        conn.executemany(
+            "INSERT INTO sentence VALUES (?, ?, ?, ?)",
+            [(key, unique_id, key_to_count[key], key_tokens) for key, unique_id, key_tokens in new_row_list],
+        )
+        conn.executemany(
+            "UPDATE sentence SET count = ? WHERE key = ?",
+            [(key_to_count[key], key) for key in old_key_set],
+        )
+        conn.commit()
+
+        occurrence_file = os.path.join(occurrence_dir, f"batch_{bi}.json")
+        write_json(occurrence_file, occurrence_list, write_log=False)
+        logger.info(
+            f"batch {start}-{bi} cumulates:"
+            f" {unique_sentences:,}/{sentences:,} unique sentences;"
+            f" {unique_tokens:,}/{tokens:,} unique tokens"
+        )
+
+    if unique_batch:
+        unique_file = os.path.join(unique_dir, f"batch_{ubi}.json")
+        write_json(unique_file, unique_batch, write_log=False)
+    else:
+        ubi -= 1
+
+    # report
+    top_duplicate_list = []
+    ubi_to_uid_count = defaultdict(lambda: [])
+    for unique_id, count in conn.execute(
+        "SELECT unique_id, count FROM sentence WHERE count > 1 ORDER BY count DESC, unique_id LIMIT ?", (top_duplicates,)
+    ):
+        ubi_to_uid_count[unique_id // batch_size + 1].append((unique_id, count))
+    for top_ubi, uid_count_list in ubi_to_uid_count.items():
+        unique_data = read_json(os.path.join(unique_dir, f"batch_{top_ubi}.json"), write_log=False)
+        for unique_id, count in uid_count_list:
+            top_duplicate_list.append({"count": count, "sentence": unique_data[unique_id % batch_size]["sentence"]})
+    top_duplicate_list = sorted(top_duplicate_list, key=lambda x: x["count"], reverse=True)
+    duplicated_sentences = conn.execute("SELECT COUNT(*) FROM sentence WHERE count > 1").fetchone()[0]
+    conn.close()
+    os.remove(db_file)
+
+    report = {
+        "source_batches": [start, end],
+        "unique_batches": [1, ubi],
+        "sentences": sentences,
+        "unique_sentences": unique_sentences,
+        "duplicated_sentence_texts": duplicated_sentences,
+        "duplication_rate": 1 - unique_sentences / max(sentences, 1),
+        "tokens": tokens,
+        "unique_tokens": unique_tokens,
+        "saved_token_rate": 1 - unique_tokens / max(tokens, 1),
+        "top_duplicate_list": top_duplicate_list,
+    }
+    report_file = os.path.join(unique_dir, "dedup_report.json")
+    write_json(report_file, report, indent=2, write_log=False)
+    logger.info(
+        f"{sentences - unique_sentences:,}/{sentences:,} ({report['duplication_rate']:.2%}) sentences are duplicates;"
+        f" {report['saved_token_rate']:.2%} of tokens are saved from NER, GeneID and spaCy"
+    )
+    logger.info(f"Report written to {report_file}")
     return
 
 
@@ -201,6 +390,12 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--start", type=int)
     parser.add_argument("--end", type=int)
+    parser.add_argument(
+        "--stage", type=str, default="extract_sentence_data", choices=["extract_sentence_data", "dedup_sentence_data"],
+    )
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--shards", type=int, default=128)
+    parser.add_argument("--processes", type=int)
     arg = parser.parse_args()
     for key, value in vars(arg).items():
         if value is not None:
@@ -214,8 +409,14 @@ def main():
     data_dir = os.path.join("/", "volume", "penghsuanli-genome2-nas2", "plant", "dataset_20230926")
     pmid_to_text_file = os.path.join(data_dir, "pmid_text.jsonl")
     sentence_dir = os.path.join(data_dir, "sentence")
+    unique_dir = os.path.join(data_dir, "sentence_unique")
 
-    extract_sentence_data(pmid_to_text_file, sentence_dir)
+    if arg.stage == "extract_sentence_data":
+        extract_sentence_data(
+            pmid_to_text_file, sentence_dir, seed=arg.seed, shards=arg.shards, processes=arg.processes,
+        )
+    elif arg.stage == "dedup_sentence_data":
+        dedup_sentence_data(sentence_dir, unique_dir, arg.start, arg.end)
     return
 
 
@@ -0,0 +1,211 @@
+import os
+import csv
+import sys
+import json
+import logging
+import argparse
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+logger = logging.getLogger(__name__)
+csv.register_dialect(
+    "tsv", delimiter="\t", quoting=csv.QUOTE_NONE, quotechar=None, doublequote=False,
+    escapechar=None, lineterminator="\n", skipinitialspace=False,
+)
+
+"""
+NER batch output formats:
+    json: target.json, a list of datums, the original format
+    jsonl: target.jsonl, one datum per line
+    msgpack: target.msgpack, concatenated MessagePack maps
+jsonl and msgpack come with target.index.tsv: pmid, sent_id, byte offset and byte length of every datum,
+so a datum can be read with one seek, and the record file can be streamed without parsing it as a whole.
+"""
+format_to_extension = {
+    "json": ".json",
+    "jsonl": ".jsonl",
+    "msgpack": ".msgpack",
+}
+
+
+def check_output_format(output_format):
+    assert output_format in format_to_extension
+    if output_format == "msgpack" and msgpack is None:
+        raise ImportError("output_format=msgpack requires the msgpack package")
+    return
+
+
+def get_record_file(target_dir, output_format):
+    return os.path.join(target_dir, "target" + format_to_extension[output_format])
+
+
+def find_record_file(target_dir):
+    # the record file of a finished batch in any format, or None
+    for output_format in format_to_extension:
+        record_file = get_record_file(target_dir, output_format)
+        if os.path.exists(record_file):
+            return record_file
+    return None
+
+
+def get_output_format(record_file):
+    extension = os.path.splitext(record_file)[1]
+    for output_format, format_extension in format_to_extension.items():
+        if extension == format_extension:
+            return output_format
+    assert False
+
+
+def get_index_file(record_file):
+    return os.path.splitext(record_file)[0] + ".index.tsv"
+
+
+def encode_record(datum, output_format):
+    if output_format == "jsonl":
+        return (json.dumps(datum) + "\n").encode("utf8")
+    return msgpack.packb(datum, use_bin_type=True)
+
+
+def decode_record(record, output_format):
+    if output_format == "jsonl":
+        return json.loads(record)
+    return msgpack.unpackb(record, raw=False)
+
+
+def write_record_file(record_file, data, indent=None, write_log=True):
+    output_format = get_output_format(record_file)
+    check_output_format(output_format)
+    if write_log:
+        objects = len(data)
+        logger.info(f"Writing {objects:,} objects")
+
+    # in every format, the record file is renamed into place last, so its existence marks a finished batch
+    if output_format == "json":
+        with open(record_file + ".tmp", "w", encoding="utf8") as f:
+            json.dump(data, f, indent=indent)
+        os.replace(record_file + ".tmp", record_file)
+
+    else:
+        index_row_list = []
+        offset = 0
+        with open(record_file + ".tmp", "wb") as f:
+            for datum in data:
+                record = encode_record(datum, output_format)
+                f.write(record)
+                index_row_list.append([datum["pmid"], datum["sent_id"], offset, len(record)])
+                offset += len(record)
+
+        with open(get_index_file(record_file), "w", encoding="utf8", newline="") as f:
+            writer = csv.writer(f, dialect="tsv")
+            for row in index_row_list:
+                writer.writerow(row)
+        os.replace(record_file + ".tmp", record_file)
+
+    if write_log:
+        logger.info(f"Written to {record_file}")
+    return
+
+
+def iterate_record_file(record_file):
+    # stream datums in file order; json files are still parsed as a whole
+    output_format = get_output_format(record_file)
+    check_output_format(output_format)
+
+    if output_format == "json":
+        with open(record_file, "r", encoding="utf8") as f:
+            data = json.load(f)
+        yield from data
+
+    elif output_format == "jsonl":
+        with open(record_file, "r", encoding="utf8") as f:
+            for line in f:
+                yield json.loads(line)
+
+    else:
+        with open(record_file, "rb") as f:
+            yield from msgpack.Unpacker(f, raw=False)
+    return
+
+
+class RecordReader:
+    """
+    Random access to a jsonl or msgpack record file by (pmid, sent_id).
+
+    with RecordReader("batch_1/target.msgpack") as reader:
+        datum = reader.get("8602747", 1)
+    """
+
+    def __init__(self, record_file):
+        self.output_format = get_output_format(record_file)
+        assert self.output_format != "json", "json record files have no index"
+        check_output_format(self.output_format)
+
+        self.key_to_position = {}
+        with open(get_index_file(record_file), "r", encoding="utf8", newline="") as f:
+            for pmid, sent_id, offset, length in csv.reader(f, dialect="tsv"):
+                self.key_to_position[(pmid, int(sent_id))] = (int(offset), int(length))
+        self.f = open(record_file, "rb")
+
+    def __len__(self):
+        return len(self.key_to_position)
+
+    def __contains__(self, key):
+        pmid, sent_id = key
+        return (str(pmid), int(sent_id)) in self.key_to_position
+
+    def get(self, pmid, sent_id):
+        position = self.key_to_position.get((str(pmid), int(sent_id)))
+        if position is None:
+            return None
+        offset, length = position
+        self.f.seek(offset)
+        return decode_record(self.f.read(length), self.output_format)
+
+    def close(self):
+        self.f.close()
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def main():
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+        datefmt="%Y/%m/%d %H:%M:%S",
+        level=logging.INFO,
+    )
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--record_file", type=str, required=True)
+    # print one datum
+    parser.add_argument("--pmid", type=str)
+    parser.add_argument("--sent_id", type=int)
+    # or convert, e.g. an existing target.json to target.jsonl with its index
+    parser.add_argument("--target_file", type=str)
+    arg = parser.parse_args()
+
+    if arg.target_file:
+        os.makedirs(os.path.dirname(arg.target_file) or ".", exist_ok=True)
+        write_record_file(arg.target_file, list(iterate_record_file(arg.record_file)))
+    elif arg.pmid is not None:
+        with RecordReader(arg.record_file) as reader:
+            datum = reader.get(arg.pmid, arg.sent_id)
+        if datum is None:
+            logger.error(f"No datum for pmid={arg.pmid} sent_id={arg.sent_id}")
+            return 1
+        print(json.dumps(datum, indent=2, ensure_ascii=False))
+    else:
+        with RecordReader(arg.record_file) as reader:
+            logger.info(f"{len(reader):,} datums in {arg.record_file}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -9,12 +9,11 @@ mkdir -p ${tgt}
 i_l=${1}
 i_r=${2}
 
-for (( i=${i_l}; i<=${i_r}; i++ ))
-do
+# one process loads the model once for batch i_l..i_r; finished batches are skipped on restart
 python main.py \
---source_file ${src}/batch_${i}.json \
---target_dir ${tgt}/batch_${i} \
+--source_dir ${src} \
+--target_dir ${tgt} \
+--start ${i_l} \
+--end ${i_r} \
 --indent -1 \
-2>&1 | tee log/run_ner/batch_${i}.txt
-done
-
+2>&1 | tee log/run_ner/batch_${i_l}_${i_r}.txt
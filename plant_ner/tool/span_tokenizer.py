@@ -0,0 +1,232 @@
+import re
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+
+from nltk.tokenize.destructive import MacIntyreContractions, NLTKWordTokenizer
+
+logger = logging.getLogger(__name__)
+
+# Also imported by spacy_openrel_tool/plant_main.py:
+# NER token positions and openrel entity masking must use the same tokenization.
+
+# Stands for a starting " that NLTKWordTokenizer converts to ``: one character, always padded,
+# so that no later rule tells it from ``.
+open_quote = "\ue000"
+chunk_pattern = re.compile(r"\S+")
+# lowercase substrings without which no CONTRACTIONS2 or CONTRACTIONS3 rule matches
+contraction_list = ["cannot", "d'ye", "gimme", "gonna", "gotta", "lemme", "more'n", "wanna", "'tis", "'twas"]
+
+
+# The rules of NLTKWordTokenizer.tokenize in its order, each one of
+#   (literals, None): pad each literal with spaces
+#   (strings, regexp, substitution): regexp.sub(), if the text contains one of the strings
+#   (characters, regexp, substitution, None): the final period rules and ([:,])$,
+#       which can only match from the character before the last of the characters
+# A starting " becomes open_quote instead of ``, and an ending " is padded instead of converted to ''.
+# Substitutions are functions rather than templates, which re.sub() expands slowly.
+STARTING_QUOTES = [
+    ("«“‘„`", re.compile("([«“‘„]|[`]+)", re.U), lambda m: f" {m[1]} "),
+    ('"', re.compile(r"^\""), f" {open_quote} "),
+    (("``",), None),
+    (
+        ('"', "''"),
+        re.compile(r"([ \(\[{<])(\"|\'{2})"),
+        lambda m: m[1] + (f" {open_quote} " if m[2] == '"' else " `` "),
+    ),
+    ("'", re.compile(r"(?i)(\')(?!re|ve|ll|m|t|s|d|n)(\w)\b", re.U), lambda m: f"{m[1]} {m[2]}"),
+]
+PUNCTUATION = [
+    (".", re.compile(r'([^\.])(\.)([\]\)}>"\'' "»”’ " r"]*)\s*$", re.U), lambda m: f"{m[1]} {m[2]} {m[3]} ", None),
+    (":,", re.compile(r"([:,])([^\d])"), lambda m: f" {m[1]} {m[2]}"),
+    (":,", re.compile(r"([:,])$"), lambda m: f" {m[1]} ", None),
+    (("..",), re.compile(r"\.{2,}", re.U), lambda m: f" {m[0]} "),
+    (";@#$%&", None),
+    (".", re.compile(r'([^\.])(\.)([\]\)}>"\']*)\s*$'), lambda m: f"{m[1]} {m[2]}{m[3]} ", None),
+    ("?!", None),
+    (("' ",), re.compile(r"([^'])' "), lambda m: f"{m[1]} ' "),
+    ("*", None),
+    # PARENS_BRACKETS and DOUBLE_DASHES
+    ("[](){}<>", None),
+    (("--",), None),
+]
+ENDING_QUOTES = [
+    ("»”’", None),
+    (("''",), None),
+    ('"', None),
+    ("'", re.compile(r"([^' ])('[sS]|'[mM]|'[dD]|') "), lambda m: f"{m[1]} {m[2]} "),
+    ("'", re.compile(r"([^' ])('ll|'LL|'re|'RE|'ve|'VE|n't|N'T) "), lambda m: f"{m[1]} {m[2]} "),
+]
+CONTRACTIONS = [
+    re.compile(pattern)
+    for pattern in MacIntyreContractions.CONTRACTIONS2 + MacIntyreContractions.CONTRACTIONS3
+]
+
+
+def apply_rule_list(rule_list, text):
+    for rule in rule_list:
+        if rule[1] is None:
+            for literal in rule[0]:
+                if literal in text:
+                    text = text.replace(literal, f" {literal} ")
+            continue
+        for string in rule[0]:
+            if string in text:
+                break
+        else:
+            continue
+        if len(rule) == 3:
+            text = rule[1].sub(rule[2], text)
+            continue
+        match = rule[1].search(text, max(max(text.rfind(c) for c in rule[0]) - 1, 0))
+        if match:
+            text = text[:match.start()] + rule[2](match) + text[match.end():]
+    return text
+
+
+class SpanWordTokenizer:
+    """
+    NLTKWordTokenizer tokens with character spans, in one pass over the text.
+
+    The NLTKWordTokenizer rules are applied as they are, except that they only insert whitespace
+    (see STARTING_QUOTES for the two quote conversions this takes).
+    So the rewritten text has the non-whitespace characters of the text in the same order,
+    and each whitespace-delimited chunk of the text is split into consecutive tokens of known length;
+    there is no post-hoc alignment as in NLTKWordTokenizer.span_tokenize, and so no alignment failure.
+    Rules are skipped when the text lacks the characters they need.
+
+    Tokens are returned as substrings of the text, i.e. quotes are not converted to `` and ''.
+    """
+
+    def rewrite(self, text):
+        text = apply_rule_list(STARTING_QUOTES, text)
+        text = apply_rule_list(PUNCTUATION, text)
+        text = apply_rule_list(ENDING_QUOTES, " " + text + " ")
+        lowered = text.lower()
+        for contraction in contraction_list:
+            if contraction in lowered:
+                for regexp in CONTRACTIONS:
+                    text = regexp.sub(r" \1 \2 ", text)
+                break
+        return text
+
+    def span_tokenize(self, text):
+        token_list = self.rewrite(text).split()
+        span_list = []
+        ti = 0
+        for match in chunk_pattern.finditer(text):
+            i, j = match.span()
+            while i < j and ti < len(token_list):
+                span_list.append((i, i + len(token_list[ti])))
+                i += len(token_list[ti])
+                ti += 1
+            if i != j:
+                raise ValueError(f"Tokens do not cover {text[match.start():match.end()]!r} of {text!r}")
+        if ti != len(token_list):
+            raise ValueError(f"Tokens {token_list[ti:]} left after {text!r}")
+        return span_list
+
+    def span_tokenize_list(self, text_list):
+        return [self.span_tokenize(text) for text in text_list]
+
+    def tokenize(self, text):
+        return [text[i:j] for i, j in self.span_tokenize(text)]
+
+
+def read_sentence_sample(source_file, sentences, seed=0):
+    # source_file: pmid_text.jsonl, pmid_text.json, or a sentence batch json of plant_utils.py
+    sentence_list = []
+    with open(source_file, "r", encoding="utf8") as f:
+        if source_file.endswith(".jsonl"):
+            for line in f:
+                _pmid, text_list = json.loads(line)
+                sentence_list.extend(text_list)
+        else:
+            data = json.load(f)
+            if isinstance(data, dict):
+                for text_list in data.values():
+                    sentence_list.extend(text_list)
+            else:
+                sentence_list = [datum["sentence"] for datum in data]
+    if len(sentence_list) > sentences:
+        sentence_list = random.Random(seed).sample(sentence_list, sentences)
+    return sentence_list
+
+
+def validate_span_tokenizer(sentence_list, mismatches_to_show=10):
+    # spans must equal NLTKWordTokenizer.span_tokenize() wherever it succeeds, tokens its tokenize() elsewhere
+    nltk_tokenizer = NLTKWordTokenizer()
+    span_tokenizer = SpanWordTokenizer()
+
+    start_time = time.perf_counter()
+    nltk_span_list = []
+    for sentence in sentence_list:
+        try:
+            nltk_span_list.append(list(nltk_tokenizer.span_tokenize(sentence)))
+        except ValueError:
+            nltk_span_list.append(None)
+    nltk_seconds = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    fast_span_list = span_tokenizer.span_tokenize_list(sentence_list)
+    fast_seconds = time.perf_counter() - start_time
+
+    nltk_failures = 0
+    mismatches = 0
+    quote_set = {'"', "``", "''"}
+    for sentence, nltk_spans, fast_spans in zip(sentence_list, nltk_span_list, fast_span_list):
+        fast_token_list = [sentence[i:j] for i, j in fast_spans]
+        if nltk_spans is None:
+            # tokens instead, up to the quote conversion
+            nltk_failures += 1
+            nltk_token_list = nltk_tokenizer.tokenize(sentence)
+            matched = len(nltk_token_list) == len(fast_token_list) and all(
+                a == b or (a in quote_set and b in quote_set)
+                for a, b in zip(nltk_token_list, fast_token_list)
+            )
+        else:
+            nltk_token_list = [sentence[i:j] for i, j in nltk_spans]
+            matched = nltk_spans == fast_spans
+        if not matched:
+            mismatches += 1
+            if mismatches <= mismatches_to_show:
+                logger.info(f"[mismatch] {sentence!r}\n  nltk: {nltk_token_list}\n  fast: {fast_token_list}")
+
+    sentences = len(sentence_list)
+    logger.info(
+        f"{sentences:,} sentences;"
+        f" {sentences - mismatches:,}/{sentences:,} identical;"
+        f" {nltk_failures:,} NLTK span_tokenize failures, compared by tokens"
+    )
+    logger.info(
+        f"NLTK {sentences / nltk_seconds:,.0f} sentences/s;"
+        f" SpanWordTokenizer {sentences / fast_seconds:,.0f} sentences/s ({nltk_seconds / fast_seconds:.1f}x)"
+    )
+    return mismatches
+
+
+def main():
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+        datefmt="%Y/%m/%d %H:%M:%S",
+        level=logging.INFO,
+    )
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--source_file", type=str, required=True)
+    parser.add_argument("--sentences", type=int, default=200000)
+    parser.add_argument("--seed", type=int, default=0)
+    arg = parser.parse_args()
+    for key, value in vars(arg).items():
+        if value is not None:
+            logger.info(f"[arg.{key}] {value}")
+
+    sentence_list = read_sentence_sample(arg.source_file, arg.sentences, arg.seed)
+    mismatches = validate_span_tokenizer(sentence_list)
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,3 +1,4 @@
+import os
 import re
 import csv
 import sys
@@ -7,9 +8,14 @@ import argparse
 from collections import defaultdict
 
 import spacy
-from nltk.tokenize.destructive import NLTKWordTokenizer
 from nltk.tokenize.treebank import TreebankWordDetokenizer
 
+# span_tokenizer: shared with plant_ner/tool/ so that NER token positions and openrel entity masking agree
+# record_file: NER batch formats of plant_ner/tool/main.py --output_format
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "plant_ner", "tool"))
+from span_tokenizer import SpanWordTokenizer
+from record_file import iterate_record_file
+
 logger = logging.getLogger(__name__)
 logging.basicConfig(
     format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
@@ -94,7 +100,7 @@ def write_csv(file, dialect, row_list, write_log=True):
 def get_masked_sentence_list(data, start, end, max_tokens=128, max_token_length=500):
     sentence_list = []
     di_list = []
-    tokenizer = NLTKWordTokenizer()
+    tokenizer = SpanWordTokenizer()
     detokenizer = TreebankWordDetokenizer()
 
     for di in range(start, end):
@@ -404,8 +410,20 @@ def add_relation_data(data, start, end, version):
     return sentences_with_triplets, triplets, perfect_triplets
 
 
+def read_source_data(source_file):
+    # target.jsonl and target.msgpack NER batches are read with record_file; anything else is a json list
+    if os.path.splitext(source_file)[1] not in [".jsonl", ".msgpack"]:
+        return read_json(source_file)
+
+    logger.info(f"Reading {source_file}")
+    data = list(iterate_record_file(source_file))
+    objects = len(data)
+    logger.info(f"Read {objects:,} objects")
+    return data
+
+
 def run_spacy_relation_extraction(arg):
-    data = read_json(arg.source_file)
+    data = read_source_data(arg.source_file)
     sentences = len(data)
 
     if not arg.use_cpu:
@@ -442,6 +460,7 @@ def run_spacy_relation_extraction(arg):
 
 def main():
     parser = argparse.ArgumentParser()
+    # a json list, or the target.jsonl / target.msgpack of plant_ner/tool/main.py --output_format
     parser.add_argument("--source_file", type=str, default="source.json")
     parser.add_argument("--target_file", type=str, default="target.json")
     parser.add_argument("--batch_size", type=int, default=50000)